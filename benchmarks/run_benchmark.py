@@ -0,0 +1,200 @@
+# Offline end-to-end benchmark for lambda_handler. Runs the handler against
+# the local stand-ins in benchmarks/stand_ins.py and sweeps the Notion update
+# settings.
+#
+#   python -m benchmarks.run_benchmark --crypto-rows 10000 --workers 4,8,16 \
+#       --rps 25,100 --burst 1,10 --latency-ms 30 --jitter-ms 20
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from benchmarks import stand_ins  # noqa: E402
+
+os.environ.setdefault("ENVIRONMENT", "production")
+
+import lambda_function  # noqa: E402
+
+
+def parse_list(value, cast):
+    return [cast(item) for item in value.split(",") if item]
+
+
+def build_env(base_url, cache_dir, workers, rps_limit, burst, args):
+    return {
+        "ENVIRONMENT": "production",
+        "NOTION_API_KEY": "benchmark",
+        "ALPHA_VANTAGE_API_KEY": "benchmark",
+        "CRYPTO_DB_ID": stand_ins.CRYPTO_DB_ID,
+        "STOCK_DB_ID": stand_ins.STOCK_DB_ID,
+        "FIAT_DB_ID": stand_ins.FIAT_DB_ID,
+        "TOTAL_CALLOUT_BLOCK_ID": stand_ins.CALLOUT_BLOCK_ID,
+        "PIPELINE_MODE": args.pipeline_mode,
+        "NOTION_UPDATE_MAX_WORKERS": str(workers),
+        "NOTION_UPDATE_RPS_LIMIT": str(rps_limit),
+        "NOTION_UPDATE_BURST": str(burst),
+        "COINGECKO_RPS_LIMIT": "1000",
+        "COINGECKO_SYMBOL_CACHE_PATH": os.path.join(cache_dir, "symbols.json"),
+        "STOCK_QUOTE_CACHE_PATH": os.path.join(cache_dir, "quotes.json"),
+        "ALPHA_VANTAGE_DAILY_QUOTA": str(args.alpha_vantage_quota),
+        "ALPHA_VANTAGE_REQUEST_INTERVAL_SECONDS": "0",
+    }
+
+
+MODULE_STATE = (
+    "NOTION_API_URL",
+    "COINGECKO_API_URL",
+    "ALPHA_VANTAGE_API_URL",
+    "RUNTIME",
+    "COINGECKO_SYMBOL_CACHE",
+    "CALLOUT_CACHE",
+    "PROVIDER_STATS",
+)
+
+
+def point_at_stand_ins(base_url):
+    lambda_function.NOTION_API_URL = f"{base_url}notion/"
+    lambda_function.COINGECKO_API_URL = f"{base_url}coingecko/"
+    lambda_function.ALPHA_VANTAGE_API_URL = f"{base_url}alphavantage/"
+    # Force a cold start so every scenario builds its own session and caches
+    lambda_function.RUNTIME = None
+    lambda_function.COINGECKO_SYMBOL_CACHE = None
+    lambda_function.CALLOUT_CACHE = None
+    lambda_function.PROVIDER_STATS = None
+
+
+def run_scenario(server, portfolio_args, workers, rps_limit, burst, args):
+    portfolio = stand_ins.generate_portfolio(**portfolio_args)
+    state = stand_ins.StandInState(
+        portfolio,
+        latency=args.latency_ms / 1000.0,
+        jitter=args.jitter_ms / 1000.0,
+        throttle_ratio=args.throttle_ratio,
+        retry_after=args.retry_after,
+        seed=args.seed,
+    )
+    server.state = state
+    point_at_stand_ins(server.base_url)
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        env = build_env(server.base_url, cache_dir, workers, rps_limit, burst, args)
+        saved_env = {name: os.environ.get(name) for name in env}
+        os.environ.update(env)
+        log = io.StringIO()
+        start = time.monotonic()
+        try:
+            with contextlib.redirect_stdout(log):
+                lambda_function.lambda_handler(None, None)
+        finally:
+            wall_time = time.monotonic() - start
+            for name, value in saved_env.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+
+    writes = state.request_counts.get("notion.page_patch", 0)
+    requests_issued = state.total_requests()
+    return {
+        "workers": workers,
+        "rps_limit": rps_limit,
+        "burst": burst,
+        "pipeline_mode": args.pipeline_mode,
+        "wall_time_s": round(wall_time, 3),
+        "requests": requests_issued,
+        "requests_per_s": round(requests_issued / wall_time, 2) if wall_time else 0,
+        "writes": writes,
+        "writes_per_s": round(writes / wall_time, 2) if wall_time else 0,
+        "throttled": state.throttled,
+        "bytes_received": state.bytes_sent,
+        "request_counts": dict(sorted(state.request_counts.items())),
+        "log_lines": log.getvalue().count("\n"),
+    }
+
+
+def print_table(results):
+    columns = [
+        "workers",
+        "rps_limit",
+        "burst",
+        "wall_time_s",
+        "requests",
+        "requests_per_s",
+        "writes",
+        "writes_per_s",
+        "throttled",
+    ]
+    print(" ".join(f"{column:>14}" for column in columns))
+    for result in results:
+        print(" ".join(f"{result[column]:>14}" for column in columns))
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Offline end-to-end benchmark for lambda_handler"
+    )
+    parser.add_argument("--crypto-rows", type=int, default=2000)
+    parser.add_argument("--stock-rows", type=int, default=200)
+    parser.add_argument("--fiat-rows", type=int, default=20)
+    parser.add_argument("--coins", type=int, default=200)
+    parser.add_argument("--stocks", type=int, default=25)
+    parser.add_argument("--price-move-ratio", type=float, default=1.0)
+    parser.add_argument("--latency-ms", type=float, default=20.0)
+    parser.add_argument("--jitter-ms", type=float, default=10.0)
+    parser.add_argument("--throttle-ratio", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--alpha-vantage-quota", type=int, default=25)
+    parser.add_argument("--workers", default="4,8,16")
+    parser.add_argument("--rps", default="50,200")
+    parser.add_argument("--burst", default="1,10")
+    parser.add_argument("--pipeline-mode", choices=["sync", "async"], default="sync")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", dest="json_path", help="Write results to this file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    portfolio_args = {
+        "crypto_rows": args.crypto_rows,
+        "stock_rows": args.stock_rows,
+        "fiat_rows": args.fiat_rows,
+        "coin_count": args.coins,
+        "stock_count": args.stocks,
+        "price_move_ratio": args.price_move_ratio,
+        "seed": args.seed,
+    }
+    sweep = itertools.product(
+        parse_list(args.workers, int),
+        parse_list(args.rps, float),
+        parse_list(args.burst, int),
+    )
+    results = []
+    saved_state = {name: getattr(lambda_function, name) for name in MODULE_STATE}
+    server = stand_ins.StandInServer(None).start()
+    try:
+        for workers, rps_limit, burst in sweep:
+            results.append(
+                run_scenario(server, portfolio_args, workers, rps_limit, burst, args)
+            )
+    finally:
+        server.stop()
+        for name, value in saved_state.items():
+            setattr(lambda_function, name, value)
+
+    print_table(results)
+    if args.json_path:
+        with open(args.json_path, "w") as output:
+            json.dump(results, output, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    main()
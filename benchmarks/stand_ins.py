@@ -0,0 +1,426 @@
+# Local stand-ins for the Notion, CoinGecko and AlphaVantage endpoints used by
+# lambda_function, plus a generator for synthetic portfolios. One threaded HTTP
+# server serves all three APIs under /notion/, /coingecko/ and /alphavantage/.
+import datetime
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+CRYPTO_DB_ID = "crypto-db"
+STOCK_DB_ID = "stock-db"
+FIAT_DB_ID = "fiat-db"
+CALLOUT_BLOCK_ID = "total-callout"
+COINS_LIST_ETAG = '"stand-in-coins-list"'
+MAX_URL_LENGTH = 8000
+
+
+def notion_timestamp(moment=None):
+    moment = moment or datetime.datetime.utcnow()
+    return moment.strftime("%Y-%m-%dT%H:%M:00.000Z")
+
+
+def make_row(database_id, page_id, symbol_property, symbol, amount, price):
+    return {
+        "object": "page",
+        "id": page_id,
+        "parent": {"type": "database_id", "database_id": database_id},
+        "last_edited_time": notion_timestamp(),
+        "properties": {
+            symbol_property: {"type": "select", "select": {"name": symbol}},
+            "Amount": {"type": "number", "number": amount},
+            "Price": {"type": "number", "number": price},
+            "Total": {
+                "type": "formula",
+                "formula": {"type": "number", "number": amount * price},
+            },
+            "Notes": {"type": "rich_text", "rich_text": []},
+        },
+    }
+
+
+def make_fiat_row(page_id, total):
+    return {
+        "object": "page",
+        "id": page_id,
+        "parent": {"type": "database_id", "database_id": FIAT_DB_ID},
+        "last_edited_time": notion_timestamp(),
+        "properties": {
+            "Currency": {"type": "select", "select": {"name": "USD"}},
+            "Total": {"type": "number", "number": total},
+        },
+    }
+
+
+def generate_portfolio(
+    crypto_rows=1000,
+    stock_rows=100,
+    fiat_rows=10,
+    coin_count=100,
+    stock_count=20,
+    price_move_ratio=1.0,
+    seed=0,
+):
+    # Notion holds yesterday's prices; the price APIs return today's, with
+    # price_move_ratio of the symbols having moved
+    rng = random.Random(seed)
+    coins = [(f"coin-{index:05d}", f"C{index}") for index in range(coin_count)]
+    coins_list = []
+    notion_coin_prices = {}
+    coin_prices = {}
+    for coin_id, symbol in coins:
+        coins_list.append({"id": coin_id, "symbol": symbol.lower(), "name": coin_id})
+        if len(coins_list) % 10 == 0:
+            # Ambiguous symbols, like the real coins list
+            coins_list.append(
+                {"id": f"{coin_id}-bridged", "symbol": symbol.lower(), "name": symbol}
+            )
+        price = round(rng.uniform(0.01, 50000), 4)
+        notion_coin_prices[symbol] = price
+        if rng.random() < price_move_ratio:
+            coin_prices[coin_id] = round(price * rng.uniform(0.9, 1.1), 4)
+        else:
+            coin_prices[coin_id] = price
+    coins_list.sort(key=lambda coin: coin["id"])
+
+    stocks = [f"S{index}" for index in range(stock_count)]
+    notion_stock_prices = {}
+    stock_prices = {}
+    for symbol in stocks:
+        price = round(rng.uniform(5, 900), 2)
+        notion_stock_prices[symbol] = price
+        if rng.random() < price_move_ratio:
+            stock_prices[symbol] = round(price * rng.uniform(0.95, 1.05), 2)
+        else:
+            stock_prices[symbol] = price
+
+    crypto = []
+    for index in range(crypto_rows):
+        _, symbol = coins[rng.randrange(coin_count)]
+        crypto.append(
+            make_row(
+                CRYPTO_DB_ID,
+                f"crypto-page-{index}",
+                "Coin",
+                symbol,
+                round(rng.uniform(0.001, 10), 6),
+                notion_coin_prices[symbol],
+            )
+        )
+    stock = []
+    for index in range(stock_rows):
+        symbol = stocks[rng.randrange(stock_count)]
+        stock.append(
+            make_row(
+                STOCK_DB_ID,
+                f"stock-page-{index}",
+                "Stock",
+                symbol,
+                rng.randint(0, 50),
+                notion_stock_prices[symbol],
+            )
+        )
+    fiat = [
+        make_fiat_row(f"fiat-page-{index}", round(rng.uniform(10, 5000), 2))
+        for index in range(fiat_rows)
+    ]
+    return {
+        "databases": {CRYPTO_DB_ID: crypto, STOCK_DB_ID: stock, FIAT_DB_ID: fiat},
+        "coins_list": coins_list,
+        "coin_prices": coin_prices,
+        "stock_prices": stock_prices,
+    }
+
+
+def matches_filter(row, query_filter):
+    if not query_filter:
+        return True
+    if "and" in query_filter:
+        return all(matches_filter(row, item) for item in query_filter["and"])
+    if "or" in query_filter:
+        return any(matches_filter(row, item) for item in query_filter["or"])
+    if query_filter.get("timestamp") == "last_edited_time":
+        condition = query_filter.get("last_edited_time", {})
+        if "on_or_after" in condition:
+            return row["last_edited_time"] >= condition["on_or_after"]
+        if "after" in condition:
+            return row["last_edited_time"] > condition["after"]
+        return True
+    value = row["properties"].get(query_filter.get("property"), {}).get("number")
+    condition = query_filter.get("number", {})
+    if "does_not_equal" in condition:
+        return value != condition["does_not_equal"]
+    if "greater_than" in condition:
+        return value is not None and value > condition["greater_than"]
+    if "equals" in condition:
+        return value == condition["equals"]
+    return True
+
+
+def project(row, filter_properties):
+    if not filter_properties:
+        return row
+    projected = dict(row)
+    projected["properties"] = {
+        name: value
+        for name, value in row["properties"].items()
+        if name in filter_properties
+    }
+    return projected
+
+
+class StandInState:
+    def __init__(
+        self,
+        portfolio,
+        latency=0.0,
+        jitter=0.0,
+        throttle_ratio=0.0,
+        retry_after=1,
+        seed=0,
+    ):
+        self.databases = portfolio["databases"]
+        self.pages = {
+            row["id"]: row for rows in self.databases.values() for row in rows
+        }
+        self.coins_list = portfolio["coins_list"]
+        self.coin_prices = portfolio["coin_prices"]
+        self.stock_prices = portfolio["stock_prices"]
+        self.blocks = {
+            CALLOUT_BLOCK_ID: {
+                "object": "block",
+                "id": CALLOUT_BLOCK_ID,
+                "type": "callout",
+                "callout": {
+                    "rich_text": [
+                        {"type": "text", "text": {"content": "Total assets"}},
+                        {"type": "text", "text": {"content": ": $0.00"}},
+                    ]
+                },
+            }
+        }
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_ratio = throttle_ratio
+        self.retry_after = retry_after
+        self.request_counts = {}
+        self.throttled = 0
+        self.bytes_sent = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def begin_request(self, endpoint):
+        with self._lock:
+            self.request_counts[endpoint] = self.request_counts.get(endpoint, 0) + 1
+            delay = self.latency + self._random.uniform(0, self.jitter)
+            throttled = self._random.random() < self.throttle_ratio
+            if throttled:
+                self.throttled += 1
+        if delay > 0:
+            time.sleep(delay)
+        return throttled
+
+    def record_bytes(self, count):
+        with self._lock:
+            self.bytes_sent += count
+
+    def total_requests(self):
+        with self._lock:
+            return sum(self.request_counts.values())
+
+    def query_database(self, database_id, body, filter_properties):
+        rows = [
+            row
+            for row in self.databases.get(database_id, [])
+            if matches_filter(row, body.get("filter"))
+        ]
+        start = int(body.get("start_cursor") or 0)
+        page_size = min(int(body.get("page_size") or 100), 100)
+        end = start + page_size
+        return {
+            "object": "list",
+            "results": [project(row, filter_properties) for row in rows[start:end]],
+            "has_more": end < len(rows),
+            "next_cursor": str(end) if end < len(rows) else None,
+        }
+
+    def update_page(self, page_id, body):
+        with self._lock:
+            row = self.pages.get(page_id)
+            if row is None:
+                return None
+            for name, value in body.get("properties", {}).items():
+                row["properties"].setdefault(name, {}).update(value)
+            properties = row["properties"]
+            if "Amount" in properties and "formula" in properties.get("Total", {}):
+                amount = properties["Amount"].get("number") or 0
+                price = properties.get("Price", {}).get("number") or 0
+                properties["Total"]["formula"]["number"] = amount * price
+            row["last_edited_time"] = notion_timestamp()
+            return row
+
+    def simple_price(self, ids, vs_currencies):
+        prices = {}
+        for coin_id in ids:
+            if coin_id in self.coin_prices:
+                usd = self.coin_prices[coin_id]
+                prices[coin_id] = {
+                    currency: usd if currency == "usd" else round(usd * 0.92, 6)
+                    for currency in vs_currencies
+                }
+        return prices
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes; without this every
+    # keep-alive response waits on a delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.route("GET")
+
+    def do_POST(self):
+        self.route("POST")
+
+    def do_PATCH(self):
+        self.route("PATCH")
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length))
+
+    def send_json(self, status, data, extra_headers=None):
+        body = json.dumps(data).encode() if data is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (extra_headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.state.record_bytes(len(body))
+
+    def route(self, method):
+        state = self.server.state
+        parsed = urlparse(self.path)
+        query = parse_qs(parsed.query)
+        parts = [part for part in parsed.path.split("/") if part]
+        body = self.read_body() if method in ("POST", "PATCH") else {}
+        if len(self.path) > MAX_URL_LENGTH:
+            self.send_json(414, {"message": "URI too long"})
+            return
+
+        if parts[:2] == ["notion", "v1"]:
+            self.route_notion(method, parts[2:], query, body, state)
+        elif parts[:3] == ["coingecko", "api", "v3"]:
+            self.route_coingecko(parts[3:], query, state)
+        elif parts[:2] == ["alphavantage", "query"]:
+            state.begin_request("alphavantage.quote")
+            symbol = query.get("symbol", [""])[0].split(".")[0]
+            price = state.stock_prices.get(symbol)
+            if price is None:
+                self.send_json(200, {"Global Quote": {}})
+            else:
+                self.send_json(200, {"Global Quote": {"05. price": f"{price:.4f}"}})
+        else:
+            self.send_json(404, {"message": f"Unknown path {parsed.path}"})
+
+    def route_notion(self, method, parts, query, body, state):
+        if parts[:1] == ["databases"] and parts[2:] == ["query"] and method == "POST":
+            endpoint = "notion.query"
+        elif parts[:1] == ["pages"] and method == "PATCH":
+            endpoint = "notion.page_patch"
+        elif parts[:1] == ["blocks"] and method in ("GET", "PATCH"):
+            endpoint = f"notion.block_{method.lower()}"
+        else:
+            self.send_json(404, {"message": "Unknown Notion endpoint"})
+            return
+
+        if state.begin_request(endpoint):
+            self.send_json(
+                429,
+                {"object": "error", "code": "rate_limited"},
+                {"Retry-After": str(state.retry_after)},
+            )
+            return
+
+        if endpoint == "notion.query":
+            self.send_json(
+                200,
+                state.query_database(parts[1], body, query.get("filter_properties")),
+            )
+        elif endpoint == "notion.page_patch":
+            row = state.update_page(parts[1], body)
+            if row is None:
+                self.send_json(404, {"object": "error", "code": "object_not_found"})
+            else:
+                self.send_json(200, row)
+        else:
+            block = state.blocks.get(parts[1])
+            if block is None:
+                self.send_json(404, {"object": "error", "code": "object_not_found"})
+                return
+            if method == "PATCH":
+                block["callout"].update(body.get("callout", {}))
+            self.send_json(200, block)
+
+    def route_coingecko(self, parts, query, state):
+        if parts == ["coins", "list"]:
+            state.begin_request("coingecko.coins_list")
+            if self.headers.get("If-None-Match") == COINS_LIST_ETAG:
+                self.send_json(304, None, {"ETag": COINS_LIST_ETAG})
+            else:
+                self.send_json(200, state.coins_list, {"ETag": COINS_LIST_ETAG})
+        elif parts == ["simple", "price"]:
+            state.begin_request("coingecko.simple_price")
+            ids = [item for item in query.get("ids", [""])[0].split(",") if item]
+            vs_currencies = query.get("vs_currencies", ["usd"])[0].split(",")
+            self.send_json(200, state.simple_price(ids, vs_currencies))
+        else:
+            self.send_json(404, {"error": "Unknown CoinGecko endpoint"})
+
+
+class StandInServer:
+    def __init__(self, state, host="127.0.0.1", port=0):
+        self.httpd = ThreadingHTTPServer((host, port), StandInHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.state = state
+        self._thread = None
+
+    @property
+    def state(self):
+        return self.httpd.state
+
+    @state.setter
+    def state(self, state):
+        self.httpd.state = state
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -1,12 +1,66 @@
+import bisect
+import copy
 import datetime
+import functools
+import importlib.util
+import json
+import math
+import mmap
 import os
+import struct
+import sys
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import zlib
+from array import array
+from contextlib import contextmanager
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
 from threading import Lock
 
-import requests
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
+# Start of the cold-start clock. The runtime has already loaded most of the
+# stdlib above, so the imports below make up the import time we report.
+IMPORT_STARTED_AT = time.monotonic()
+
+
+def lazy_import(name):
+    # The module loads on first attribute access instead of at import time.
+    # Only for modules whose first use is on the main thread (LazyLoader is
+    # not safe when several threads trigger the load at once).
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+# Only PIPELINE_MODE=async needs asyncio, which costs more to import than the
+# rest of the module put together
+asyncio = lazy_import("asyncio")
+
+import requests  # noqa: E402
+from requests.adapters import HTTPAdapter  # noqa: E402
+from urllib3.util.retry import Retry  # noqa: E402
+
+try:
+    import numpy
+except ImportError:
+    # Not part of the Lambda bundle; valuation falls back to array("d")
+    numpy = None
+
+try:
+    import orjson
+except ImportError:
+    # Optional faster decoder for Notion and CoinGecko responses
+    orjson = None
 
 if os.environ.get("ENVIRONMENT") != "production":
     from dotenv import load_dotenv
@@ -18,26 +72,231 @@ PRICE_LITERAL = "05. price"
 INFO_LITERAL = "Information"
 DEFAULT_TIMEOUT_SECONDS = 10
 COINGECKO_SYMBOL_CACHE = None
+DEFAULT_COINGECKO_SYMBOL_CACHE_PATH = "/tmp/coingecko_symbol_index.json"
+DEFAULT_COINGECKO_SYMBOL_CACHE_TTL_SECONDS = 24 * 60 * 60
+DEFAULT_COINGECKO_PRICE_BATCH_SIZE = 100
+DEFAULT_COINGECKO_PRICE_MAX_URL_LENGTH = 2000
+DEFAULT_COINGECKO_PRICE_MAX_WORKERS = 2
+DEFAULT_COINGECKO_RPS_LIMIT = 0.5
+# /tmp is per container, so each new container starts the daily quota from zero.
+# Point STOCK_QUOTE_CACHE_PATH at a shared mount (EFS) to enforce it account-wide.
+DEFAULT_STOCK_QUOTE_CACHE_PATH = "/tmp/alphavantage_quotes.json"
+DEFAULT_ALPHA_VANTAGE_DAILY_QUOTA = 25
+DEFAULT_STOCK_QUOTE_MIN_AGE_SECONDS = 60 * 60
+# Symbols shared by several CoinGecko coins and the id we hold for each.
+# Extend through COINGECKO_SYMBOL_OVERRIDES (JSON) or COINGECKO_SYMBOL_OVERRIDES_PATH.
+DEFAULT_COINGECKO_SYMBOL_OVERRIDES = {
+    "dai": "dai",
+    "mana": "decentraland",
+    "eth": "ethereum",
+    "btc": "bitcoin",
+    "usdt": "tether",
+    "bnb": "binancecoin",
+}
 DEFAULT_NOTION_UPDATE_MAX_WORKERS = 4
 DEFAULT_NOTION_UPDATE_RPS_LIMIT = 2.5
 DEFAULT_NOTION_UPDATE_BURST = 1
+DEFAULT_NOTION_QUERY_PAGE_SIZE = 100
+DEFAULT_NOTION_THROTTLE_RETRIES = 3
+# Base URLs can be pointed at local stand-ins (see benchmarks/); keep the trailing /
+NOTION_API_URL = os.environ.get("NOTION_API_URL", "https://api.notion.com/")
+COINGECKO_API_URL = os.environ.get("COINGECKO_API_URL", "https://api.coingecko.com/")
+ALPHA_VANTAGE_API_URL = os.environ.get(
+    "ALPHA_VANTAGE_API_URL", "https://www.alphavantage.co/"
+)
+COINBASE_API_URL = os.environ.get("COINBASE_API_URL", "https://api.coinbase.com/")
+FINNHUB_API_URL = os.environ.get("FINNHUB_API_URL", "https://finnhub.io/")
+DEFAULT_ALPHA_VANTAGE_REQUEST_INTERVAL_SECONDS = 1.0
+DEFAULT_TOTALS_FULL_RECONCILE_SECONDS = 86400
+# Notion rounds last_edited_time down to the minute
+DEFAULT_TOTALS_EDIT_SLACK_SECONDS = 120
+# Serializes totals cache writes: portfolios finish on several threads
+TOTALS_CACHE_LOCK = Lock()
+# Price history records: timestamp, symbol id, price, holding value
+PRICE_HISTORY_MAGIC = b"NSPH"
+PRICE_HISTORY_VERSION = 1
+PRICE_HISTORY_HEADER = struct.Struct("<4sHH")
+PRICE_HISTORY_RECORD = struct.Struct("<dIdd")
+# Serializes appends: portfolios finish on several threads and share the file
+PRICE_HISTORY_LOCK = Lock()
+DEFAULT_NOTION_JOB_MAX_ATTEMPTS = 5
+DEFAULT_NOTION_JOB_LEASE_SECONDS = 120
+MAX_NOTION_JOB_BACKOFF_SECONDS = 60
+# Last rich_text written to each callout block, kept across warm invocations
+CALLOUT_CACHE = None
+CALLOUT_CACHE_LOCK = Lock()
+# Time kept back from the Lambda deadline for the total and the callout
+DEFAULT_DEADLINE_RESERVE_SECONDS = 15.0
+MIN_REQUEST_TIMEOUT_SECONDS = 1.0
+# Deadline for the invocation in progress; None when there is no Lambda context
+RUN_DEADLINE = None
+DEFAULT_METRICS_NAMESPACE = "NotionSavings"
+DEFAULT_ROW_LOG_SAMPLE_RATE = 0.01
+WRITE_LATENCY_BUCKETS_MS = [50, 100, 250, 500, 1000, 2500, 5000]
+# Metrics for the invocation in progress, replaced by start_run_metrics
+RUN_METRICS = None
+# Price providers tried for each asset class, in order, until stats say otherwise
+DEFAULT_PRICE_PROVIDERS = {"crypto": "coingecko", "stock": "alphavantage"}
+# A secondary provider is asked once the current one is this slow
+DEFAULT_PRICE_HEDGE_DELAY_SECONDS = 2.0
+PROVIDER_LATENCY_SMOOTHING = 0.3
+PROVIDER_MAX_CONSECUTIVE_FAILURES = 3
+PROVIDER_COOLDOWN_SECONDS = 300
+# Latency and health per price provider, kept across warm invocations
+PROVIDER_STATS = None
+PROVIDER_STATS_LOCK = Lock()
+# Single-flight lease for overlapping triggers (button clicks and the schedule)
+DEFAULT_RUN_LEASE_TTL_SECONDS = 900
+DEFAULT_RUN_RESULT_FRESH_SECONDS = 60
+DEFAULT_RUN_LEASE_WAIT_SECONDS = 300
+RUN_LEASE_POLL_SECONDS = 1.0
+# Import + init + time to first request allowed for a cold start
+DEFAULT_COLD_START_BUDGET_MS = 1000.0
+# Seconds spent importing this module and building the runtime, per container
+STARTUP_TIMINGS = {}
+DEFAULT_POOL_SIZE = 10
+# Built once per container by get_runtime and reused by warm invocations
+RUNTIME = None
+# Only the properties each stage reads are requested from Notion
+CRYPTO_QUERY_PROPERTIES = ["Coin", "Price", "Amount", "Total"]
+STOCK_QUERY_PROPERTIES = ["Stock", "Price", "Amount", "Total"]
+FIAT_QUERY_PROPERTIES = ["Total"]
+# Zero-amount stock rows never get a price update and add nothing to the total.
+# Negative amounts still count towards the total, so this is not "> 0".
+STOCK_QUERY_FILTER = {"property": "Amount", "number": {"does_not_equal": 0}}
+# Select that names a row's coin, stock or fiat currency, in lookup order
+HOLDING_SYMBOL_PROPERTIES = ("Coin", "Stock", "Currency")
+
+
+# Remaining-time budget for one invocation. Until enter_final_phase is called
+# the reserve is held back, so price fetches and writes stop in time for the
+# total and the callout.
+class Deadline:
+    def __init__(self, remaining_seconds, reserve_seconds):
+        self.expires_at = time.monotonic() + remaining_seconds
+        self.reserve_seconds = reserve_seconds
+        self.final = False
+
+    def remaining(self):
+        return self.expires_at - time.monotonic()
+
+    def budget(self):
+        if self.final:
+            return self.remaining()
+        return self.remaining() - self.reserve_seconds
+
+    def enter_final_phase(self):
+        self.final = True
+
+
+def start_run_deadline(context):
+    global RUN_DEADLINE
+    get_remaining_time = getattr(context, "get_remaining_time_in_millis", None)
+    if get_remaining_time is None:
+        RUN_DEADLINE = None
+        return None
+    reserve_seconds = parse_float_env(
+        "DEADLINE_RESERVE_SECONDS", DEFAULT_DEADLINE_RESERVE_SECONDS, 0.0
+    )
+    RUN_DEADLINE = Deadline(get_remaining_time() / 1000.0, reserve_seconds)
+    print(
+        f"Deadline: remaining={RUN_DEADLINE.remaining():.1f}s, "
+        f"reserve={reserve_seconds}s"
+    )
+    return RUN_DEADLINE
+
+
+def get_deadline_budget():
+    return None if RUN_DEADLINE is None else RUN_DEADLINE.budget()
+
+
+def has_time_for_work():
+    budget = get_deadline_budget()
+    return budget is None or budget > MIN_REQUEST_TIMEOUT_SECONDS
+
+
+def enter_final_phase():
+    if RUN_DEADLINE is not None:
+        RUN_DEADLINE.enter_final_phase()
+
+
+def cap_to_deadline(seconds):
+    budget = get_deadline_budget()
+    if budget is None:
+        return seconds
+    return max(0.0, min(seconds, budget - MIN_REQUEST_TIMEOUT_SECONDS))
+
+
+def get_request_timeout():
+    budget = get_deadline_budget()
+    if budget is None:
+        return DEFAULT_TIMEOUT_SECONDS
+    return max(MIN_REQUEST_TIMEOUT_SECONDS, min(DEFAULT_TIMEOUT_SECONDS, budget))
+
+
+# urllib3 retries that never back off or retry past the run deadline.
+# Retry.new() copies use type(self), so the subclass survives every increment.
+class DeadlineRetry(Retry):
+    def get_backoff_time(self):
+        return cap_to_deadline(super().get_backoff_time())
 
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        return None if retry_after is None else cap_to_deadline(retry_after)
 
-def create_session():
-    retry = Retry(
+    def is_exhausted(self):
+        return super().is_exhausted() or not has_time_for_work()
+
+
+def create_retry(status_forcelist, allowed_methods=("GET", "POST", "PATCH")):
+    return DeadlineRetry(
         total=3,
         backoff_factor=0.5,
-        status_forcelist=[429, 500, 502, 503, 504],
-        allowed_methods=["GET", "POST", "PATCH"],
+        status_forcelist=status_forcelist,
+        allowed_methods=list(allowed_methods),
     )
+
+
+def create_session(
+    notion_pool_size=DEFAULT_POOL_SIZE,
+    coingecko_pool_size=DEFAULT_POOL_SIZE,
+    retry_notion_writes=True,
+):
     session = requests.Session()
-    adapter = HTTPAdapter(max_retries=retry)
+    adapter = HTTPAdapter(max_retries=create_retry([429, 500, 502, 503, 504]))
     session.mount("https://", adapter)
     session.mount("http://", adapter)
+    session.mount(
+        COINGECKO_API_URL,
+        HTTPAdapter(
+            pool_maxsize=coingecko_pool_size,
+            max_retries=create_retry([429, 500, 502, 503, 504]),
+        ),
+    )
+    # Notion 429s are left to the shared RateLimiter so it can back off. With
+    # the job queue, failed PATCHes are requeued instead of retried here.
+    notion_methods = ("GET", "POST")
+    if retry_notion_writes:
+        notion_methods += ("PATCH",)
+    session.mount(
+        NOTION_API_URL,
+        HTTPAdapter(
+            pool_maxsize=notion_pool_size,
+            max_retries=create_retry([500, 502, 503, 504], notion_methods),
+        ),
+    )
     return session
 
 
-def request_json(session, method, url, headers=None, payload=None, params=None):
+def send_request(
+    session, method, url, headers=None, payload=None, params=None, limiter=None
+):
+    if limiter is not None:
+        return send_limited_request(
+            limiter, session, method, url, headers, payload, params
+        )
+    metrics = get_run_metrics()
+    metrics.mark_request()
     try:
         response = session.request(
             method,
@@ -45,40 +304,91 @@ def request_json(session, method, url, headers=None, payload=None, params=None):
             headers=headers,
             json=payload,
             params=params,
-            timeout=DEFAULT_TIMEOUT_SECONDS,
+            timeout=get_request_timeout(),
         )
     except requests.RequestException as exc:
+        metrics.increment("requests")
+        metrics.increment("request_errors")
         print(f"Request failed for {url}: {exc}")
         return None
+    metrics.record_response(response)
+    return response
 
-    if response.status_code >= 400:
-        print(f"Request failed for {url}: {response.status_code} {response.text}")
-        return None
 
-    if response.content:
-        return response.json()
-    return None
+def parse_retry_after(value):
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
 
 
-def request_status(session, method, url, headers=None, payload=None):
-    try:
-        response = session.request(
-            method,
-            url,
-            headers=headers,
-            json=payload,
-            timeout=DEFAULT_TIMEOUT_SECONDS,
-        )
-    except requests.RequestException as exc:
-        print(f"Request failed for {url}: {exc}")
+def record_limiter_feedback(limiter, response, url):
+    # Returns True when the request was throttled and should be sent again
+    if response is None:
         return False
+    if response.status_code == 429:
+        retry_after = parse_retry_after(response.headers.get("Retry-After"))
+        limiter.record_throttle(retry_after)
+        print(
+            f"Throttled by {url}: retry_after={retry_after}, "
+            f"rps_limit={limiter.rps:.2f}"
+        )
+        return True
+    if response.status_code < 500:
+        limiter.record_success()
+    return False
+
+
+def send_limited_request(
+    limiter, session, method, url, headers=None, payload=None, params=None, retries=None
+):
+    if retries is None:
+        retries = parse_int_env(
+            "NOTION_THROTTLE_RETRIES", DEFAULT_NOTION_THROTTLE_RETRIES, 0
+        )
+    response = None
+    for attempt in range(retries + 1):
+        delay = limiter.reserve()
+        budget = get_deadline_budget()
+        if attempt and budget is not None and delay >= budget:
+            print(f"Not retrying {url}: the throttle wait passes the deadline")
+            break
+        if delay > 0:
+            time.sleep(delay)
+        response = send_request(session, method, url, headers, payload, params)
+        if not record_limiter_feedback(limiter, response, url):
+            break
+    return response
+
 
+def is_response_ok(response, url):
+    if response is None:
+        return False
     if response.status_code >= 400:
         print(f"Request failed for {url}: {response.status_code} {response.text}")
         return False
     return True
 
 
+def request_json(
+    session, method, url, headers=None, payload=None, params=None, limiter=None
+):
+    response = send_request(session, method, url, headers, payload, params, limiter)
+    if not is_response_ok(response, url):
+        return None
+
+    if response.content:
+        if orjson is not None and isinstance(response.content, bytes):
+            return orjson.loads(response.content)
+        return response.json()
+    return None
+
+
+def request_status(session, method, url, headers=None, payload=None, limiter=None):
+    response = send_request(session, method, url, headers, payload, None, limiter)
+    return is_response_ok(response, url)
+
+
 def get_required_env(name):
     value = os.environ.get(name)
     if not value:
@@ -86,96 +396,626 @@ def get_required_env(name):
     return value
 
 
+def read_json_file(path):
+    try:
+        if orjson is not None:
+            with open(path, "rb") as json_file:
+                return orjson.loads(json_file.read())
+        with open(path) as json_file:
+            return json.load(json_file)
+    except (OSError, ValueError):
+        return None
+
+
+def write_json_file(path, data):
+    # Write to a sibling file first so readers never see a partial document
+    temp_path = f"{path}.tmp"
+    try:
+        with open(temp_path, "w") as json_file:
+            json.dump(data, json_file, separators=(",", ":"))
+        os.replace(temp_path, path)
+    except OSError as exc:
+        print(f"Could not write {path}: {exc}")
+        return False
+    return True
+
+
+class RunMetrics:
+    def __init__(self):
+        self._lock = Lock()
+        self.started_at = time.monotonic()
+        self.first_request_at = None
+        self.phases = {}
+        self.counters = {}
+        self.write_latencies_ms = []
+        self.row_log_mode = os.environ.get("ROW_LOG_MODE", "all").lower()
+        self.row_log_sample_rate = parse_float_env(
+            "ROW_LOG_SAMPLE_RATE", DEFAULT_ROW_LOG_SAMPLE_RATE, 0.0
+        )
+
+    @contextmanager
+    def span(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            with self._lock:
+                self.phases[name] = self.phases.get(name, 0) + elapsed
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def record_phase(self, name, seconds):
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0) + seconds
+
+    def mark_request(self):
+        if self.first_request_at is None:
+            with self._lock:
+                if self.first_request_at is None:
+                    self.first_request_at = time.monotonic()
+
+    def observe_write_latency(self, seconds):
+        with self._lock:
+            self.write_latencies_ms.append(seconds * 1000)
+
+    def record_response(self, response):
+        self.increment("requests")
+        content = getattr(response, "content", None)
+        if isinstance(content, bytes):
+            self.increment("response_bytes", len(content))
+        # urllib3 keeps the retries it made for this response in its history
+        retries = getattr(getattr(response, "raw", None), "retries", None)
+        history = getattr(retries, "history", None)
+        if isinstance(history, tuple) and history:
+            self.increment("retries", len(history))
+        if response.status_code == 429:
+            self.increment("throttled_429")
+
+    def should_log_row(self, key):
+        if self.row_log_mode == "summary":
+            return False
+        if self.row_log_mode == "sample":
+            bucket = zlib.crc32(str(key).encode()) % 10000
+            return bucket < self.row_log_sample_rate * 10000
+        return True
+
+    def write_latency_histogram(self):
+        counts = [0] * (len(WRITE_LATENCY_BUCKETS_MS) + 1)
+        for latency in self.write_latencies_ms:
+            counts[bisect.bisect_left(WRITE_LATENCY_BUCKETS_MS, latency)] += 1
+        labels = [f"le_{bucket}ms" for bucket in WRITE_LATENCY_BUCKETS_MS]
+        labels.append(f"gt_{WRITE_LATENCY_BUCKETS_MS[-1]}ms")
+        return dict(zip(labels, counts))
+
+    def to_emf(self, namespace, dimensions):
+        # CloudWatch Embedded Metric Format: one JSON object per run
+        record = dict(dimensions)
+        metrics = []
+        with self._lock:
+            phases = dict(self.phases)
+            counters = dict(self.counters)
+            latencies = sorted(self.write_latencies_ms)
+        phases["total"] = time.monotonic() - self.started_at
+        for name, seconds in sorted(phases.items()):
+            record[f"phase.{name}"] = round(seconds * 1000, 1)
+            metrics.append({"Name": f"phase.{name}", "Unit": "Milliseconds"})
+        for name, value in sorted(counters.items()):
+            record[name] = value
+            unit = "Bytes" if name.endswith("bytes") else "Count"
+            metrics.append({"Name": name, "Unit": unit})
+        if latencies:
+            for label, quantile in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99)):
+                rank = max(0, int(math.ceil(quantile * len(latencies))) - 1)
+                record[f"notion_write_latency_{label}"] = round(latencies[rank], 1)
+                metrics.append(
+                    {"Name": f"notion_write_latency_{label}", "Unit": "Milliseconds"}
+                )
+            record["notion_write_latency_histogram"] = self.write_latency_histogram()
+        record["_aws"] = {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [
+                {
+                    "Namespace": namespace,
+                    "Dimensions": [sorted(dimensions)],
+                    "Metrics": metrics,
+                }
+            ],
+        }
+        return record
+
+
+def get_run_metrics():
+    global RUN_METRICS
+    if RUN_METRICS is None:
+        RUN_METRICS = RunMetrics()
+    return RUN_METRICS
+
+
+def start_run_metrics():
+    global RUN_METRICS
+    RUN_METRICS = RunMetrics()
+    return RUN_METRICS
+
+
+def metrics_span(name):
+    return get_run_metrics().span(name)
+
+
+def log_row(message, key):
+    # Per-row output follows ROW_LOG_MODE: all, sample or summary
+    if get_run_metrics().should_log_row(key):
+        print(message)
+
+
+def report_startup(metrics):
+    # Cold starts only: how long the module import, the runtime setup and the
+    # wait for the first outbound request took, against COLD_START_BUDGET_MS
+    timings = {
+        "import": STARTUP_TIMINGS.get("import", 0.0),
+        "init": STARTUP_TIMINGS.get("init", 0.0),
+    }
+    if metrics.first_request_at is not None:
+        timings["first_request"] = metrics.first_request_at - metrics.started_at
+    for name, seconds in timings.items():
+        metrics.record_phase(f"startup.{name}", seconds)
+    total_ms = sum(timings.values()) * 1000
+    budget_ms = parse_float_env(
+        "COLD_START_BUDGET_MS", DEFAULT_COLD_START_BUDGET_MS, 0.0
+    )
+    print(
+        "Startup: "
+        + ", ".join(
+            f"{name}={round(seconds * 1000, 1)}ms" for name, seconds in timings.items()
+        )
+        + f", total={round(total_ms, 1)}ms, budget={round(budget_ms, 1)}ms"
+    )
+    if total_ms > budget_ms:
+        print("Warning: Cold start exceeded COLD_START_BUDGET_MS")
+        metrics.increment("cold_start_over_budget")
+    return total_ms
+
+
+def emit_run_metrics(metrics, dimensions):
+    if os.environ.get("EMIT_METRICS", "true").lower() in ("0", "false", "no"):
+        return None
+    namespace = os.environ.get("METRICS_NAMESPACE", DEFAULT_METRICS_NAMESPACE)
+    record = metrics.to_emf(namespace, dimensions)
+    print(json.dumps(record, separators=(",", ":")))
+    return record
+
+
 def fetch_crypto_prices(unique_coins, session):
+    providers = build_price_providers("crypto")
+    return resolve_prices("crypto", providers, sorted(unique_coins), session)
+
+
+def fetch_coingecko_prices(unique_coins, session, should_stop=None):
+    # None when CoinGecko could not be reached
+    quotes = fetch_crypto_quotes(unique_coins, session, ["usd"], should_stop)
+    if quotes is None:
+        return None
+    coin_prices = {}
+    for coin, quote in quotes.items():
+        usd_price = quote.get("usd")
+        if usd_price is not None:
+            coin_prices[coin] = usd_price
+        else:
+            print(f"Warning: USD price not available for {coin}")
+    return coin_prices
+
+
+def fetch_crypto_quotes(unique_coins, session, vs_currencies, should_stop=None):
     if not unique_coins:
         return {}
-    coins_list_url = "https://api.coingecko.com/api/v3/coins/list"
-    print("Retrieving coins list from CoinGecko")
-    coins_list = get_cached_coins_list(session, coins_list_url)
-    if not coins_list:
+    overrides = load_symbol_overrides()
+    if all(coin.lower() in overrides for coin in unique_coins):
+        # Every coin is pinned to an id, so the coins list is not needed
+        symbol_index = {}
+    else:
+        print("Retrieving coins list from CoinGecko")
+        symbol_index = get_cached_symbol_index(
+            session, get_coingecko_url("coins/list")
+        )
+        if not symbol_index:
+            return None
+        print("Coins list retrieved successfully")
+
+    symbol_to_id = create_symbol_to_id_mapping(symbol_index, unique_coins, overrides)
+    coin_ids = sorted(
+        set(
+            symbol_to_id[coin.lower()]
+            for coin in unique_coins
+            if symbol_to_id.get(coin.lower())
+        )
+    )
+    if not coin_ids:
         return {}
-    print("Coins list retrieved successfully")
 
-    symbol_to_id = create_symbol_to_id_mapping(coins_list, unique_coins)
+    print("Retrieving prices from CoinGecko")
+    price_data = fetch_coingecko_price_batches(
+        coin_ids, vs_currencies, session, should_stop
+    )
+    if price_data is None:
+        print("Failed to retrieve prices from CoinGecko")
+        return None
+    print("Prices retrieved successfully from CoinGecko")
 
-    coin_prices = {}
-    coin_ids = [
-        symbol_to_id.get(coin.lower())
-        for coin in unique_coins
-        if symbol_to_id.get(coin.lower())
-    ]
-    if coin_ids:
-        crypto_price_url = f"https://api.coingecko.com/api/v3/simple/price?ids={','.join(coin_ids)}&vs_currencies=usd"
-        print("Retrieving prices from CoinGecko")
-        price_data = request_json(session, "GET", crypto_price_url)
-        if not price_data:
-            print("Failed to retrieve prices from CoinGecko")
-            return {}
-        print("Prices retrieved successfully from CoinGecko")
-        for coin in unique_coins:
-            coin_id = symbol_to_id.get(coin.lower())
-            if coin_id and coin_id.lower() in price_data:
-                usd_price = price_data[coin_id.lower()].get("usd")
-                if usd_price is not None:
-                    coin_prices[coin] = usd_price
-                else:
-                    print(f"Warning: USD price not available for {coin}")
+    coin_quotes = {}
+    for coin in unique_coins:
+        coin_id = symbol_to_id.get(coin.lower())
+        if coin_id and coin_id.lower() in price_data:
+            coin_quotes[coin] = price_data[coin_id.lower()]
+    return coin_quotes
+
+
+def get_coingecko_url(path):
+    return f"{COINGECKO_API_URL}api/v3/{path}"
+
+
+def build_coingecko_price_url(coin_ids, vs_currencies):
+    return (
+        f"{get_coingecko_url('simple/price')}?ids={','.join(coin_ids)}"
+        f"&vs_currencies={','.join(vs_currencies)}"
+    )
+
+
+def chunk_coin_ids(coin_ids, vs_currencies, batch_size, max_url_length):
+    # Each chunk's URL stays under max_url_length, but a chunk always holds at
+    # least one id
+    ids_budget = max_url_length - len(build_coingecko_price_url([], vs_currencies))
+    chunks = []
+    current = []
+    current_length = 0
+    for coin_id in coin_ids:
+        added_length = len(coin_id) + (1 if current else 0)
+        if current and (
+            len(current) >= batch_size or current_length + added_length > ids_budget
+        ):
+            chunks.append(current)
+            current = []
+            current_length = 0
+            added_length = len(coin_id)
+        current.append(coin_id)
+        current_length += added_length
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def fetch_coingecko_price_batches(coin_ids, vs_currencies, session, should_stop=None):
+    batch_size = parse_int_env(
+        "COINGECKO_PRICE_BATCH_SIZE", DEFAULT_COINGECKO_PRICE_BATCH_SIZE, 1
+    )
+    max_url_length = parse_int_env(
+        "COINGECKO_PRICE_MAX_URL_LENGTH", DEFAULT_COINGECKO_PRICE_MAX_URL_LENGTH, 256
+    )
+    max_workers = parse_int_env(
+        "COINGECKO_PRICE_MAX_WORKERS", DEFAULT_COINGECKO_PRICE_MAX_WORKERS, 1
+    )
+    rps_limit = parse_float_env(
+        "COINGECKO_RPS_LIMIT", DEFAULT_COINGECKO_RPS_LIMIT, 0.01
+    )
+    chunks = chunk_coin_ids(coin_ids, vs_currencies, batch_size, max_url_length)
+    limiter = RateLimiter(rps_limit, 1)
+    get_run_metrics().increment("coingecko_price_batches", len(chunks))
+
+    def worker(chunk):
+        limiter.wait_for_slot()
+        if should_stop is not None and should_stop():
+            return chunk, None
+        url = build_coingecko_price_url(chunk, vs_currencies)
+        return chunk, request_json(session, "GET", url)
+
+    price_data = {}
+    failed_ids = []
+    failed_batches = 0
+    with metrics_span("crypto_price_fetch"), ThreadPoolExecutor(
+        max_workers=min(max_workers, len(chunks))
+    ) as executor:
+        futures = [executor.submit(worker, chunk) for chunk in chunks]
+        for future in as_completed(futures):
+            chunk, data = future.result()
+            if not isinstance(data, dict):
+                failed_batches += 1
+                failed_ids.extend(chunk)
+                continue
+            price_data.update(data)
+    if failed_ids:
+        print(
+            f"Failed to retrieve CoinGecko prices for {len(failed_ids)} coins: "
+            + ",".join(sorted(failed_ids))
+        )
+    print(f"CoinGecko price batches: count={len(chunks)}, failed={failed_batches}")
+    if chunks and failed_batches == len(chunks):
+        return None
+    return price_data
+
+
+def build_symbol_index(coins_list):
+    index = {}
+    for coin in coins_list:
+        symbol = coin.get("symbol")
+        coin_id = coin.get("id")
+        if symbol and coin_id:
+            index.setdefault(symbol.lower(), []).append(coin_id)
+    return index
+
+
+def load_symbol_index_file(path):
+    cache = read_json_file(path)
+    if not isinstance(cache, dict) or not isinstance(cache.get("index"), dict):
+        return None
+    if not isinstance(cache.get("fetched_at"), (int, float)):
+        return None
+    return cache
+
+
+def refresh_symbol_index(session, coins_list_url, cache=None):
+    # Revalidate with the stored ETag so an unchanged list costs a 304 only
+    request_headers = None
+    if cache and cache.get("etag"):
+        request_headers = {"If-None-Match": cache["etag"]}
+    get_run_metrics().mark_request()
+    try:
+        response = session.request(
+            "GET",
+            coins_list_url,
+            headers=request_headers,
+            timeout=get_request_timeout(),
+        )
+    except requests.RequestException as exc:
+        print(f"Request failed for {coins_list_url}: {exc}")
+        return None
+
+    if response.status_code == 304 and cache:
+        print("CoinGecko coins list not modified")
+        return dict(cache, fetched_at=time.time())
+    if response.status_code >= 400:
+        print(
+            f"Request failed for {coins_list_url}: "
+            f"{response.status_code} {response.text}"
+        )
+        return None
+    try:
+        coins_list = response.json()
+    except ValueError:
+        print(f"Invalid JSON received from {coins_list_url}")
+        return None
+    if not isinstance(coins_list, list) or not coins_list:
+        return None
+    return {
+        "index": build_symbol_index(coins_list),
+        "fetched_at": time.time(),
+        "etag": response.headers.get("ETag"),
+    }
 
-    return coin_prices
 
+def get_cached_symbol_index(session, coins_list_url):
+    with metrics_span("coin_list"):
+        return load_symbol_index(session, coins_list_url)
 
-def get_cached_coins_list(session, coins_list_url):
+
+def load_symbol_index(session, coins_list_url):
     global COINGECKO_SYMBOL_CACHE
-    if COINGECKO_SYMBOL_CACHE is None:
-        COINGECKO_SYMBOL_CACHE = request_json(session, "GET", coins_list_url)
-    return COINGECKO_SYMBOL_CACHE
+    path = os.environ.get(
+        "COINGECKO_SYMBOL_CACHE_PATH", DEFAULT_COINGECKO_SYMBOL_CACHE_PATH
+    )
+    ttl = parse_int_env(
+        "COINGECKO_SYMBOL_CACHE_TTL_SECONDS",
+        DEFAULT_COINGECKO_SYMBOL_CACHE_TTL_SECONDS,
+        0,
+    )
+    cache = COINGECKO_SYMBOL_CACHE or load_symbol_index_file(path)
+    if cache and time.time() - cache["fetched_at"] < ttl:
+        COINGECKO_SYMBOL_CACHE = cache
+        return cache["index"]
+
+    refreshed = refresh_symbol_index(session, coins_list_url, cache)
+    if refreshed:
+        COINGECKO_SYMBOL_CACHE = refreshed
+        write_json_file(path, refreshed)
+        return refreshed["index"]
+    if cache:
+        print("Using stale CoinGecko symbol index")
+        COINGECKO_SYMBOL_CACHE = cache
+        return cache["index"]
+    return None
+
+
+def parse_symbol_overrides(raw, source):
+    try:
+        overrides = json.loads(raw)
+    except ValueError:
+        print(f"Invalid symbol overrides in {source}. Ignoring.")
+        return {}
+    if not isinstance(overrides, dict):
+        print(f"Symbol overrides in {source} must be a JSON object. Ignoring.")
+        return {}
+    return {
+        str(symbol).lower(): coin_id
+        for symbol, coin_id in overrides.items()
+        if isinstance(coin_id, str) and coin_id
+    }
 
 
-def create_symbol_to_id_mapping(coins_list, unique_coins):
+def load_symbol_overrides():
+    overrides = dict(DEFAULT_COINGECKO_SYMBOL_OVERRIDES)
+    path = os.environ.get("COINGECKO_SYMBOL_OVERRIDES_PATH")
+    if path:
+        try:
+            with open(path) as overrides_file:
+                overrides.update(parse_symbol_overrides(overrides_file.read(), path))
+        except OSError as exc:
+            print(f"Could not read symbol overrides from {path}: {exc}")
+    raw = os.environ.get("COINGECKO_SYMBOL_OVERRIDES")
+    if raw:
+        overrides.update(parse_symbol_overrides(raw, "COINGECKO_SYMBOL_OVERRIDES"))
+    return overrides
+
+
+def create_symbol_to_id_mapping(symbol_index, unique_coins, overrides=None):
+    if overrides is None:
+        overrides = load_symbol_overrides()
     symbol_to_id = {}
-    for coin in coins_list:
-        symbol = coin["symbol"]
-        coin_id = coin["id"]
-        if symbol.upper() in unique_coins and not (
-            (symbol == "dai" and coin_id != "dai")
-            or (symbol == "mana" and coin_id != "decentraland")
-            or (symbol == "eth" and coin_id != "ethereum")
-            or (symbol == "btc" and coin_id != "bitcoin")
-            or (symbol == "usdt" and coin_id != "tether")
-            or (symbol == "bnb" and coin_id != "binancecoin")
-        ):
-            symbol_to_id[symbol] = coin_id
+    for coin in sorted(unique_coins):
+        symbol = coin.lower()
+        if symbol in overrides:
+            symbol_to_id[symbol] = overrides[symbol]
+            continue
+        candidates = symbol_index.get(symbol)
+        if not candidates:
+            print(f"Warning: No CoinGecko id found for {coin}")
+            continue
+        candidates = sorted(candidates)
+        # The coins list is ordered by id and the last match used to win
+        symbol_to_id[symbol] = candidates[-1]
+        if len(candidates) > 1:
+            print(
+                f"Warning: Ambiguous CoinGecko symbol {coin}: "
+                f"candidates={','.join(candidates)}, using {candidates[-1]}. "
+                "Add it to COINGECKO_SYMBOL_OVERRIDES to pin the id."
+            )
     return symbol_to_id
 
 
-def fetch_stock_prices(unique_stocks, alpha_vantage_api_key, session):
-    stock_prices = {"USD": 1.00}  # Initialize with a value for USD
-    for stock_symbol in unique_stocks:
-        if stock_symbol != "USD":
-            price = get_stock_price(stock_symbol, alpha_vantage_api_key, session)
+def load_stock_quote_cache(path, today):
+    cache = read_json_file(path)
+    if not isinstance(cache, dict):
+        cache = {}
+    quotes = cache.get("quotes")
+    if not isinstance(quotes, dict):
+        quotes = {}
+    quota_used = cache.get("quota_used", 0)
+    if cache.get("quota_date") != today or not isinstance(quota_used, int):
+        quota_used = 0
+    return {"quota_date": today, "quota_used": quota_used, "quotes": quotes}
+
+
+def get_run_allowance(quota_remaining, utc_hour):
+    # Spread what is left of today's budget evenly over the remaining hourly runs
+    if quota_remaining <= 0:
+        return 0
+    runs_left_today = 24 - utc_hour
+    return int(math.ceil(quota_remaining / float(runs_left_today)))
+
+
+def plan_stock_refreshes(stock_values, quotes, now_ts, allowance, min_age_seconds):
+    # Staleness weighted by holding value; symbols never quoted go first
+    candidates = []
+    for symbol, value in stock_values.items():
+        quote = quotes.get(symbol)
+        if quote is None:
+            age = float("inf")
+        else:
+            age = now_ts - quote["fetched_at"]
+            if age < min_age_seconds:
+                continue
+        candidates.append((age * max(value, 1.0), value, symbol))
+    candidates.sort(reverse=True)
+    return [symbol for _, _, symbol in candidates[:allowance]]
+
+
+def fetch_stock_prices(stock_values, alpha_vantage_api_key, session, now=None):
+    now = now or datetime.datetime.utcnow()
+    path = os.environ.get("STOCK_QUOTE_CACHE_PATH", DEFAULT_STOCK_QUOTE_CACHE_PATH)
+    daily_quota = parse_int_env(
+        "ALPHA_VANTAGE_DAILY_QUOTA", DEFAULT_ALPHA_VANTAGE_DAILY_QUOTA, 0
+    )
+    min_age_seconds = parse_int_env(
+        "STOCK_QUOTE_MIN_AGE_SECONDS", DEFAULT_STOCK_QUOTE_MIN_AGE_SECONDS, 0
+    )
+    request_interval = parse_float_env(
+        "ALPHA_VANTAGE_REQUEST_INTERVAL_SECONDS",
+        DEFAULT_ALPHA_VANTAGE_REQUEST_INTERVAL_SECONDS,
+        0.0,
+    )
+    cache = load_stock_quote_cache(path, now.date().isoformat())
+    quotes = cache["quotes"]
+    now_ts = (now - datetime.datetime(1970, 1, 1)).total_seconds()
+
+    held = {symbol: value for symbol, value in stock_values.items() if symbol != "USD"}
+    providers = build_price_providers("stock", alpha_vantage_api_key)
+    alpha_vantage = next(
+        (p for p in providers if isinstance(p, AlphaVantageProvider)), None
+    )
+    # The daily quota only limits AlphaVantage requests; other providers may
+    # refresh every stale holding
+    allowance = get_run_allowance(daily_quota - cache["quota_used"], now.hour)
+    if alpha_vantage is not None and not allowance:
+        providers.remove(alpha_vantage)
+    to_refresh = plan_stock_refreshes(
+        held,
+        quotes,
+        now_ts,
+        len(held) if any(p is not alpha_vantage for p in providers) else allowance,
+        min_age_seconds,
+    )
+    print(
+        f"Stock quote budget: used={cache['quota_used']}/{daily_quota}, "
+        f"allowance={allowance}, refreshing={len(to_refresh)}"
+    )
+
+    with metrics_span("stock_price_fetch"):
+        for stock_symbol in to_refresh:
+            if not providers:
+                break
+            if not has_time_for_work():
+                print("Stopping stock quote refreshes to meet the deadline")
+                break
+            if alpha_vantage in providers and alpha_vantage.requests:
+                # AlphaVantage free tier: 1 request per second
+                time.sleep(request_interval)
+            price = resolve_prices("stock", providers, [stock_symbol], session).get(
+                stock_symbol
+            )
+            if alpha_vantage in providers and (
+                alpha_vantage.rate_limited or alpha_vantage.requests >= allowance
+            ):
+                # Out of AlphaVantage quota for this run (or, when it says so,
+                # for the day); any other stock provider carries on
+                providers.remove(alpha_vantage)
             if price is not None:
-                print(
+                log_row(
                     "Successfully fetched price for stock "
                     + stock_symbol
                     + ". New price: "
-                    + str(price)
+                    + str(price),
+                    stock_symbol,
                 )
-                stock_prices[stock_symbol] = price
-            time.sleep(1)  # Rate limit: 1 request per second for AlphaVantage free tier
+                quotes[stock_symbol] = {"price": price, "fetched_at": now_ts}
+    if alpha_vantage is not None:
+        cache["quota_used"] += alpha_vantage.requests
+        if alpha_vantage.rate_limited:
+            cache["quota_used"] = max(cache["quota_used"], daily_quota)
+    get_run_metrics().increment("stock_quotes_refreshed", len(to_refresh))
+    write_json_file(path, cache)
+
+    stock_prices = {"USD": 1.00}  # Initialize with a value for USD
+    for stock_symbol in stock_values:
+        if stock_symbol in quotes:
+            stock_prices[stock_symbol] = quotes[stock_symbol]["price"]
     return stock_prices
 
 
-def get_stock_price(stock_symbol, alpha_vantage_api_key, session):
+def request_stock_quote(stock_symbol, alpha_vantage_api_key, session):
     if stock_symbol == "CSPX":
         stock_symbol = "CSPX.LON"  # Adjust the symbol for CSPX
     alpha_vantage_url = build_url(stock_symbol, alpha_vantage_api_key)
-    print("Fetching stock price for " + stock_symbol)
-    data = request_json(session, "GET", alpha_vantage_url)
-    return parse_data(data)
+    log_row("Fetching stock price for " + stock_symbol, stock_symbol)
+    return request_json(session, "GET", alpha_vantage_url)
+
+
+def get_stock_price(stock_symbol, alpha_vantage_api_key, session):
+    return parse_data(
+        request_stock_quote(stock_symbol, alpha_vantage_api_key, session)
+    )
 
 
 def build_url(stock_symbol, alpha_vantage_api_key):
-    return f"https://www.alphavantage.co/query?apikey={alpha_vantage_api_key}&function=GLOBAL_QUOTE&symbol={stock_symbol}"
+    return f"{ALPHA_VANTAGE_API_URL}query?apikey={alpha_vantage_api_key}&function=GLOBAL_QUOTE&symbol={stock_symbol}"
 
 
 def parse_data(data):
@@ -196,9 +1036,328 @@ def parse_data(data):
     return None
 
 
-def get_stock_amount(result):
-    amount = result.get("properties", {}).get("Amount", {}).get("number")
-    return amount if isinstance(amount, (int, float)) else 0
+# A source of prices for one asset class. fetch() returns {symbol: price} for
+# the symbols it could price (empty when it knows none of them), or None when
+# its requests failed.
+class PriceProvider:
+    name = None
+    kind = None
+
+    def __init__(self):
+        # Set when the provider reports its quota is used up for the day
+        self.rate_limited = False
+        # Set when another provider already answered; fetch() should stop early
+        self.cancelled = False
+
+    def fetch(self, symbols, session):
+        raise NotImplementedError
+
+
+class CoinGeckoProvider(PriceProvider):
+    name = "coingecko"
+    kind = "crypto"
+
+    def fetch(self, symbols, session):
+        return fetch_coingecko_prices(
+            symbols, session, should_stop=lambda: self.cancelled
+        )
+
+
+class CoinbaseProvider(PriceProvider):
+    # Keyless: a single request returns USD exchange rates for every listed coin
+    name = "coinbase"
+    kind = "crypto"
+
+    def fetch(self, symbols, session):
+        data = request_json(
+            session,
+            "GET",
+            f"{COINBASE_API_URL}v2/exchange-rates",
+            params={"currency": "USD"},
+        )
+        rates = ((data or {}).get("data") or {}).get("rates")
+        if not isinstance(rates, dict):
+            return None
+        prices = {}
+        for symbol in symbols:
+            try:
+                rate = float(rates.get(symbol.upper()))
+            except (TypeError, ValueError):
+                continue
+            if rate > 0:
+                prices[symbol] = 1.0 / rate
+        return prices
+
+
+class AlphaVantageProvider(PriceProvider):
+    name = "alphavantage"
+    kind = "stock"
+
+    def __init__(self, api_key):
+        super().__init__()
+        self.api_key = api_key
+        # Requests made so far; each one uses up daily quota
+        self.requests = 0
+
+    def fetch(self, symbols, session):
+        prices = {}
+        failed = False
+        for symbol in symbols:
+            if self.cancelled:
+                break
+            self.requests += 1
+            data = request_stock_quote(symbol, self.api_key, session)
+            if data is None:
+                failed = True
+                continue
+            price = parse_data(data)
+            if INFO_LITERAL in data:
+                self.rate_limited = True
+                break
+            if price is not None:
+                prices[symbol] = price
+        if (failed or self.rate_limited) and not prices:
+            return None
+        return prices
+
+
+class FinnhubProvider(PriceProvider):
+    name = "finnhub"
+    kind = "stock"
+
+    def __init__(self, api_key):
+        super().__init__()
+        self.api_key = api_key
+
+    def fetch(self, symbols, session):
+        prices = {}
+        failed = False
+        for symbol in symbols:
+            if self.cancelled:
+                break
+            data = request_json(
+                session,
+                "GET",
+                f"{FINNHUB_API_URL}api/v1/quote",
+                params={"symbol": symbol, "token": self.api_key},
+            )
+            if not isinstance(data, dict):
+                failed = True
+                continue
+            price = data.get("c")
+            # Finnhub answers unknown symbols with a zero quote
+            if isinstance(price, (int, float)) and price > 0:
+                prices[symbol] = float(price)
+        return None if failed and not prices else prices
+
+
+def build_price_providers(kind, alpha_vantage_api_key=None):
+    # PRICE_PROVIDERS_CRYPTO / PRICE_PROVIDERS_STOCK: comma separated names.
+    # Providers that need a key are left out when it is not set.
+    names = os.environ.get(
+        f"PRICE_PROVIDERS_{kind.upper()}", DEFAULT_PRICE_PROVIDERS[kind]
+    )
+    providers = []
+    for name in (name.strip().lower() for name in names.split(",")):
+        if kind == "crypto" and name == "coingecko":
+            providers.append(CoinGeckoProvider())
+        elif kind == "crypto" and name == "coinbase":
+            providers.append(CoinbaseProvider())
+        elif kind == "stock" and name == "alphavantage":
+            providers.append(AlphaVantageProvider(alpha_vantage_api_key))
+        elif kind == "stock" and name == "finnhub":
+            if os.environ.get("FINNHUB_API_KEY"):
+                providers.append(FinnhubProvider(os.environ["FINNHUB_API_KEY"]))
+            else:
+                print("Skipping finnhub price provider: FINNHUB_API_KEY is not set")
+        elif name:
+            print(f"Unknown {kind} price provider: {name}")
+    return providers
+
+
+def get_provider_stats():
+    # Loaded from PRICE_PROVIDER_STATS_PATH on a cold start, if set
+    global PROVIDER_STATS
+    with PROVIDER_STATS_LOCK:
+        if PROVIDER_STATS is None:
+            path = os.environ.get("PRICE_PROVIDER_STATS_PATH")
+            cached = read_json_file(path) if path else None
+            PROVIDER_STATS = cached if isinstance(cached, dict) else {}
+        return PROVIDER_STATS
+
+
+def record_provider_result(name, seconds, ok, now=None):
+    stats = get_provider_stats()
+    with PROVIDER_STATS_LOCK:
+        entry = stats.setdefault(
+            name, {"latency": None, "ok": 0, "fail": 0, "consecutive_failures": 0}
+        )
+        if entry["latency"] is None:
+            entry["latency"] = seconds
+        else:
+            entry["latency"] += PROVIDER_LATENCY_SMOOTHING * (
+                seconds - entry["latency"]
+            )
+        if ok:
+            entry["ok"] += 1
+            entry["consecutive_failures"] = 0
+        else:
+            entry["fail"] += 1
+            entry["consecutive_failures"] += 1
+            entry["failed_at"] = now or time.time()
+
+
+def save_provider_stats():
+    path = os.environ.get("PRICE_PROVIDER_STATS_PATH")
+    if path:
+        stats = get_provider_stats()
+        with PROVIDER_STATS_LOCK:
+            write_json_file(path, stats)
+
+
+def is_provider_healthy(name, now=None):
+    entry = get_provider_stats().get(name)
+    if not entry or entry["consecutive_failures"] < PROVIDER_MAX_CONSECUTIVE_FAILURES:
+        return True
+    # Failing providers get another chance once the cooldown is over
+    return (now or time.time()) - entry.get("failed_at", 0) > PROVIDER_COOLDOWN_SECONDS
+
+
+def rank_providers(providers, now=None):
+    # Healthy before unhealthy, then fastest first. Providers without a
+    # latency yet keep their configured order behind the measured ones.
+    stats = get_provider_stats()
+
+    def key(item):
+        position, provider = item
+        latency = (stats.get(provider.name) or {}).get("latency")
+        return (
+            not is_provider_healthy(provider.name, now),
+            float("inf") if latency is None else latency,
+            position,
+        )
+
+    return [provider for _, provider in sorted(enumerate(providers), key=key)]
+
+
+def run_price_provider(provider, symbols, session):
+    start = time.monotonic()
+    try:
+        prices = provider.fetch(symbols, session)
+    except Exception as exc:
+        # A bad response body must not stop the other providers from answering
+        print(f"Price provider {provider.name} failed: {exc!r}")
+        prices = None
+    # An empty answer (unknown tickers) or a cancelled loser is still healthy
+    record_provider_result(
+        provider.name,
+        time.monotonic() - start,
+        prices is not None or provider.cancelled,
+    )
+    return prices
+
+
+def resolve_prices(kind, providers, symbols, session):
+    # Asks the fastest healthy provider first. If it has not answered within
+    # PRICE_HEDGE_DELAY_SECONDS, or answers without some symbols, the next
+    # provider is asked for what is still missing. The first price per
+    # symbol wins.
+    if not symbols or not providers:
+        return {}
+    queue = rank_providers(providers)
+    for provider in queue:
+        provider.cancelled = False
+    if len(queue) == 1:
+        prices = run_price_provider(queue[0], symbols, session) or {}
+        save_provider_stats()
+        return prices
+
+    hedge_delay = parse_float_env(
+        "PRICE_HEDGE_DELAY_SECONDS", DEFAULT_PRICE_HEDGE_DELAY_SECONDS, 0.0
+    )
+    metrics = get_run_metrics()
+    prices = {}
+    pending = {}
+    executor = ThreadPoolExecutor(max_workers=len(queue))
+
+    def launch():
+        provider = queue.pop(0)
+        missing = [symbol for symbol in symbols if symbol not in prices]
+        pending[executor.submit(run_price_provider, provider, missing, session)] = (
+            provider
+        )
+
+    try:
+        launch()
+        while pending and len(prices) < len(symbols):
+            if not has_time_for_work():
+                print(f"Stopping {kind} price resolution to meet the deadline")
+                break
+            timeout = cap_to_deadline(hedge_delay) if queue else get_deadline_budget()
+            done, _ = wait(list(pending), timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                if queue:
+                    print(
+                        f"Hedging {kind} prices: no answer within {hedge_delay}s, "
+                        f"asking {queue[0].name}"
+                    )
+                    metrics.increment("price_hedges")
+                    launch()
+                continue
+            for future in done:
+                provider = pending.pop(future)
+                found = 0
+                for symbol, price in (future.result() or {}).items():
+                    if symbol not in prices:
+                        prices[symbol] = price
+                        found += 1
+                if found:
+                    metrics.increment(f"prices_from.{provider.name}", found)
+            if not pending and queue and len(prices) < len(symbols):
+                launch()
+    finally:
+        # Losing providers stop before their next request; the one in flight
+        # gets at most a request timeout so no thread outlives the invocation
+        for provider in pending.values():
+            provider.cancelled = True
+        if pending:
+            _, running = wait(
+                list(pending), timeout=cap_to_deadline(get_request_timeout())
+            )
+            if running:
+                print(
+                    f"{len(running)} {kind} price providers still running "
+                    "at the deadline"
+                )
+        executor.shutdown(wait=False)
+    save_provider_stats()
+    return prices
+
+
+def get_stock_amount(holding):
+    return holding.amount if holding.amount is not None else 0
+
+
+def filter_stock_results(stock_results):
+    filtered_stock_results = [
+        holding
+        for holding in stock_results
+        if get_stock_amount(holding) > 0 and holding.symbol not in (None, "USD")
+    ]
+    filtered_out_count = len(stock_results) - len(filtered_stock_results)
+    if filtered_out_count:
+        print(
+            f"Skipping {filtered_out_count} stock entries with Amount <= 0 or USD currency"
+        )
+    return filtered_stock_results
+
+
+def get_stock_values(stock_results):
+    stock_values = {}
+    for holding in stock_results:
+        value = get_stock_amount(holding) * (holding.price or 0)
+        stock_values[holding.symbol] = stock_values.get(holding.symbol, 0) + value
+    return stock_values
 
 
 def get_select_name(result, property_name):
@@ -210,11 +1369,83 @@ def get_select_name(result, property_name):
     return name if isinstance(name, str) and name else None
 
 
-def parse_int_env(name, default, minimum):
-    value = os.environ.get(name)
-    if value is None:
-        return default
-    try:
+def get_number(property_value):
+    number = (property_value or {}).get("number")
+    if isinstance(number, bool) or not isinstance(number, (int, float)):
+        return None
+    return number
+
+
+# One Notion row, parsed once when its page arrives. The page JSON is dropped
+# right after, so every later stage reads plain attributes and memory grows
+# with the handful of fields below rather than with Notion's nested payload.
+class Holding:
+    __slots__ = (
+        "page_id",
+        "database_id",
+        "symbol",
+        "amount",
+        "price",
+        "total",
+        "last_edited_time",
+        "archived",
+    )
+
+    def __init__(
+        self,
+        page_id,
+        database_id=None,
+        symbol=None,
+        amount=None,
+        price=None,
+        total=None,
+        last_edited_time=None,
+        archived=False,
+    ):
+        self.page_id = page_id
+        self.database_id = database_id
+        self.symbol = symbol
+        self.amount = amount
+        self.price = price
+        self.total = total
+        self.last_edited_time = last_edited_time
+        self.archived = archived
+
+    def __repr__(self):
+        return (
+            f"Holding(page_id={self.page_id!r}, symbol={self.symbol!r}, "
+            f"amount={self.amount!r}, price={self.price!r}, total={self.total!r})"
+        )
+
+
+def parse_holding(result, database_id=None):
+    properties = result.get("properties", {})
+    symbol = None
+    for property_name in HOLDING_SYMBOL_PROPERTIES:
+        if property_name in properties:
+            symbol = get_select_name(result, property_name)
+            break
+    # Crypto and stock rows compute Total with a formula; fiat rows store it
+    total = properties.get("Total") or {}
+    if "formula" in total:
+        total = total["formula"]
+    return Holding(
+        result.get("id"),
+        database_id or result.get("parent", {}).get("database_id"),
+        symbol,
+        get_number(properties.get("Amount")),
+        get_number(properties.get("Price")),
+        get_number(total),
+        result.get("last_edited_time"),
+        bool(result.get("archived") or result.get("in_trash")),
+    )
+
+
+def parse_int_env(name, default, minimum):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    try:
         parsed = int(value)
     except ValueError:
         print(f"Invalid value for {name}: {value}. Using default {default}.")
@@ -244,45 +1475,80 @@ def parse_float_env(name, default, minimum):
     return parsed
 
 
+# AIMD limiter: the rate is halved on every 429 and grows back towards
+# rps_limit while responses stay healthy. Slots are reserved under the lock
+# and callers sleep outside it, so waiting threads do not queue on each other.
 class RateLimiter:
-    def __init__(self, rps_limit, burst):
+    def __init__(self, rps_limit, burst, min_rps_limit=None):
+        self.max_rps = rps_limit
+        self.rps = rps_limit
+        if min_rps_limit is None:
+            min_rps_limit = rps_limit / 10.0
+        self.min_rps = min(min_rps_limit, rps_limit)
+        self.increase_step = rps_limit / 20.0
         self.interval = 1.0 / rps_limit if rps_limit > 0 else 0
         self.burst = max(1, burst)
         self._lock = Lock()
         self._next_allowed_at = time.monotonic()
+        # Throttles before this time answer requests sent at the old rate
+        self._backoff_until = None
 
-    def wait_for_slot(self):
+    def reserve(self):
         if self.interval <= 0:
-            return
+            return 0
         with self._lock:
             now = time.monotonic()
             floor = now - ((self.burst - 1) * self.interval)
             if self._next_allowed_at < floor:
                 self._next_allowed_at = floor
-            delay = self._next_allowed_at - now
-            if delay > 0:
-                time.sleep(delay)
-                now = time.monotonic()
-            self._next_allowed_at = max(self._next_allowed_at, now) + self.interval
+            slot = max(self._next_allowed_at, now)
+            self._next_allowed_at = slot + self.interval
+        return slot - now
+
+    def wait_for_slot(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    def record_success(self):
+        if self.max_rps <= 0:
+            return
+        with self._lock:
+            if self.rps < self.max_rps:
+                self._set_rate(min(self.max_rps, self.rps + self.increase_step))
+
+    def record_throttle(self, retry_after=None):
+        with self._lock:
+            now = time.monotonic()
+            # One cut per backoff window: a burst of 429s is one congestion signal
+            if self.max_rps > 0 and (
+                self._backoff_until is None or now >= self._backoff_until
+            ):
+                self._set_rate(max(self.min_rps, self.rps / 2.0))
+                self._backoff_until = now + max(retry_after or 0, self.interval)
+            if retry_after:
+                self._next_allowed_at = max(self._next_allowed_at, now + retry_after)
+
+    def _set_rate(self, rps):
+        self.rps = rps
+        self.interval = 1.0 / rps
 
 
 def build_update_jobs(type, database_results, prices):
     jobs = []
-    for result in database_results:
-        page_id = result["id"]
-        notion_page_url = f"https://api.notion.com/v1/pages/{page_id}"
-        if type == "crypto":
-            symbol = get_select_name(result, "Coin")
-            if not symbol:
-                print(
-                    "Warning: Skipping crypto entry with missing Coin select. Page id: "
-                    + page_id
-                )
-                continue
-        else:
-            symbol = result["properties"]["Stock"]["select"]["name"]
-        current_price = result["properties"]["Price"]["number"]
-        new_price = prices.get(symbol, 0)
+    for holding in database_results:
+        page_id = holding.page_id
+        notion_page_url = f"{NOTION_API_URL}v1/pages/{page_id}"
+        symbol = holding.symbol
+        if not symbol:
+            log_row(
+                f"Warning: Skipping {type} entry with missing symbol select. "
+                f"Page id: {page_id}",
+                page_id,
+            )
+            continue
+        current_price = holding.price
+        new_price = prices.get(symbol)
         resolved_price = new_price if new_price is not None else current_price
         update_payload = {
             "properties": {
@@ -299,25 +1565,73 @@ def build_update_jobs(type, database_results, prices):
                 "symbol": symbol,
                 "url": notion_page_url,
                 "payload": update_payload,
+                "current_price": current_price,
+                "new_price": float(new_price) if new_price is not None else None,
+                "amount": get_stock_amount(holding),
             }
         )
     return jobs
 
 
-def rate_limited_request_status(limiter, session, method, url, headers=None, payload=None):
-    limiter.wait_for_slot()
+def get_price_tolerances(type):
+    suffix = type.upper()
+    abs_tolerance = parse_float_env(f"PRICE_CHANGE_ABS_TOLERANCE_{suffix}", 0.0, 0.0)
+    rel_tolerance = parse_float_env(f"PRICE_CHANGE_REL_TOLERANCE_{suffix}", 0.0, 0.0)
+    return abs_tolerance, rel_tolerance
+
+
+def is_price_unchanged(current_price, new_price, abs_tolerance=0.0, rel_tolerance=0.0):
+    if new_price is None:
+        return True
+    if not isinstance(current_price, (int, float)):
+        return False
+    threshold = max(abs_tolerance, rel_tolerance * abs(current_price))
+    return abs(new_price - current_price) <= threshold
+
+
+def filter_changed_jobs(jobs, abs_tolerance=0.0, rel_tolerance=0.0):
+    changed = []
+    missing = 0
+    unchanged = 0
+    for job in jobs:
+        if job["new_price"] is None:
+            missing += 1
+        elif is_price_unchanged(
+            job["current_price"], job["new_price"], abs_tolerance, rel_tolerance
+        ):
+            unchanged += 1
+        else:
+            changed.append(job)
+    if missing:
+        print(f"Skipping {missing} Notion updates with no price available")
+    if unchanged:
+        print(f"Skipping {unchanged} Notion updates with unchanged price")
+    return changed, missing + unchanged
+
+
+def rate_limited_request_status(
+    limiter, session, method, url, headers=None, payload=None
+):
     start = time.monotonic()
     success = request_status(
-        session, method, url, headers=headers, payload=payload
+        session, method, url, headers=headers, payload=payload, limiter=limiter
     )
-    return success, round(time.monotonic() - start, 3)
+    elapsed = time.monotonic() - start
+    get_run_metrics().observe_write_latency(elapsed)
+    return success, round(elapsed, 3)
 
 
-def run_notion_updates_concurrently(jobs, headers, session, max_workers, limiter):
-    outcomes = {"ok": 0, "fail": 0}
+def run_notion_updates_concurrently(
+    jobs, headers, session, max_workers, limiter, on_outcome=None
+):
+    # on_outcome(scheduler, job, ok) follows per-symbol progress while this runs
+    scheduler = WriteScheduler(jobs)
 
     def worker(job):
-        print("Updating price in Notion for " + job["symbol"])
+        # None means the job was not sent because the deadline is near
+        if not has_time_for_work():
+            return None
+        log_row("Updating price in Notion for " + job["symbol"], job["page_id"])
         ok, elapsed = rate_limited_request_status(
             limiter,
             session,
@@ -327,28 +1641,335 @@ def run_notion_updates_concurrently(jobs, headers, session, max_workers, limiter
             payload=job["payload"],
         )
         status = "ok" if ok else "fail"
-        print(
+        log_row(
             f"Notion update outcome for {job['symbol']}: {status} "
-            f"(page_id={job['page_id']}, elapsed={elapsed}s)"
+            f"(page_id={job['page_id']}, elapsed={elapsed}s)",
+            job["page_id"],
         )
         return ok
 
     with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = [executor.submit(worker, job) for job in jobs]
-        for future in as_completed(futures):
-            if future.result():
-                outcomes["ok"] += 1
-            else:
-                outcomes["fail"] += 1
+        for job, ok in scheduler.stream(executor, worker, max_workers * 2):
+            if on_outcome is not None:
+                on_outcome(scheduler, job, ok)
+    scheduler.report()
+    outcomes = scheduler.outcomes()
+    if outcomes["deferred"]:
+        print(f"Deferred {outcomes['deferred']} Notion updates to meet the deadline")
     return outcomes
 
 
-def update_notion_prices(type, database_results, prices, headers, session):
-    jobs = build_update_jobs(type, database_results, prices)
-    if not jobs:
-        print("No Notion updates to apply")
-        return
+def get_outcome_key(ok):
+    if ok is None:
+        return "deferred"
+    return "ok" if ok else "fail"
+
+
+# Sends Notion writes one symbol group at a time, biggest value at stake
+# first, and streams each outcome back as it lands. Only a small window of
+# writes is in flight, so the order holds under throttling. Progress per
+# symbol shows how much of the portfolio total is already written.
+class WriteScheduler:
+    def __init__(self, jobs):
+        self.jobs = order_jobs_by_symbol(jobs)
+        self._lock = Lock()
+        self.started_at = time.monotonic()
+        self.progress = {}
+        for job in self.jobs:
+            entry = self.progress.setdefault(
+                job["symbol"],
+                {
+                    "planned": 0,
+                    "ok": 0,
+                    "fail": 0,
+                    "deferred": 0,
+                    "value": 0.0,
+                    "done_at": None,
+                },
+            )
+            entry["planned"] += 1
+            entry["value"] += get_holding_value(job)
+
+    def record(self, job, ok):
+        with self._lock:
+            entry = self.progress[job["symbol"]]
+            entry[get_outcome_key(ok)] += 1
+            finished = entry["ok"] + entry["fail"] + entry["deferred"]
+            if finished < entry["planned"]:
+                return
+            entry["done_at"] = time.monotonic() - self.started_at
+        log_row(
+            f"Notion updates for {job['symbol']} done: ok={entry['ok']}, "
+            f"fail={entry['fail']}, deferred={entry['deferred']}, "
+            f"value={round(entry['value'], 2)}, at={round(entry['done_at'], 3)}s",
+            job["symbol"],
+        )
+
+    def stream(self, executor, worker, window):
+        # Yields (job, ok) as writes complete; ok is None for deferred jobs
+        pending = {}
+        jobs = iter(self.jobs)
+
+        def submit_next():
+            job = next(jobs, None)
+            if job is not None:
+                pending[executor.submit(worker, job)] = job
+
+        for _ in range(max(1, window)):
+            submit_next()
+        while pending:
+            done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+            # done is a set; walk it in submission order so outcomes are stable
+            for future in [future for future in pending if future in done]:
+                job = pending.pop(future)
+                ok = future.result()
+                self.record(job, ok)
+                submit_next()
+                yield job, ok
+
+    def outcomes(self):
+        outcomes = {"ok": 0, "fail": 0, "deferred": 0}
+        with self._lock:
+            for entry in self.progress.values():
+                for key in outcomes:
+                    outcomes[key] += entry[key]
+        return outcomes
+
+    def written_value(self):
+        # Share of the holding value whose symbol has every write sent
+        with self._lock:
+            total = sum(entry["value"] for entry in self.progress.values())
+            written = sum(
+                entry["value"]
+                for entry in self.progress.values()
+                if entry["ok"] == entry["planned"]
+            )
+        return written / total if total else 1.0
+
+    def report(self):
+        elapsed = time.monotonic() - self.started_at
+        outcomes = self.outcomes()
+        sent = outcomes["ok"] + outcomes["fail"]
+        with self._lock:
+            completed = sum(
+                1 for entry in self.progress.values() if entry["ok"] == entry["planned"]
+            )
+        metrics = get_run_metrics()
+        metrics.increment("notion_symbols_planned", len(self.progress))
+        metrics.increment("notion_symbols_completed", completed)
+        print(
+            f"Notion write throughput: sent={sent} in {round(elapsed, 3)}s "
+            f"({round(sent / elapsed, 2) if elapsed else 0}/s), "
+            f"symbols completed={completed}/{len(self.progress)}, "
+            f"value written={round(self.written_value() * 100, 1)}%"
+        )
+
+
+# Durable queue of Notion price writes, so failed or unsent writes survive the
+# invocation. Each run replaces the jobs for the rows it planned, sends what is
+# due in queue order and moves retryable failures to the back with a backoff.
+# Claimed jobs are leased, so an overlapping invocation skips them.
+class NotionJobQueue:
+    def __init__(self, path):
+        # Imported here so runs without the queue do not pay for it
+        import sqlite3
+
+        self.connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS notion_jobs ("
+            "page_id TEXT PRIMARY KEY, scope TEXT NOT NULL, symbol TEXT, "
+            "url TEXT NOT NULL, payload TEXT NOT NULL, seq INTEGER NOT NULL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, "
+            "available_at REAL NOT NULL DEFAULT 0, "
+            "leased_until REAL NOT NULL DEFAULT 0, last_error TEXT)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS notion_jobs_scope_seq "
+            "ON notion_jobs (scope, seq)"
+        )
+
+    def close(self):
+        self.connection.close()
+
+    def _next_seq(self):
+        row = self.connection.execute("SELECT MAX(seq) FROM notion_jobs").fetchone()
+        return (row[0] or 0) + 1
+
+    def sync(self, scope, jobs, seen_page_ids, now):
+        # The fresh plan wins for every row read this run: pages that no
+        # longer need a write are dropped, the others get the new payload
+        planned = {job["page_id"] for job in jobs}
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            self.connection.executemany(
+                "DELETE FROM notion_jobs "
+                "WHERE page_id = ? AND scope = ? AND leased_until <= ?",
+                [
+                    (page_id, scope, now)
+                    for page_id in seen_page_ids
+                    if page_id not in planned
+                ],
+            )
+            seq = self._next_seq()
+            # INSERT OR REPLACE rather than an upsert: the Lambda Python 3.8
+            # runtime ships SQLite 3.7
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO notion_jobs "
+                "(page_id, scope, symbol, url, payload, seq, attempts, "
+                "available_at, leased_until) VALUES (?, ?, ?, ?, ?, ?, "
+                "COALESCE((SELECT attempts FROM notion_jobs WHERE page_id = ?), 0), "
+                "0, COALESCE((SELECT leased_until FROM notion_jobs "
+                "WHERE page_id = ?), 0))",
+                [
+                    (
+                        job["page_id"],
+                        scope,
+                        job["symbol"],
+                        job["url"],
+                        json.dumps(job["payload"]),
+                        seq + position,
+                        job["page_id"],
+                        job["page_id"],
+                    )
+                    for position, job in enumerate(jobs)
+                ],
+            )
+
+    def claim(self, scope, limit, now, lease_seconds):
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            rows = self.connection.execute(
+                "SELECT page_id, symbol, url, payload, attempts FROM notion_jobs "
+                "WHERE scope = ? AND available_at <= ? AND leased_until <= ? "
+                "ORDER BY seq LIMIT ?",
+                (scope, now, now, limit),
+            ).fetchall()
+            self.connection.executemany(
+                "UPDATE notion_jobs SET leased_until = ? WHERE page_id = ?",
+                [(now + lease_seconds, row[0]) for row in rows],
+            )
+        return [
+            {
+                "page_id": page_id,
+                "symbol": symbol,
+                "url": url,
+                "payload": json.loads(payload),
+                "attempts": attempts,
+            }
+            for page_id, symbol, url, payload, attempts in rows
+        ]
+
+    def complete(self, page_id):
+        with self.connection:
+            self.connection.execute(
+                "DELETE FROM notion_jobs WHERE page_id = ?", (page_id,)
+            )
+
+    def retry_later(self, page_id, now, error):
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            row = self.connection.execute(
+                "SELECT attempts FROM notion_jobs WHERE page_id = ?", (page_id,)
+            ).fetchone()
+            attempts = (row[0] if row else 0) + 1
+            backoff = min(MAX_NOTION_JOB_BACKOFF_SECONDS, 2 ** attempts)
+            self.connection.execute(
+                "UPDATE notion_jobs SET seq = ?, attempts = ?, available_at = ?, "
+                "leased_until = 0, last_error = ? WHERE page_id = ?",
+                (self._next_seq(), attempts, now + backoff, error, page_id),
+            )
+
+    def count(self, scope):
+        row = self.connection.execute(
+            "SELECT COUNT(*) FROM notion_jobs WHERE scope = ?", (scope,)
+        ).fetchone()
+        return row[0]
+
+
+def get_job_scope(type, headers):
+    # Jobs are only resumed with the token they were planned with
+    token = (headers or {}).get("Authorization", "")
+    return f"{type}:{zlib.crc32(token.encode()):08x}"
+
+
+def send_queued_job(job, headers, session, limiter):
+    # One attempt only: "ok", "retry" (requeue) or "drop" (permanent failure)
+    start = time.monotonic()
+    response = send_limited_request(
+        limiter, session, "PATCH", job["url"], headers, job["payload"], retries=0
+    )
+    get_run_metrics().observe_write_latency(time.monotonic() - start)
+    if response is None:
+        return "retry", "request error"
+    if response.status_code == 429 or response.status_code >= 500:
+        return "retry", f"HTTP {response.status_code}"
+    if not is_response_ok(response, job["url"]):
+        return "drop", f"HTTP {response.status_code}"
+    return "ok", None
+
+
+def run_queued_notion_updates(queue, scope, headers, session, max_workers, limiter):
+    max_attempts = parse_int_env(
+        "NOTION_JOB_MAX_ATTEMPTS", DEFAULT_NOTION_JOB_MAX_ATTEMPTS, 1
+    )
+    lease_seconds = parse_int_env(
+        "NOTION_JOB_LEASE_SECONDS", DEFAULT_NOTION_JOB_LEASE_SECONDS, 1
+    )
+    outcomes = {"ok": 0, "fail": 0, "deferred": 0, "retried": 0}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while has_time_for_work():
+            batch = queue.claim(scope, max_workers * 4, time.time(), lease_seconds)
+            if not batch:
+                break
+            results = executor.map(
+                lambda job: send_queued_job(job, headers, session, limiter), batch
+            )
+            for job, (result, error) in zip(batch, results):
+                log_row(
+                    f"Notion update outcome for {job['symbol']}: {result} "
+                    f"(page_id={job['page_id']}, attempts={job['attempts'] + 1})",
+                    job["page_id"],
+                )
+                if result == "ok":
+                    queue.complete(job["page_id"])
+                    outcomes["ok"] += 1
+                elif result == "retry" and job["attempts"] + 1 < max_attempts:
+                    queue.retry_later(job["page_id"], time.time(), error)
+                    outcomes["retried"] += 1
+                else:
+                    print(
+                        f"Dropping Notion update for {job['symbol']} "
+                        f"(page_id={job['page_id']}): {error}"
+                    )
+                    queue.complete(job["page_id"])
+                    outcomes["fail"] += 1
+    outcomes["deferred"] = queue.count(scope)
+    return outcomes
+
+
+def update_notion_prices_queued(
+    queue_path, type, database_results, jobs, headers, session, limiter
+):
+    max_workers, _, _ = get_notion_update_settings()
+    queue = NotionJobQueue(queue_path)
+    try:
+        scope = get_job_scope(type, headers)
+        queue.sync(
+            scope, jobs, [holding.page_id for holding in database_results], time.time()
+        )
+        print(
+            f"Starting queued Notion updates: planned={len(jobs)}, "
+            f"queued={queue.count(scope)}, workers={max_workers}"
+        )
+        with metrics_span(f"updates.{type}"):
+            return run_queued_notion_updates(
+                queue, scope, headers, session, max_workers, limiter
+            )
+    finally:
+        queue.close()
 
+
+def get_notion_update_settings():
     max_workers = parse_int_env(
         "NOTION_UPDATE_MAX_WORKERS", DEFAULT_NOTION_UPDATE_MAX_WORKERS, 1
     )
@@ -356,63 +1977,627 @@ def update_notion_prices(type, database_results, prices, headers, session):
         "NOTION_UPDATE_RPS_LIMIT", DEFAULT_NOTION_UPDATE_RPS_LIMIT, 0.1
     )
     burst = parse_int_env("NOTION_UPDATE_BURST", DEFAULT_NOTION_UPDATE_BURST, 1)
-    limiter = RateLimiter(rps_limit, burst)
+    return max_workers, rps_limit, burst
+
+
+def plan_notion_updates(type, database_results, prices):
+    with metrics_span(f"job_build.{type}"):
+        all_jobs = build_update_jobs(type, database_results, prices)
+        abs_tolerance, rel_tolerance = get_price_tolerances(type)
+        jobs, skipped = filter_changed_jobs(all_jobs, abs_tolerance, rel_tolerance)
+        # Biggest moves first, so a run cut short by the deadline has already
+        # written the updates that matter most for the total
+        jobs = order_jobs_by_symbol(jobs)
+    metrics = get_run_metrics()
+    metrics.increment("notion_writes_planned", len(jobs))
+    metrics.increment("notion_writes_skipped", skipped)
+    return jobs, skipped
+
+
+def get_value_at_stake(job):
+    current_price = job.get("current_price") or 0.0
+    new_price = job.get("new_price")
+    if new_price is None:
+        return 0.0
+    return abs(new_price - current_price) * abs(job.get("amount", 1.0))
+
+
+def get_holding_value(job):
+    new_price = job.get("new_price")
+    if new_price is None:
+        return 0.0
+    return abs(new_price) * abs(job.get("amount", 1.0))
+
+
+def order_jobs_by_symbol(jobs):
+    # Jobs for one symbol stay together. Symbols go by the value at stake of
+    # all their rows, then by holding value; rows within a symbol by their own.
+    groups = {}
+    for job in jobs:
+        groups.setdefault(job["symbol"], []).append(job)
+
+    def group_key(symbol):
+        group = groups[symbol]
+        return (
+            sum(get_value_at_stake(job) for job in group),
+            sum(get_holding_value(job) for job in group),
+        )
+
+    ordered = []
+    for symbol in sorted(groups, key=group_key, reverse=True):
+        ordered.extend(sorted(groups[symbol], key=get_value_at_stake, reverse=True))
+    return ordered
+
+
+def record_update_outcomes(outcomes):
+    metrics = get_run_metrics()
+    metrics.increment("notion_writes_ok", outcomes["ok"])
+    metrics.increment("notion_writes_failed", outcomes["fail"])
+    metrics.increment("notion_writes_deferred", outcomes["deferred"])
 
+
+def update_notion_prices(
+    type, database_results, prices, headers, session, limiter=None
+):
+    jobs, skipped = plan_notion_updates(type, database_results, prices)
+    max_workers, rps_limit, burst = get_notion_update_settings()
+    if limiter is None:
+        limiter = RateLimiter(rps_limit, burst)
+
+    queue_path = os.environ.get("NOTION_JOB_QUEUE_PATH")
+    if queue_path:
+        # Runs even with no new jobs, to resume work left by earlier runs
+        outcomes = update_notion_prices_queued(
+            queue_path, type, database_results, jobs, headers, session, limiter
+        )
+    elif not jobs:
+        print(f"No Notion updates to apply (writes saved: {skipped})")
+        return {"ok": 0, "fail": 0, "deferred": 0, "skipped": skipped}
+    else:
+        print(
+            f"Starting Notion updates: count={len(jobs)}, workers={max_workers}, "
+            f"rps_limit={rps_limit}, burst={burst}"
+        )
+        with metrics_span(f"updates.{type}"):
+            outcomes = run_notion_updates_concurrently(
+                jobs, headers, session, max_workers, limiter
+            )
+    record_update_outcomes(outcomes)
+    outcomes["skipped"] = skipped
     print(
-        f"Starting Notion updates: count={len(jobs)}, workers={max_workers}, "
-        f"rps_limit={rps_limit}, burst={burst}"
-    )
-    outcomes = run_notion_updates_concurrently(
-        jobs, headers, session, max_workers, limiter
+        f"Completed Notion updates: ok={outcomes['ok']}, fail={outcomes['fail']}, "
+        f"deferred={outcomes['deferred']}, writes saved={skipped}"
     )
-    print(
-        f"Completed Notion updates: ok={outcomes['ok']}, fail={outcomes['fail']}"
+    return outcomes
+
+
+def build_query_options(properties, query_filter=None):
+    page_size = parse_int_env(
+        "NOTION_QUERY_PAGE_SIZE", DEFAULT_NOTION_QUERY_PAGE_SIZE, 1
     )
+    options = {"page_size": min(page_size, DEFAULT_NOTION_QUERY_PAGE_SIZE)}
+    projection = os.environ.get("NOTION_QUERY_PROJECTION", "true").lower()
+    if projection not in ("0", "false", "no"):
+        options["filter_properties"] = list(properties)
+    if query_filter:
+        options["query_filter"] = query_filter
+    return options
+
+
+def build_database_query_options(config):
+    return {
+        config["crypto_database_id"]: build_query_options(CRYPTO_QUERY_PROPERTIES),
+        config["stock_database_id"]: build_query_options(
+            STOCK_QUERY_PROPERTIES, STOCK_QUERY_FILTER
+        ),
+        config["fiat_database_id"]: build_query_options(
+            FIAT_QUERY_PROPERTIES + (["Currency"] if load_fx_rates() else [])
+        ),
+    }
 
 
-def query_notion_database(database_id, headers, session):
-    notion_db_url = f"https://api.notion.com/v1/databases/{database_id}/query"
-    results = []
-    payload = {}
+def iter_notion_database_pages(
+    database_id,
+    headers,
+    session,
+    filter_properties=None,
+    page_size=None,
+    query_filter=None,
+    limiter=None,
+):
+    notion_db_url = f"{NOTION_API_URL}v1/databases/{database_id}/query"
+    params = None
+    if filter_properties:
+        params = {"filter_properties": list(filter_properties)}
+    base_payload = {}
+    if page_size:
+        base_payload["page_size"] = page_size
+    if query_filter:
+        base_payload["filter"] = query_filter
+    payload = dict(base_payload)
     while True:
         database = request_json(
-            session, "POST", notion_db_url, headers=headers, payload=payload
+            session,
+            "POST",
+            notion_db_url,
+            headers=headers,
+            payload=payload,
+            params=params,
+            limiter=limiter,
         )
         if not database:
-            break
-        results.extend(database.get("results", []))
+            # Lets callers that need a complete read (read_database_changes)
+            # tell a failed page apart from the end of the database
+            return False
+        yield database.get("results", [])
         if database.get("has_more"):
-            payload = {"start_cursor": database.get("next_cursor")}
+            payload = dict(base_payload, start_cursor=database.get("next_cursor"))
         else:
-            break
+            return True
+
+
+def iter_notion_database_rows(database_id, headers, session, **query_options):
+    for page_results in iter_notion_database_pages(
+        database_id, headers, session, **query_options
+    ):
+        for result in page_results:
+            yield result
+
+
+def query_notion_database(database_id, headers, session, **query_options):
+    return list(
+        iter_notion_database_rows(database_id, headers, session, **query_options)
+    )
+
+
+# Rows already fetched from Notion during the current run, keyed by database id.
+class PortfolioSnapshot:
+    def __init__(self):
+        self._results = {}
+
+    def is_loaded(self, database_id):
+        return database_id in self._results
+
+    def store(self, database_id, results):
+        self._results[database_id] = results
+        return results
+
+    def get(self, database_id):
+        return self._results.get(database_id, [])
+
+
+def iter_holding_pages(database_id, headers, session, **query_options):
+    # iter_notion_database_pages with every row parsed into a Holding. Passes
+    # on the generator's return value (whether the read completed).
+    pages = iter_notion_database_pages(database_id, headers, session, **query_options)
+    while True:
+        try:
+            page_results = next(pages)
+        except StopIteration as stop:
+            return stop.value
+        yield [parse_holding(result, database_id) for result in page_results]
+
+
+def load_database_results(
+    database_id,
+    headers,
+    session,
+    snapshot=None,
+    query_options=None,
+    limiter=None,
+    kind="holdings",
+):
+    # kind (crypto, stock or fiat) names the query's metric; database ids would
+    # make one EMF metric per database
+    if snapshot is not None and snapshot.is_loaded(database_id):
+        print(f"Using snapshot rows for database {database_id}")
+        return snapshot.get(database_id)
+    results = []
+    with metrics_span(f"db_query.{kind}"):
+        pages = iter_holding_pages(
+            database_id, headers, session, limiter=limiter, **(query_options or {})
+        )
+        while True:
+            try:
+                results.extend(next(pages))
+            except StopIteration as stop:
+                complete = stop.value is not False
+                break
+    get_run_metrics().increment("notion_rows_read", len(results))
+    if not complete:
+        # A partial read must not stand in for the database at total time
+        print(f"Read of database {database_id} was incomplete; not snapshotting")
+    elif snapshot is not None:
+        snapshot.store(database_id, results)
     return results
 
 
-def calculate_total_assets(databases, headers, session):
-    print("Calculating total assets")
-    total = 0
+def apply_prices_in_memory(database_results, prices):
+    # Mirror the Notion Price update on the rows we already hold so the total
+    # can be computed without re-reading them. Total is Amount * Price.
+    applied = 0
+    for holding in database_results:
+        new_price = prices.get(holding.symbol) if holding.symbol else None
+        if new_price is None:
+            continue
+        holding.price = float(new_price)
+        holding.total = get_stock_amount(holding) * holding.price
+        applied += 1
+    return applied
+
+
+def normalize_notion_id(notion_id):
+    return notion_id.replace("-", "").lower()
+
+
+def load_fx_rates():
+    # FIAT_FX_RATES: {"EUR": 1.08} converts fiat rows to USD by Currency select
+    raw = os.environ.get("FIAT_FX_RATES")
+    if not raw:
+        return {}
+    try:
+        rates = json.loads(raw)
+    except ValueError:
+        print("Invalid FIAT_FX_RATES. Ignoring.")
+        return {}
+    if not isinstance(rates, dict):
+        print("FIAT_FX_RATES must be a JSON object. Ignoring.")
+        return {}
+    parsed = {}
+    for currency, rate in rates.items():
+        if isinstance(rate, (int, float)) and not isinstance(rate, bool):
+            parsed[str(currency).upper()] = float(rate)
+        else:
+            print(f"Invalid FX rate for {currency}: {rate}. Ignoring.")
+    return parsed
+
+
+def get_fx_rate(fx_rates, currency):
+    if not fx_rates or not currency:
+        return 1.0
+    return fx_rates.get(currency.upper(), 1.0)
+
+
+def get_row_valuation(holding, is_fiat):
+    # (quantity, unit price, currency) for one row. Crypto and stock rows are
+    # valued as Amount * Price, so the total does not wait for Notion to
+    # recompute the Total formula of pages updated in this run.
+    if is_fiat:
+        return holding.total or 0.0, 1.0, holding.symbol
+    if holding.amount is None or holding.price is None:
+        return holding.total or 0.0, 1.0, None
+    return holding.amount, holding.price, None
+
+
+def extract_valuation_columns(results, is_fiat):
+    amounts = array("d")
+    prices = array("d")
+    currencies = []
+    for result in results:
+        amount, price, currency = get_row_valuation(result, is_fiat)
+        amounts.append(amount)
+        prices.append(price)
+        currencies.append(currency)
+    return amounts, prices, currencies
+
+
+def multiply_columns(amounts, prices):
+    if numpy is not None and len(amounts):
+        return numpy.frombuffer(amounts, dtype=float) * numpy.frombuffer(
+            prices, dtype=float
+        )
+    return array("d", map(float.__mul__, amounts, prices))
+
+
+def sum_values(values):
+    if numpy is not None and isinstance(values, numpy.ndarray):
+        return float(values.sum())
+    return math.fsum(values)
+
+
+def convert_columns(prices, currencies, fx_rates):
+    if not fx_rates:
+        return prices
+    return array(
+        "d",
+        (
+            price * get_fx_rate(fx_rates, currency)
+            for price, currency in zip(prices, currencies)
+        ),
+    )
+
+
+def value_rows(results, is_fiat, fx_rates=None):
+    # Per-row USD values for a batch of rows in one pass
+    amounts, prices, currencies = extract_valuation_columns(results, is_fiat)
+    return multiply_columns(amounts, convert_columns(prices, currencies, fx_rates))
+
+
+def sum_database_rows(results, is_fiat, fx_rates=None):
+    return sum_values(value_rows(results, is_fiat, fx_rates))
+
+
+def get_database_query_span(is_fiat):
+    # Crypto and stock are usually in the snapshot, so their total-time reads
+    # share one name
+    return "db_query.fiat" if is_fiat else "db_query.holdings"
+
+
+def stream_database_subtotal(
+    database_id,
+    is_fiat,
+    headers,
+    session,
+    query_options=None,
+    limiter=None,
+    fx_rates=None,
+):
+    # Pages are summed as they arrive instead of being kept in memory
+    subtotal = 0
+    rows = 0
+    with metrics_span(get_database_query_span(is_fiat)):
+        for page_results in iter_holding_pages(
+            database_id, headers, session, limiter=limiter, **(query_options or {})
+        ):
+            subtotal += sum_database_rows(page_results, is_fiat, fx_rates)
+            rows += len(page_results)
+    get_run_metrics().increment("notion_rows_read", rows)
+    return subtotal
+
+
+def format_notion_timestamp(moment):
+    return moment.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+def build_edited_since_filter(checkpoint):
+    return {
+        "timestamp": "last_edited_time",
+        "last_edited_time": {"on_or_after": checkpoint},
+    }
+
+
+def load_totals_cache(path):
+    cache = read_json_file(path)
+    if not isinstance(cache, dict) or not isinstance(cache.get("databases"), dict):
+        return {"databases": {}}
+    return cache
+
+
+def save_totals_cache(path, totals_cache, loaded):
+    # Other portfolios write the same file concurrently, so the entries this
+    # run replaced are merged into a fresh copy instead of overwriting it
+    with TOTALS_CACHE_LOCK:
+        merged = load_totals_cache(path)
+        for key, entry in totals_cache["databases"].items():
+            if entry is not loaded.get(key):
+                merged["databases"][key] = entry
+        write_json_file(path, merged)
+
+
+def read_database_changes(
+    database_id, is_fiat, headers, session, query_options, limiter
+):
+    # Returns {page_id: {"edited", "value", "currency"}} and whether every
+    # page was read. Values are kept before FX conversion so cached pages follow
+    # rate changes. Archived pages come back with a None value.
+    changes = {}
+    pages = iter_holding_pages(
+        database_id, headers, session, limiter=limiter, **query_options
+    )
+    while True:
+        try:
+            page_results = next(pages)
+        except StopIteration as stop:
+            return changes, stop.value is not False
+        amounts, prices, currencies = extract_valuation_columns(
+            page_results, is_fiat
+        )
+        values = multiply_columns(amounts, prices)
+        for holding, value, currency in zip(page_results, values, currencies):
+            changes[holding.page_id] = {
+                "edited": holding.last_edited_time,
+                "value": None if holding.archived else float(value),
+                "currency": currency,
+            }
+
+
+def sum_cached_pages(pages, fx_rates=None):
+    values = array("d", (page["value"] for page in pages))
+    rates = array(
+        "d", (get_fx_rate(fx_rates, page.get("currency")) for page in pages)
+    )
+    return sum_values(multiply_columns(values, rates))
+
+
+def incremental_database_subtotal(
+    database_id,
+    is_fiat,
+    headers,
+    session,
+    totals_cache,
+    query_options=None,
+    limiter=None,
+    now=None,
+    fx_rates=None,
+):
+    # Only pages edited since the last checkpoint are read and folded into the
+    # cached per-page contributions. Deleted pages never show up in that query,
+    # so the whole database is re-read every TOTALS_FULL_RECONCILE_SECONDS.
+    now = now or datetime.datetime.utcnow()
+    now_ts = (now - datetime.datetime(1970, 1, 1)).total_seconds()
+    reconcile_seconds = parse_int_env(
+        "TOTALS_FULL_RECONCILE_SECONDS", DEFAULT_TOTALS_FULL_RECONCILE_SECONDS, 0
+    )
+    slack_seconds = parse_int_env(
+        "TOTALS_EDIT_SLACK_SECONDS", DEFAULT_TOTALS_EDIT_SLACK_SECONDS, 0
+    )
+    key = normalize_notion_id(database_id)
+    entry = totals_cache["databases"].get(key)
+    options = dict(query_options or {})
+    full = (
+        not isinstance(entry, dict)
+        or now_ts - entry.get("reconciled_at", 0) >= reconcile_seconds
+    )
+    if full:
+        pages = {}
+    else:
+        pages = dict(entry["pages"])
+        # No row filter here: a row edited out of it must still replace its
+        # cached contribution
+        options["query_filter"] = build_edited_since_filter(entry["checkpoint"])
+
+    checkpoint = format_notion_timestamp(
+        now - datetime.timedelta(seconds=slack_seconds)
+    )
+    with metrics_span(get_database_query_span(is_fiat)):
+        changes, complete = read_database_changes(
+            database_id, is_fiat, headers, session, options, limiter
+        )
+    get_run_metrics().increment("notion_rows_read", len(changes))
+    for page_id, change in changes.items():
+        if change["value"] is None:
+            pages.pop(page_id, None)
+        else:
+            pages[page_id] = change
+    print(
+        f"Totals for database {database_id}: "
+        f"{'full' if full else 'incremental'} read, changed={len(changes)}, "
+        f"cached={len(pages)}"
+    )
+
+    if complete:
+        totals_cache["databases"][key] = {
+            "pages": pages,
+            "checkpoint": checkpoint,
+            "reconciled_at": now_ts if full else entry["reconciled_at"],
+        }
+    else:
+        print(f"Totals cache for {database_id} kept after a failed read")
+    return sum_cached_pages(list(pages.values()), fx_rates)
+
+
+def calculate_asset_breakdown(
+    databases,
+    headers,
+    session,
+    snapshot=None,
+    fiat_database_id=None,
+    query_options=None,
+    limiter=None,
+):
+    if fiat_database_id is None:
+        fiat_database_id = os.environ["FIAT_DB_ID"]
+    fiat_key = normalize_notion_id(fiat_database_id)
+    totals_cache_path = os.environ.get("TOTALS_CACHE_PATH")
+    totals_cache = load_totals_cache(totals_cache_path) if totals_cache_path else None
+    # Entries as loaded, so only the ones this call replaced are written back
+    loaded = dict(totals_cache["databases"]) if totals_cache is not None else None
+    fx_rates = load_fx_rates()
+
+    breakdown = {}
+    pending = []
     for database_id in databases:
-        results = query_notion_database(database_id, headers, session)
-        for result in results:
-            if result["parent"]["database_id"] == os.environ["FIAT_DB_ID"]:
-                total += result["properties"]["Total"]["number"]
-            else:
-                total += result["properties"]["Total"]["formula"]["number"]
-    return round(total, 2)
+        is_fiat = normalize_notion_id(database_id) == fiat_key
+        if snapshot is not None and snapshot.is_loaded(database_id):
+            breakdown[database_id] = sum_database_rows(
+                snapshot.get(database_id), is_fiat, fx_rates
+            )
+        else:
+            pending.append((database_id, is_fiat))
+
+    if pending:
+        with ThreadPoolExecutor(max_workers=len(pending)) as executor:
+            futures = {}
+            for database_id, is_fiat in pending:
+                database_options = (query_options or {}).get(database_id)
+                if totals_cache is None:
+                    future = executor.submit(
+                        stream_database_subtotal,
+                        database_id,
+                        is_fiat,
+                        headers,
+                        session,
+                        database_options,
+                        limiter,
+                        fx_rates,
+                    )
+                else:
+                    future = executor.submit(
+                        incremental_database_subtotal,
+                        database_id,
+                        is_fiat,
+                        headers,
+                        session,
+                        totals_cache,
+                        database_options,
+                        limiter,
+                        fx_rates=fx_rates,
+                    )
+                futures[future] = database_id
+            for future in as_completed(futures):
+                breakdown[futures[future]] = future.result()
+        if totals_cache is not None:
+            save_totals_cache(totals_cache_path, totals_cache, loaded)
+
+    return {database_id: breakdown[database_id] for database_id in databases}
+
+
+def calculate_total_assets(
+    databases,
+    headers,
+    session,
+    snapshot=None,
+    query_options=None,
+    limiter=None,
+    fiat_database_id=None,
+):
+    print("Calculating total assets")
+    breakdown = calculate_asset_breakdown(
+        databases,
+        headers,
+        session,
+        snapshot,
+        fiat_database_id=fiat_database_id,
+        query_options=query_options,
+        limiter=limiter,
+    )
+    for database_id, subtotal in breakdown.items():
+        print(f"Subtotal for database {database_id}: {subtotal:.2f}")
+    return round(sum(breakdown.values()), 2)
 
 
-def update_total_assets_callout(block_id, total_assets, headers, session):
-    notion_block_url = f"https://api.notion.com/v1/blocks/{block_id}"
-    block = request_json(session, "GET", notion_block_url, headers=headers)
-    if not block:
-        return
+def update_total_assets_callout(block_id, total_assets, headers, session, limiter=None):
+    with metrics_span("callout"):
+        write_total_assets_callout(
+            block_id, total_assets, headers, session, limiter=limiter
+        )
+
+
+def get_callout_cache():
+    # Loaded from CALLOUT_CACHE_PATH on a cold start, if set
+    global CALLOUT_CACHE
+    with CALLOUT_CACHE_LOCK:
+        if CALLOUT_CACHE is None:
+            path = os.environ.get("CALLOUT_CACHE_PATH")
+            cached = read_json_file(path) if path else None
+            CALLOUT_CACHE = cached if isinstance(cached, dict) else {}
+        return CALLOUT_CACHE
 
-    callout = block.get("callout")
-    if not callout:
-        print("Callout block not found in response")
-        return
 
-    rich_text = callout.get("rich_text", [])
+def store_callout_cache(block_id, rich_text):
+    cache = get_callout_cache()
+    with CALLOUT_CACHE_LOCK:
+        if rich_text is None:
+            cache.pop(block_id, None)
+        else:
+            cache[block_id] = {"rich_text": rich_text}
+        path = os.environ.get("CALLOUT_CACHE_PATH")
+        if path:
+            write_json_file(path, cache)
+
+
+def set_callout_total(rich_text, content):
+    rich_text = copy.deepcopy(rich_text)
     if len(rich_text) < 1:
         rich_text.append({"type": "text", "text": {"content": ""}})
     if len(rich_text) < 2:
@@ -420,96 +2605,988 @@ def update_total_assets_callout(block_id, total_assets, headers, session):
 
     if "text" not in rich_text[1]:
         rich_text[1]["text"] = {"content": ""}
-    rich_text[1]["text"]["content"] = f": ${total_assets:.2f}"
-    callout["rich_text"] = rich_text
+    rich_text[1]["text"]["content"] = content
+    return rich_text
+
+
+def get_callout_content(rich_text):
+    if len(rich_text) < 2:
+        return None
+    return rich_text[1].get("text", {}).get("content")
+
+
+def write_total_assets_callout(block_id, total_assets, headers, session, limiter=None):
+    notion_block_url = f"{NOTION_API_URL}v1/blocks/{block_id}"
+    content = f": ${total_assets:.2f}"
+    cached = get_callout_cache().get(block_id)
+    if cached:
+        # The cached layout saves the GET, and an unchanged total saves the PATCH
+        if get_callout_content(cached["rich_text"]) == content:
+            print("Total assets unchanged, callout not updated")
+            get_run_metrics().increment("callout_writes_saved")
+            return
+        rich_text = set_callout_total(cached["rich_text"], content)
+        print("Updating total assets")
+        response = send_request(
+            session,
+            "PATCH",
+            notion_block_url,
+            headers,
+            {"callout": {"rich_text": rich_text}},
+            None,
+            limiter,
+        )
+        if is_response_ok(response, notion_block_url):
+            store_callout_cache(block_id, rich_text)
+            return
+        status_code = response.status_code if response is not None else None
+        if status_code is None or status_code == 429 or status_code >= 500:
+            # Transient failure: keep the layout, the next run tries again
+            return
+        print("Cached callout layout was rejected, reading the block again")
+        store_callout_cache(block_id, None)
+
+    block = request_json(
+        session, "GET", notion_block_url, headers=headers, limiter=limiter
+    )
+    if not block:
+        return
+
+    callout = block.get("callout")
+    if not callout:
+        print("Callout block not found in response")
+        return
+
+    rich_text = set_callout_total(callout.get("rich_text", []), content)
     print("Updating total assets")
-    request_status(
+    if request_status(
         session,
         "PATCH",
         notion_block_url,
         headers=headers,
-        payload={"callout": {"rich_text": callout["rich_text"]}},
+        payload={"callout": {"rich_text": rich_text}},
+        limiter=limiter,
+    ):
+        store_callout_cache(block_id, rich_text)
+
+
+# Append-only binary price history. Records are fixed width, so any record can
+# be read from a memory map by offset and time ranges are found by bisection.
+# Symbol names live in a JSON sidecar and records refer to them by index.
+class PriceHistoryStore:
+    def __init__(self, path):
+        self.path = path
+        self.symbols_path = f"{path}.symbols.json"
+        symbols = read_json_file(self.symbols_path)
+        self.symbols = symbols if isinstance(symbols, list) else []
+        self._symbol_ids = {symbol: index for index, symbol in enumerate(self.symbols)}
+
+    def symbol_id(self, symbol):
+        if symbol not in self._symbol_ids:
+            self._symbol_ids[symbol] = len(self.symbols)
+            self.symbols.append(symbol)
+        return self._symbol_ids[symbol]
+
+    def append(self, records):
+        # Queries binary search on time, so a record older than the last one
+        # stored is moved up to it rather than breaking the order
+        known = len(self.symbols)
+        floor = self.last_timestamp()
+        packed = []
+        for timestamp, symbol, price, value in records:
+            if floor is not None and timestamp < floor:
+                timestamp = floor
+            floor = timestamp
+            packed.append(
+                PRICE_HISTORY_RECORD.pack(
+                    timestamp, self.symbol_id(symbol), float(price), float(value)
+                )
+            )
+        if not packed:
+            return 0
+        # The sidecar goes first so every stored id always resolves
+        if len(self.symbols) != known and not write_json_file(
+            self.symbols_path, self.symbols
+        ):
+            for symbol in self.symbols[known:]:
+                del self._symbol_ids[symbol]
+            del self.symbols[known:]
+            return 0
+        with open(self.path, "ab") as history_file:
+            if history_file.tell() == 0:
+                history_file.write(
+                    PRICE_HISTORY_HEADER.pack(
+                        PRICE_HISTORY_MAGIC,
+                        PRICE_HISTORY_VERSION,
+                        PRICE_HISTORY_RECORD.size,
+                    )
+                )
+            else:
+                # Drop a partial record left behind by an interrupted append
+                end = history_file.tell()
+                partial = (end - PRICE_HISTORY_HEADER.size) % PRICE_HISTORY_RECORD.size
+                if partial:
+                    history_file.truncate(end - partial)
+            history_file.write(b"".join(packed))
+        return len(packed)
+
+    @contextmanager
+    def _records(self):
+        try:
+            history_file = open(self.path, "rb")
+        except FileNotFoundError:
+            yield None, 0
+            return
+        with history_file:
+            size = os.fstat(history_file.fileno()).st_size
+            if size <= PRICE_HISTORY_HEADER.size:
+                yield None, 0
+                return
+            with mmap.mmap(
+                history_file.fileno(), 0, access=mmap.ACCESS_READ
+            ) as mapped:
+                magic, version, record_size = PRICE_HISTORY_HEADER.unpack_from(mapped)
+                if (
+                    magic != PRICE_HISTORY_MAGIC
+                    or version != PRICE_HISTORY_VERSION
+                    or record_size != PRICE_HISTORY_RECORD.size
+                ):
+                    raise ValueError(f"Unsupported price history file: {self.path}")
+                count = (size - PRICE_HISTORY_HEADER.size) // record_size
+                yield mapped, count
+
+    def _record(self, mapped, index):
+        timestamp, symbol_id, price, value = PRICE_HISTORY_RECORD.unpack_from(
+            mapped, PRICE_HISTORY_HEADER.size + index * PRICE_HISTORY_RECORD.size
+        )
+        return timestamp, self.symbols[symbol_id], price, value
+
+    def last_timestamp(self):
+        with self._records() as (mapped, count):
+            return self._record(mapped, count - 1)[0] if count else None
+
+    def _first_at_or_after(self, mapped, count, timestamp):
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if self._record(mapped, middle)[0] < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def query(self, symbol=None, start=None, end=None):
+        # Records with start <= timestamp < end, oldest first
+        with self._records() as (mapped, count):
+            if not count:
+                return []
+            first = 0
+            if start is not None:
+                first = self._first_at_or_after(mapped, count, start)
+            last = count
+            if end is not None:
+                last = self._first_at_or_after(mapped, count, end)
+            records = []
+            for index in range(first, last):
+                record = self._record(mapped, index)
+                if symbol is None or record[1] == symbol:
+                    records.append(record)
+            return records
+
+    def latest(self):
+        # {symbol: (timestamp, price, value)} from a backwards scan that stops
+        # once every known symbol has been seen
+        latest = {}
+        with self._records() as (mapped, count):
+            for index in range(count - 1, -1, -1):
+                timestamp, symbol, price, value = self._record(mapped, index)
+                if symbol not in latest:
+                    latest[symbol] = (timestamp, price, value)
+                    if len(latest) == len(self.symbols):
+                        break
+        return latest
+
+
+def build_history_records(
+    portfolio, rows, crypto_prices, stock_prices, total_assets, timestamp
+):
+    prefix = f"{portfolio['name']}:" if portfolio.get("name") else ""
+    records = []
+    for asset_class, results, prices in (
+        ("crypto", rows["crypto_results"], crypto_prices or {}),
+        ("stock", rows["stock_results"], stock_prices or {}),
+    ):
+        values = {}
+        for holding, value in zip(results, value_rows(results, False)):
+            symbol = holding.symbol
+            if symbol in prices:
+                values[symbol] = values.get(symbol, 0) + float(value)
+        for symbol in sorted(values):
+            records.append(
+                (
+                    timestamp,
+                    f"{prefix}{asset_class}:{symbol}",
+                    prices[symbol],
+                    values[symbol],
+                )
+            )
+    records.append((timestamp, f"{prefix}total", total_assets, total_assets))
+    return records
+
+
+def record_price_history(
+    portfolio, rows, crypto_prices, stock_prices, total_assets, timestamp=None
+):
+    path = os.environ.get("PRICE_HISTORY_PATH")
+    if not path:
+        return 0
+    try:
+        # The store is opened and the time taken under the lock, so appends
+        # from concurrent portfolios see each other's symbols and stay in order
+        with PRICE_HISTORY_LOCK:
+            records = build_history_records(
+                portfolio,
+                rows,
+                crypto_prices,
+                stock_prices,
+                total_assets,
+                time.time() if timestamp is None else timestamp,
+            )
+            written = PriceHistoryStore(path).append(records)
+    except (OSError, ValueError) as exc:
+        print(f"Could not append price history to {path}: {exc}")
+        return 0
+    get_run_metrics().increment("history_records", written)
+    return written
+
+
+# Async view of a RateLimiter, so event loop tasks and worker threads draw
+# from the same budget
+class AsyncRateLimiter:
+    def __init__(self, limiter):
+        self.limiter = limiter
+
+    async def wait_for_slot(self):
+        delay = self.limiter.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+async def run_blocking(executor, func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        executor, functools.partial(func, *args, **kwargs)
     )
 
 
-def lambda_handler(event, context):
-    notion_api_key = get_required_env("NOTION_API_KEY")
-    alpha_vantage_api_key = get_required_env("ALPHA_VANTAGE_API_KEY")
-    crypto_database_id = get_required_env("CRYPTO_DB_ID")
-    stock_database_id = get_required_env("STOCK_DB_ID")
-    fiat_database_id = get_required_env("FIAT_DB_ID")
-    session = create_session()
-
-    headers = {
-        "Authorization": "Bearer " + notion_api_key,
-        "accept": "application/json",
-        "Notion-Version": "2022-06-28",
-        "content-type": "application/json",
-    }
+async def send_limited_request_async(
+    async_limiter, executor, session, method, url, headers=None, payload=None
+):
+    retries = parse_int_env(
+        "NOTION_THROTTLE_RETRIES", DEFAULT_NOTION_THROTTLE_RETRIES, 0
+    )
+    response = None
+    for attempt in range(retries + 1):
+        if attempt and not has_time_for_work():
+            break
+        await async_limiter.wait_for_slot()
+        response = await run_blocking(
+            executor, send_request, session, method, url, headers, payload
+        )
+        if not record_limiter_feedback(async_limiter.limiter, response, url):
+            break
+    return response
+
+
+async def update_notion_prices_async(
+    type, database_results, prices, headers, session, executor, limiter, max_workers
+):
+    if os.environ.get("NOTION_JOB_QUEUE_PATH"):
+        # The queue drains on its own worker pool; run it off the event loop
+        return await run_blocking(
+            executor,
+            update_notion_prices,
+            type,
+            database_results,
+            prices,
+            headers,
+            session,
+            limiter.limiter,
+        )
+    jobs, skipped = plan_notion_updates(type, database_results, prices)
+    if not jobs:
+        print(f"No Notion updates to apply (writes saved: {skipped})")
+        return {"ok": 0, "fail": 0, "deferred": 0, "skipped": skipped}
+    scheduler = WriteScheduler(jobs)
+
+    semaphore = asyncio.Semaphore(max_workers)
+
+    async def worker(job):
+        async with semaphore:
+            if not has_time_for_work():
+                return None
+            log_row("Updating price in Notion for " + job["symbol"], job["page_id"])
+            start = time.monotonic()
+            response = await send_limited_request_async(
+                limiter,
+                executor,
+                session,
+                "PATCH",
+                job["url"],
+                headers=headers,
+                payload=job["payload"],
+            )
+            ok = is_response_ok(response, job["url"])
+            elapsed = time.monotonic() - start
+            get_run_metrics().observe_write_latency(elapsed)
+            status = "ok" if ok else "fail"
+            log_row(
+                f"Notion update outcome for {job['symbol']}: {status} "
+                f"(page_id={job['page_id']}, elapsed={round(elapsed, 3)}s)",
+                job["page_id"],
+            )
+            return ok
 
-    # CRYPTOCURRENCY PRICES
-    print("Getting CRYPTO database information")
-    crypto_results = query_notion_database(crypto_database_id, headers, session)
+    print(f"Starting async Notion updates: type={type}, count={len(jobs)}")
+    with metrics_span(f"updates.{type}"):
+        # Tasks are created in scheduler order, so the semaphore admits the
+        # biggest symbols first; outcomes are recorded as they complete
+        async def run_job(job):
+            scheduler.record(job, await worker(job))
+
+        await asyncio.gather(
+            *[asyncio.ensure_future(run_job(job)) for job in scheduler.jobs]
+        )
+    scheduler.report()
+    outcomes = scheduler.outcomes()
+    outcomes["skipped"] = skipped
+    record_update_outcomes(outcomes)
+    if outcomes["deferred"]:
+        print(f"Deferred {outcomes['deferred']} Notion updates to meet the deadline")
+    print(
+        f"Completed Notion updates: ok={outcomes['ok']}, fail={outcomes['fail']}, "
+        f"deferred={outcomes['deferred']}, writes saved={skipped}"
+    )
+    return outcomes
+
+
+def collect_unique_coins(crypto_results):
     unique_coins_set = set()
-    for result in crypto_results:
-        coin_name = get_select_name(result, "Coin")
+    for holding in crypto_results:
+        coin_name = holding.symbol
         if coin_name:
             unique_coins_set.add(coin_name)
         else:
-            page_id = result.get("id", "unknown")
-            print(
+            page_id = holding.page_id or "unknown"
+            log_row(
                 "Warning: Skipping crypto entry with missing Coin select. Page id: "
-                + page_id
+                + page_id,
+                page_id,
             )
-    unique_coins = list(unique_coins_set)
-    crypto_prices = fetch_crypto_prices(unique_coins, session)
+    return list(unique_coins_set)
+
+
+PORTFOLIO_ID_KEYS = (
+    "crypto_database_id",
+    "stock_database_id",
+    "fiat_database_id",
+    "total_callout_block_id",
+)
+
+
+def parse_portfolios(raw, source, default_notion_api_key=None):
+    try:
+        entries = json.loads(raw)
+    except ValueError:
+        raise ValueError(f"Invalid portfolios config in {source}")
+    if not isinstance(entries, list) or not entries:
+        raise ValueError(f"Portfolios config in {source} must be a non-empty list")
+
+    portfolios = []
+    for position, entry in enumerate(entries):
+        if not isinstance(entry, dict):
+            raise ValueError(f"Portfolio {position + 1} in {source} must be an object")
+        name = entry.get("name") or f"portfolio-{position + 1}"
+        notion_api_key = entry.get("notion_api_key") or default_notion_api_key
+        missing = [key for key in PORTFOLIO_ID_KEYS if not entry.get(key)]
+        if not notion_api_key:
+            missing.append("notion_api_key")
+        if missing:
+            raise ValueError(f"Portfolio {name} is missing: {', '.join(missing)}")
+        portfolio = {key: entry[key] for key in PORTFOLIO_ID_KEYS}
+        portfolio["name"] = name
+        portfolio["notion_api_key"] = notion_api_key
+        portfolios.append(portfolio)
+    names = [portfolio["name"] for portfolio in portfolios]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Portfolio names in {source} must be unique")
+    return portfolios
+
+
+def load_portfolios(default_notion_api_key=None):
+    raw = os.environ.get("PORTFOLIOS_CONFIG")
+    source = "PORTFOLIOS_CONFIG"
+    path = os.environ.get("PORTFOLIOS_CONFIG_PATH")
+    if not raw and path:
+        try:
+            with open(path) as portfolios_file:
+                raw = portfolios_file.read()
+        except OSError as exc:
+            raise ValueError(f"Could not read portfolios config from {path}: {exc}")
+        source = path
+    if not raw:
+        return None
+    return parse_portfolios(raw, source, default_notion_api_key)
+
+
+def load_config():
+    pipeline_mode = os.environ.get("PIPELINE_MODE", "sync").lower()
+    portfolios = load_portfolios(os.environ.get("NOTION_API_KEY"))
+    if portfolios is not None:
+        return {
+            "notion_api_key": os.environ.get("NOTION_API_KEY"),
+            "alpha_vantage_api_key": get_required_env("ALPHA_VANTAGE_API_KEY"),
+            "pipeline_mode": pipeline_mode,
+            "portfolios": portfolios,
+        }
+    return {
+        "notion_api_key": get_required_env("NOTION_API_KEY"),
+        "alpha_vantage_api_key": get_required_env("ALPHA_VANTAGE_API_KEY"),
+        "crypto_database_id": get_required_env("CRYPTO_DB_ID"),
+        "stock_database_id": get_required_env("STOCK_DB_ID"),
+        "fiat_database_id": get_required_env("FIAT_DB_ID"),
+        "total_callout_block_id": get_required_env("TOTAL_CALLOUT_BLOCK_ID"),
+        "pipeline_mode": pipeline_mode,
+        "portfolios": None,
+    }
+
+
+def build_notion_headers(notion_api_key):
+    return {
+        "Authorization": "Bearer " + notion_api_key,
+        "accept": "application/json",
+        "Notion-Version": "2022-06-28",
+        "content-type": "application/json",
+    }
+
+
+def create_notion_limiter():
+    # One limiter for every Notion read, write and callout call in a run
+    _, rps_limit, burst = get_notion_update_settings()
+    return RateLimiter(rps_limit, burst)
+
+
+def load_portfolio_rows(portfolio, headers, session, limiter):
+    # Rows fetched during this run are kept here and reused for the total
+    snapshot = PortfolioSnapshot()
+    query_options = build_database_query_options(portfolio)
+    print("Getting CRYPTO database information")
+    crypto_results = load_database_results(
+        portfolio["crypto_database_id"],
+        headers,
+        session,
+        snapshot,
+        query_options[portfolio["crypto_database_id"]],
+        limiter,
+        kind="crypto",
+    )
+    stock_results = load_database_results(
+        portfolio["stock_database_id"],
+        headers,
+        session,
+        snapshot,
+        query_options[portfolio["stock_database_id"]],
+        limiter,
+        kind="stock",
+    )
+    return {
+        "snapshot": snapshot,
+        "query_options": query_options,
+        "crypto_results": crypto_results,
+        "stock_results": filter_stock_results(stock_results),
+    }
+
+
+def write_portfolio_prices(
+    portfolio, rows, crypto_prices, stock_prices, headers, session, limiter
+):
     if crypto_prices:
-        update_notion_prices("crypto", crypto_results, crypto_prices, headers, session)
+        update_notion_prices(
+            "crypto", rows["crypto_results"], crypto_prices, headers, session, limiter
+        )
+        apply_prices_in_memory(rows["crypto_results"], crypto_prices)
+    if stock_prices:
+        update_notion_prices(
+            "stock", rows["stock_results"], stock_prices, headers, session, limiter
+        )
+        apply_prices_in_memory(rows["stock_results"], stock_prices)
+
+
+def finish_portfolio(
+    portfolio, rows, crypto_prices, stock_prices, headers, session, limiter
+):
+    # CALCULATE TOTAL ASSETS
+    total_assets = calculate_total_assets(
+        [
+            portfolio["crypto_database_id"],
+            portfolio["stock_database_id"],
+            portfolio["fiat_database_id"],
+        ],
+        headers,
+        session,
+        rows["snapshot"],
+        rows["query_options"],
+        limiter,
+        fiat_database_id=portfolio["fiat_database_id"],
+    )
+    update_total_assets_callout(
+        portfolio["total_callout_block_id"], total_assets, headers, session, limiter
+    )
+    record_price_history(portfolio, rows, crypto_prices, stock_prices, total_assets)
+    return total_assets
+
+
+def update_portfolio(
+    portfolio, rows, crypto_prices, stock_prices, headers, session, limiter
+):
+    args = (portfolio, rows, crypto_prices, stock_prices, headers, session, limiter)
+    write_portfolio_prices(*args)
+    enter_final_phase()
+    return finish_portfolio(*args)
+
+
+def run_pipeline(config, headers, session):
+    limiter = create_notion_limiter()
+    rows = load_portfolio_rows(config, headers, session, limiter)
+
+    # CRYPTOCURRENCY PRICES
+    unique_coins = collect_unique_coins(rows["crypto_results"])
+    crypto_prices = fetch_crypto_prices(unique_coins, session)
 
     # STOCK PRICES
-    # Get current UTC hour
-    current_utc_hour = datetime.datetime.utcnow().hour
-
-    # Define the hour at which to perform the stock price update (e.g., 11 UTC)
-    # This is because the free tier of the API has a limit of 25 requests per day
-    stock_update_hour = 11
-
-    # Only execute stock price update if the current hour matches the specified hour
-    if current_utc_hour == stock_update_hour:
-        stock_results = query_notion_database(stock_database_id, headers, session)
-        filtered_stock_results = [
-            result
-            for result in stock_results
-            if get_stock_amount(result) > 0
-            and result["properties"]["Stock"]["select"]["name"] != "USD"
-        ]
-        filtered_out_count = len(stock_results) - len(filtered_stock_results)
-        if filtered_out_count:
+    # The free tier of AlphaVantage has a limit of 25 requests per day, so each
+    # run spends a share of that budget and reuses cached quotes for the rest
+    stock_prices = fetch_stock_prices(
+        get_stock_values(rows["stock_results"]),
+        config["alpha_vantage_api_key"],
+        session,
+    )
+    return update_portfolio(
+        config, rows, crypto_prices, stock_prices, headers, session, limiter
+    )
+
+
+def run_portfolios_pipeline(config, session):
+    # Every portfolio is read first so each coin and stock price is fetched
+    # once for all of them. Notion limits each integration token separately,
+    # so portfolios that share a token share one limiter.
+    portfolios = config["portfolios"]
+    limiters = {}
+    headers = {}
+    for portfolio in portfolios:
+        key = portfolio["notion_api_key"]
+        if key not in limiters:
+            limiters[key] = create_notion_limiter()
+            headers[key] = build_notion_headers(key)
+
+    def load(portfolio):
+        key = portfolio["notion_api_key"]
+        return load_portfolio_rows(portfolio, headers[key], session, limiters[key])
+
+    with ThreadPoolExecutor(max_workers=len(portfolios)) as executor:
+        all_rows = list(executor.map(load, portfolios))
+
+    unique_coins = set()
+    stock_values = {}
+    for rows in all_rows:
+        unique_coins.update(collect_unique_coins(rows["crypto_results"]))
+        for symbol, value in get_stock_values(rows["stock_results"]).items():
+            stock_values[symbol] = stock_values.get(symbol, 0) + value
+    print(
+        f"Portfolios: count={len(portfolios)}, coins={len(unique_coins)}, "
+        f"stocks={len(stock_values)}"
+    )
+    crypto_prices = fetch_crypto_prices(sorted(unique_coins), session)
+    stock_prices = fetch_stock_prices(
+        stock_values, config["alpha_vantage_api_key"], session
+    )
+
+    failures = []
+
+    def fan_out(stage, targets):
+        results = {}
+        with ThreadPoolExecutor(max_workers=len(portfolios)) as executor:
+            futures = {}
+            for portfolio, rows in targets:
+                key = portfolio["notion_api_key"]
+                future = executor.submit(
+                    stage,
+                    portfolio,
+                    rows,
+                    crypto_prices,
+                    stock_prices,
+                    headers[key],
+                    session,
+                    limiters[key],
+                )
+                futures[future] = portfolio["name"]
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    results[name] = future.result()
+                except Exception as exc:
+                    # One broken workspace should not stop the others
+                    print(f"Portfolio {name} failed: {exc}")
+                    failures.append(name)
+        return results
+
+    targets = list(zip(portfolios, all_rows))
+    written = fan_out(write_portfolio_prices, targets)
+    # Every portfolio's writes are done before any total may use the reserve
+    enter_final_phase()
+    totals = fan_out(
+        finish_portfolio,
+        [target for target in targets if target[0]["name"] in written],
+    )
+    for portfolio in portfolios:
+        if portfolio["name"] in totals:
             print(
-                f"Skipping {filtered_out_count} stock entries with Amount <= 0 or USD currency"
+                f"Total for portfolio {portfolio['name']}: "
+                f"{totals[portfolio['name']]:.2f}"
             )
-        unique_stocks = list(
-            set(
-                [
-                    result["properties"]["Stock"]["select"]["name"]
-                    for result in filtered_stock_results
-                ]
+    if failures:
+        raise RuntimeError(f"Portfolios failed: {', '.join(sorted(failures))}")
+    return totals
+
+
+async def run_pipeline_async(config, headers, session):
+    # Blocking HTTP calls run in a thread pool; the event loop only sequences
+    # them, so independent stages overlap instead of running back to back
+    max_workers, _, _ = get_notion_update_settings()
+    limiter = create_notion_limiter()
+    write_limiter = AsyncRateLimiter(limiter)
+    snapshot = PortfolioSnapshot()
+    query_options = build_database_query_options(config)
+    executor = ThreadPoolExecutor(max_workers=max_workers + 4)
+    try:
+        crypto_task = asyncio.ensure_future(
+            run_blocking(
+                executor,
+                load_database_results,
+                config["crypto_database_id"],
+                headers,
+                session,
+                snapshot,
+                query_options[config["crypto_database_id"]],
+                limiter,
+                kind="crypto",
             )
         )
-        stock_prices = fetch_stock_prices(unique_stocks, alpha_vantage_api_key, session)
-        if stock_prices:
-            update_notion_prices(
-                "stock", filtered_stock_results, stock_prices, headers, session
+        stock_task = asyncio.ensure_future(
+            run_blocking(
+                executor,
+                load_database_results,
+                config["stock_database_id"],
+                headers,
+                session,
+                snapshot,
+                query_options[config["stock_database_id"]],
+                limiter,
+                kind="stock",
+            )
+        )
+        # With TOTALS_CACHE_PATH the fiat database is left to the incremental
+        # read at total time, as in the sync pipeline
+        fiat_tasks = []
+        if not os.environ.get("TOTALS_CACHE_PATH"):
+            fiat_tasks.append(
+                run_blocking(
+                    executor,
+                    load_database_results,
+                    config["fiat_database_id"],
+                    headers,
+                    session,
+                    snapshot,
+                    query_options[config["fiat_database_id"]],
+                    limiter,
+                    kind="fiat",
+                )
             )
-    else:
-        print("Skipping stock price updates")
 
-    # CALCULATE TOTAL ASSETS
-    block_id = get_required_env("TOTAL_CALLOUT_BLOCK_ID")
-    total_assets = calculate_total_assets(
-        [crypto_database_id, stock_database_id, fiat_database_id], headers, session
+        async def crypto_stage():
+            crypto_results = await crypto_task
+            # fetch_crypto_prices downloads the CoinGecko coins list only when
+            # a coin needs it, while the stock stage runs alongside
+            crypto_prices = await run_blocking(
+                executor,
+                fetch_crypto_prices,
+                collect_unique_coins(crypto_results),
+                session,
+            )
+            if crypto_prices:
+                await update_notion_prices_async(
+                    "crypto",
+                    crypto_results,
+                    crypto_prices,
+                    headers,
+                    session,
+                    executor,
+                    write_limiter,
+                    max_workers,
+                )
+                apply_prices_in_memory(crypto_results, crypto_prices)
+            return crypto_results, crypto_prices
+
+        async def stock_stage():
+            filtered_stock_results = filter_stock_results(await stock_task)
+            stock_prices = await run_blocking(
+                executor,
+                fetch_stock_prices,
+                get_stock_values(filtered_stock_results),
+                config["alpha_vantage_api_key"],
+                session,
+            )
+            if stock_prices:
+                await update_notion_prices_async(
+                    "stock",
+                    filtered_stock_results,
+                    stock_prices,
+                    headers,
+                    session,
+                    executor,
+                    write_limiter,
+                    max_workers,
+                )
+                apply_prices_in_memory(filtered_stock_results, stock_prices)
+            return filtered_stock_results, stock_prices
+
+        (crypto_results, crypto_prices), (stock_results, stock_prices), *_ = (
+            await asyncio.gather(crypto_stage(), stock_stage(), *fiat_tasks)
+        )
+
+        enter_final_phase()
+        total_assets = calculate_total_assets(
+            [
+                config["crypto_database_id"],
+                config["stock_database_id"],
+                config["fiat_database_id"],
+            ],
+            headers,
+            session,
+            snapshot,
+            query_options,
+            limiter,
+            fiat_database_id=config["fiat_database_id"],
+        )
+        await run_blocking(
+            executor,
+            update_total_assets_callout,
+            config["total_callout_block_id"],
+            total_assets,
+            headers,
+            session,
+            limiter,
+        )
+        record_price_history(
+            config,
+            {"crypto_results": crypto_results, "stock_results": stock_results},
+            crypto_prices,
+            stock_prices,
+            total_assets,
+        )
+        return total_assets
+    finally:
+        executor.shutdown(wait=True)
+
+
+@contextmanager
+def locked_run_lease(path):
+    # flock on a sidecar file serializes lease updates between invocations
+    # that share the path (an EFS mount for concurrent Lambda containers)
+    import fcntl
+
+    with open(path + ".lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def claim_run(path, owner, now=None):
+    # ("recent", result) when a run finished within RUN_RESULT_FRESH_SECONDS,
+    # ("busy", lease) while another invocation holds an unexpired lease, and
+    # ("run", None) once this invocation holds the lease
+    now = now or time.time()
+    fresh_seconds = parse_float_env(
+        "RUN_RESULT_FRESH_SECONDS", DEFAULT_RUN_RESULT_FRESH_SECONDS, 0.0
+    )
+    with locked_run_lease(path):
+        lease = read_json_file(path)
+        if not isinstance(lease, dict):
+            lease = {}
+        state = lease.get("state")
+        if state == "done" and now - lease.get("finished_at", 0) < fresh_seconds:
+            return "recent", lease.get("result")
+        if (
+            state == "running"
+            and lease.get("owner") != owner
+            and lease.get("expires_at", 0) > now
+        ):
+            return "busy", lease
+        ttl = RUN_DEADLINE.remaining() if RUN_DEADLINE is not None else None
+        if ttl is None:
+            ttl = parse_float_env(
+                "RUN_LEASE_TTL_SECONDS", DEFAULT_RUN_LEASE_TTL_SECONDS, 1.0
+            )
+        write_json_file(
+            path,
+            {
+                "state": "running",
+                "owner": owner,
+                "started_at": now,
+                "expires_at": now + ttl,
+            },
+        )
+    return "run", None
+
+
+def finish_run(path, owner, state, result=None, now=None):
+    with locked_run_lease(path):
+        lease = read_json_file(path)
+        if not isinstance(lease, dict) or lease.get("owner") != owner:
+            # The lease expired and another invocation took it over
+            return False
+        write_json_file(
+            path,
+            {
+                "state": state,
+                "owner": owner,
+                "finished_at": now or time.time(),
+                "result": result,
+            },
+        )
+    return True
+
+
+def run_single_flight(path, owner, run):
+    # Overlapping triggers wait for the run in progress and return its result
+    # instead of starting a duplicate that competes for Notion's rate limit
+    max_wait = parse_float_env(
+        "RUN_LEASE_WAIT_SECONDS", DEFAULT_RUN_LEASE_WAIT_SECONDS, 0.0
     )
-    update_total_assets_callout(block_id, total_assets, headers, session)
+    metrics = get_run_metrics()
+    wait_until = time.monotonic() + max_wait
+    waited = False
+    while True:
+        action, result = claim_run(path, owner)
+        if action == "recent":
+            print("Returning the result of a run that just finished")
+            metrics.increment("runs_attached" if waited else "runs_coalesced")
+            return result
+        if action == "run":
+            break
+        if not waited:
+            print(f"Run {result.get('owner')} is in progress; waiting for it")
+            waited = True
+        remaining = wait_until - time.monotonic()
+        if remaining <= 0 or not has_time_for_work():
+            print("Run in progress did not finish in time; not starting another")
+            metrics.increment("runs_skipped")
+            return None
+        time.sleep(cap_to_deadline(min(RUN_LEASE_POLL_SECONDS, remaining)))
+
+    try:
+        result = run()
+    except Exception:
+        # Let waiting and later triggers run instead of attaching to a failure
+        finish_run(path, owner, "failed")
+        raise
+    finish_run(path, owner, "done", result)
+    return result
+
+
+def create_runtime():
+    config = load_config()
+    max_workers, _, _ = get_notion_update_settings()
+    coingecko_workers = parse_int_env(
+        "COINGECKO_PRICE_MAX_WORKERS", DEFAULT_COINGECKO_PRICE_MAX_WORKERS, 1
+    )
+    # Writers plus the three database queries that can overlap with them, for
+    # every portfolio updated at the same time
+    portfolio_count = len(config.get("portfolios") or [config])
+    notion_pool_size = max(DEFAULT_POOL_SIZE, (max_workers + 3) * portfolio_count)
+    coingecko_pool_size = max(DEFAULT_POOL_SIZE, coingecko_workers + 1)
+    return {
+        "config": config,
+        "headers": build_notion_headers(config["notion_api_key"])
+        if config["notion_api_key"]
+        else None,
+        "session": create_session(
+            notion_pool_size,
+            coingecko_pool_size,
+            retry_notion_writes=not os.environ.get("NOTION_JOB_QUEUE_PATH"),
+        ),
+        "created_at": time.monotonic(),
+        "invocations": 0,
+    }
+
+
+def get_runtime():
+    global RUNTIME
+    warm = RUNTIME is not None
+    if not warm:
+        started_at = time.monotonic()
+        RUNTIME = create_runtime()
+        STARTUP_TIMINGS["init"] = time.monotonic() - started_at
+    RUNTIME["invocations"] += 1
+    print(
+        f"Runtime: {'warm' if warm else 'cold'} start, "
+        f"invocation={RUNTIME['invocations']}, "
+        f"age={round(time.monotonic() - RUNTIME['created_at'], 1)}s"
+    )
+    return RUNTIME, warm
+
+
+def lambda_handler(event, context):
+    metrics = start_run_metrics()
+    start_run_deadline(context)
+    runtime, warm = get_runtime()
+    config = runtime["config"]
+    session = runtime["session"]
+    headers = runtime["headers"]
+
+    def run():
+        if config.get("portfolios"):
+            if config["pipeline_mode"] == "async":
+                print("PIPELINE_MODE=async is not used with PORTFOLIOS_CONFIG")
+            return run_portfolios_pipeline(config, session)
+        if config["pipeline_mode"] == "async":
+            print("Running async pipeline")
+            return asyncio.run(run_pipeline_async(config, headers, session))
+        return run_pipeline(config, headers, session)
+
+    try:
+        lease_path = os.environ.get("RUN_LEASE_PATH")
+        if lease_path:
+            owner = getattr(context, "aws_request_id", None) or os.urandom(8).hex()
+            result = run_single_flight(lease_path, owner, run)
+        else:
+            result = run()
+    finally:
+        if not warm:
+            report_startup(metrics)
+        emit_run_metrics(
+            metrics,
+            {
+                "PipelineMode": config["pipeline_mode"],
+                "Start": "warm" if warm else "cold",
+            },
+        )
+    return result
+
+
+STARTUP_TIMINGS["import"] = time.monotonic() - IMPORT_STARTED_AT
 
 
 # Main execution
@@ -0,0 +1,81 @@
+import contextlib
+import io
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from benchmarks import run_benchmark, stand_ins
+
+
+class StandInTests(unittest.TestCase):
+    def test_generate_portfolio_sizes(self):
+        portfolio = stand_ins.generate_portfolio(
+            crypto_rows=30, stock_rows=5, fiat_rows=2, coin_count=10, stock_count=3
+        )
+        databases = portfolio["databases"]
+        self.assertEqual(len(databases[stand_ins.CRYPTO_DB_ID]), 30)
+        self.assertEqual(len(databases[stand_ins.STOCK_DB_ID]), 5)
+        self.assertEqual(len(databases[stand_ins.FIAT_DB_ID]), 2)
+        self.assertEqual(len(portfolio["coin_prices"]), 10)
+
+    def test_query_paginates_filters_and_projects(self):
+        portfolio = stand_ins.generate_portfolio(
+            crypto_rows=0, stock_rows=150, fiat_rows=0, stock_count=3
+        )
+        state = stand_ins.StandInState(portfolio)
+        body = {
+            "page_size": 100,
+            "filter": {"property": "Amount", "number": {"does_not_equal": 0}},
+        }
+        first = state.query_database(stand_ins.STOCK_DB_ID, body, ["Amount"])
+        second = state.query_database(
+            stand_ins.STOCK_DB_ID, dict(body, start_cursor=first["next_cursor"]), None
+        )
+        rows = first["results"] + second["results"]
+        self.assertTrue(first["has_more"])
+        self.assertFalse(second["has_more"])
+        self.assertTrue(all(row["properties"]["Amount"]["number"] for row in rows))
+        self.assertEqual(list(first["results"][0]["properties"]), ["Amount"])
+
+
+class RunBenchmarkTests(unittest.TestCase):
+    def test_small_sweep_runs_end_to_end(self):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            results = run_benchmark.main(
+                [
+                    "--crypto-rows",
+                    "40",
+                    "--stock-rows",
+                    "6",
+                    "--fiat-rows",
+                    "3",
+                    "--coins",
+                    "8",
+                    "--stocks",
+                    "3",
+                    "--latency-ms",
+                    "0",
+                    "--jitter-ms",
+                    "0",
+                    "--workers",
+                    "1,4",
+                    "--rps",
+                    "1000",
+                    "--burst",
+                    "5",
+                ]
+            )
+
+        self.assertEqual([result["workers"] for result in results], [1, 4])
+        for result in results:
+            self.assertGreater(result["writes"], 0)
+            self.assertEqual(result["request_counts"]["notion.block_patch"], 1)
+            self.assertEqual(result["throttled"], 0)
+        self.assertIn("writes_per_s", output.getvalue())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,8 +1,17 @@
+import asyncio
+import datetime
+import json
 import os
+import subprocess
 import sys
+import tempfile
+import threading
+import time
 import unittest
 from unittest import mock
 
+from urllib3.util.retry import RequestHistory
+
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
 import lambda_function
@@ -18,6 +27,114 @@ class ParseDataTests(unittest.TestCase):
         self.assertIsNone(lambda_function.parse_data(data))
 
 
+class StockQuoteSchedulerTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.cache_path = os.path.join(self.temp_dir.name, "quotes.json")
+        self.env = mock.patch.dict(
+            os.environ, {"STOCK_QUOTE_CACHE_PATH": self.cache_path}
+        )
+        self.env.start()
+        self.sleep = mock.patch("lambda_function.time.sleep")
+        self.sleep.start()
+
+    def tearDown(self):
+        self.sleep.stop()
+        self.env.stop()
+        self.temp_dir.cleanup()
+
+    def test_get_run_allowance_spreads_budget(self):
+        self.assertEqual(lambda_function.get_run_allowance(25, 0), 2)
+        self.assertEqual(lambda_function.get_run_allowance(3, 21), 1)
+        self.assertEqual(lambda_function.get_run_allowance(5, 23), 5)
+        self.assertEqual(lambda_function.get_run_allowance(0, 10), 0)
+
+    def test_plan_prefers_missing_then_stale_valuable_holdings(self):
+        quotes = {
+            "AAPL": {"price": 1.0, "fetched_at": 0},
+            "MSFT": {"price": 1.0, "fetched_at": 0},
+            "TSLA": {"price": 1.0, "fetched_at": 9000},
+        }
+        plan = lambda_function.plan_stock_refreshes(
+            {"AAPL": 10.0, "MSFT": 500.0, "TSLA": 1000.0, "NVDA": 5.0},
+            quotes,
+            now_ts=10000,
+            allowance=3,
+            min_age_seconds=3600,
+        )
+        self.assertEqual(plan, ["NVDA", "MSFT", "AAPL"])
+
+    def test_fetch_stock_prices_reuses_cache_and_tracks_quota(self):
+        now = datetime.datetime(2024, 1, 2, 23, 0)
+        now_ts = (now - datetime.datetime(1970, 1, 1)).total_seconds()
+        lambda_function.write_json_file(
+            self.cache_path,
+            {
+                "quota_date": "2024-01-02",
+                "quota_used": 24,
+                "quotes": {"AAPL": {"price": 150.0, "fetched_at": now_ts - 60}},
+            },
+        )
+        with mock.patch(
+            "lambda_function.request_json",
+            return_value={"Global Quote": {"05. price": "300.5"}},
+        ) as request_mock:
+            prices = lambda_function.fetch_stock_prices(
+                {"AAPL": 1500.0, "MSFT": 10.0, "TSLA": 5.0}, "key", mock.Mock(), now
+            )
+
+        self.assertEqual(request_mock.call_count, 1)
+        self.assertEqual(prices, {"USD": 1.0, "AAPL": 150.0, "MSFT": 300.5})
+        with open(self.cache_path) as cache_file:
+            cache = json.load(cache_file)
+        self.assertEqual(cache["quota_used"], 25)
+        self.assertIn("MSFT", cache["quotes"])
+
+    def test_fetch_stock_prices_stops_when_provider_rate_limits(self):
+        now = datetime.datetime(2024, 1, 3, 0, 0)
+        with mock.patch.dict(
+            os.environ, {"ALPHA_VANTAGE_DAILY_QUOTA": "48"}
+        ), mock.patch(
+            "lambda_function.request_json", return_value={"Information": "limit"}
+        ) as request_mock:
+            prices = lambda_function.fetch_stock_prices(
+                {"AAPL": 1.0, "MSFT": 2.0}, "key", mock.Mock(), now
+            )
+
+        self.assertEqual(request_mock.call_count, 1)
+        self.assertEqual(prices, {"USD": 1.0})
+        with open(self.cache_path) as cache_file:
+            self.assertEqual(json.load(cache_file)["quota_used"], 48)
+
+    def test_other_providers_refresh_past_the_alpha_vantage_quota(self):
+        now = datetime.datetime(2024, 1, 3, 12, 0)
+        lambda_function.write_json_file(
+            self.cache_path,
+            {"quota_date": "2024-01-03", "quota_used": 25, "quotes": {}},
+        )
+        env = {
+            "PRICE_PROVIDERS_STOCK": "alphavantage,finnhub",
+            "FINNHUB_API_KEY": "token",
+        }
+        with mock.patch.dict(os.environ, env), mock.patch.object(
+            lambda_function, "PROVIDER_STATS", None
+        ), mock.patch(
+            "lambda_function.request_json", return_value={"c": 10.0}
+        ) as request_mock:
+            prices = lambda_function.fetch_stock_prices(
+                {"AAPL": 1.0, "MSFT": 2.0, "TSLA": 3.0}, "key", mock.Mock(), now
+            )
+
+        self.assertEqual(request_mock.call_count, 3)
+        for call in request_mock.call_args_list:
+            self.assertIn("finnhub", call.args[2])
+        self.assertEqual(
+            prices, {"USD": 1.0, "AAPL": 10.0, "MSFT": 10.0, "TSLA": 10.0}
+        )
+        with open(self.cache_path) as cache_file:
+            self.assertEqual(json.load(cache_file)["quota_used"], 25)
+
+
 class QueryNotionDatabaseTests(unittest.TestCase):
     def test_query_notion_database_handles_pagination(self):
         first_page = {
@@ -40,8 +157,407 @@ class QueryNotionDatabaseTests(unittest.TestCase):
         self.assertEqual([item["id"] for item in results], ["1", "2", "3"])
         self.assertEqual(request_mock.call_count, 2)
 
+    def test_query_sends_projection_page_size_and_filter(self):
+        pages = [
+            {"results": [{"id": "1"}], "has_more": True, "next_cursor": "c1"},
+            {"results": [{"id": "2"}], "has_more": False},
+        ]
+        query_filter = {"property": "Amount", "number": {"greater_than": 0}}
+        with mock.patch(
+            "lambda_function.request_json", side_effect=pages
+        ) as request_mock:
+            rows = lambda_function.iter_notion_database_rows(
+                "db-id",
+                {"header": "x"},
+                mock.Mock(),
+                filter_properties=["Stock", "Amount"],
+                page_size=50,
+                query_filter=query_filter,
+            )
+            self.assertEqual(next(rows)["id"], "1")
+            self.assertEqual(request_mock.call_count, 1)
+            self.assertEqual([row["id"] for row in rows], ["2"])
+
+        first_call, second_call = request_mock.call_args_list
+        self.assertEqual(
+            first_call.kwargs["params"], {"filter_properties": ["Stock", "Amount"]}
+        )
+        self.assertEqual(
+            first_call.kwargs["payload"], {"page_size": 50, "filter": query_filter}
+        )
+        self.assertEqual(
+            second_call.kwargs["payload"],
+            {"page_size": 50, "filter": query_filter, "start_cursor": "c1"},
+        )
+
+    @mock.patch.dict(
+        os.environ,
+        {"NOTION_QUERY_PROJECTION": "false", "NOTION_QUERY_PAGE_SIZE": "500"},
+    )
+    def test_build_query_options_respects_env(self):
+        options = lambda_function.build_query_options(["Total"])
+        self.assertEqual(options, {"page_size": 100})
+
+
+class CalculateAssetBreakdownTests(unittest.TestCase):
+    def _page(self, database_id, totals, is_fiat=False):
+        return [
+            {
+                "id": f"{database_id}-{index}",
+                "parent": {"database_id": database_id},
+                "properties": {
+                    "Total": {"number": total}
+                    if is_fiat
+                    else {"formula": {"number": total}}
+                },
+            }
+            for index, total in enumerate(totals)
+        ]
+
+    def test_breakdown_streams_each_database_page_by_page(self):
+        pages = {
+            "crypto-db": [
+                self._page("crypto-db", [1.0, 2.0]),
+                self._page("crypto-db", [3.0]),
+            ],
+            "stock-db": [self._page("stock-db", [10.0])],
+            "fiat-db": [self._page("fiat-db", [100.0, 0.5], is_fiat=True)],
+        }
+        with mock.patch(
+            "lambda_function.iter_notion_database_pages",
+            side_effect=lambda database_id, headers, session, **options: iter(
+                pages[database_id]
+            ),
+        ) as pages_mock:
+            breakdown = lambda_function.calculate_asset_breakdown(
+                ["crypto-db", "stock-db", "fiat-db"],
+                {"h": "v"},
+                mock.Mock(),
+                fiat_database_id="fiat-db",
+            )
+
+        self.assertEqual(pages_mock.call_count, 3)
+        self.assertEqual(list(breakdown), ["crypto-db", "stock-db", "fiat-db"])
+        self.assertEqual(
+            breakdown, {"crypto-db": 6.0, "stock-db": 10.0, "fiat-db": 100.5}
+        )
+
+    def test_fiat_database_matches_ids_with_or_without_dashes(self):
+        with mock.patch(
+            "lambda_function.iter_notion_database_pages",
+            return_value=iter([self._page("ab-cd", [7.0], is_fiat=True)]),
+        ):
+            breakdown = lambda_function.calculate_asset_breakdown(
+                ["ab-cd"], {}, mock.Mock(), fiat_database_id="ABCD"
+            )
+        self.assertEqual(breakdown, {"ab-cd": 7.0})
+
+
+class HoldingTests(unittest.TestCase):
+    def test_parse_holding_keeps_only_the_fields_in_use(self):
+        holding = lambda_function.parse_holding(
+            {
+                "id": "p1",
+                "parent": {"database_id": "crypto-db"},
+                "last_edited_time": "2024-05-01T11:00:00.000Z",
+                "properties": {
+                    "Coin": {"select": {"name": "BTC"}},
+                    "Amount": {"number": 2},
+                    "Price": {"number": True},
+                    "Total": {"formula": {"type": "number", "number": 20.0}},
+                },
+            }
+        )
+        self.assertEqual(
+            (holding.page_id, holding.database_id, holding.symbol),
+            ("p1", "crypto-db", "BTC"),
+        )
+        self.assertEqual(
+            (holding.amount, holding.price, holding.total), (2, None, 20.0)
+        )
+        self.assertFalse(holding.archived)
+        self.assertFalse(hasattr(holding, "__dict__"))
+
+    def test_parse_holding_reads_fiat_rows(self):
+        holding = lambda_function.parse_holding(
+            {
+                "id": "f1",
+                "in_trash": True,
+                "properties": {
+                    "Currency": {"select": {"name": "EUR"}},
+                    "Total": {"number": 5.5},
+                },
+            },
+            "fiat-db",
+        )
+        self.assertEqual((holding.database_id, holding.symbol), ("fiat-db", "EUR"))
+        self.assertEqual(holding.total, 5.5)
+        self.assertTrue(holding.archived)
+
+    def test_request_json_decodes_bytes_with_orjson(self):
+        orjson = mock.Mock()
+        orjson.loads.return_value = {"ok": True}
+        response = mock.Mock(status_code=200, content=b'{"ok": true}')
+        with mock.patch.object(lambda_function, "orjson", orjson), mock.patch(
+            "lambda_function.send_request", return_value=response
+        ):
+            data = lambda_function.request_json(mock.Mock(), "GET", "url")
+        self.assertEqual(data, {"ok": True})
+        orjson.loads.assert_called_once_with(b'{"ok": true}')
+        response.json.assert_not_called()
+
+
+class ValuationTests(unittest.TestCase):
+    def _holding(self, amount, price, total=None):
+        return lambda_function.parse_holding(
+            {
+                "properties": {
+                    "Amount": {"number": amount},
+                    "Price": {"number": price},
+                    "Total": {"formula": {"number": total}},
+                }
+            }
+        )
+
+    def _fiat(self, total, currency=None):
+        row = {"properties": {"Total": {"number": total}}}
+        if currency:
+            row["properties"]["Currency"] = {"select": {"name": currency}}
+        return lambda_function.parse_holding(row)
+
+    def test_holdings_are_valued_from_amount_and_price(self):
+        rows = [
+            self._holding(2, 10.0, total=1.0),
+            self._holding(None, 5.0, total=7.0),
+            lambda_function.parse_holding({"properties": {}}),
+        ]
+        with mock.patch.object(lambda_function, "numpy", None):
+            values = lambda_function.value_rows(rows, False)
+            subtotal = lambda_function.sum_database_rows(rows, False)
+
+        self.assertEqual(list(values), [20.0, 7.0, 0.0])
+        self.assertEqual(subtotal, 27.0)
+
+    def test_fiat_rows_are_converted_with_fx_rates(self):
+        rows = [self._fiat(100.0, "EUR"), self._fiat(50.0, "usd"), self._fiat(10.0)]
+        with mock.patch.dict(os.environ, {"FIAT_FX_RATES": '{"eur": 1.1}'}):
+            fx_rates = lambda_function.load_fx_rates()
+
+        self.assertEqual(fx_rates, {"EUR": 1.1})
+        self.assertAlmostEqual(
+            lambda_function.sum_database_rows(rows, True, fx_rates), 170.0
+        )
+
+    def test_invalid_fx_rates_are_ignored(self):
+        with mock.patch.dict(os.environ, {"FIAT_FX_RATES": "[1]"}), mock.patch(
+            "builtins.print"
+        ):
+            self.assertEqual(lambda_function.load_fx_rates(), {})
+
+    def test_cached_pages_follow_fx_rate_changes(self):
+        pages = [
+            {"value": 100.0, "currency": "EUR"},
+            {"value": 5.0},
+        ]
+        self.assertEqual(lambda_function.sum_cached_pages(pages), 105.0)
+        self.assertEqual(
+            lambda_function.sum_cached_pages(pages, {"EUR": 2.0}), 205.0
+        )
+
+
+class IncrementalTotalsTests(unittest.TestCase):
+    NOW = datetime.datetime(2024, 5, 1, 12, 0)
+
+    def _row(self, page_id, total, **extra):
+        row = {
+            "id": page_id,
+            "last_edited_time": "2024-05-01T11:00:00.000Z",
+            "properties": {"Total": {"number": total}},
+        }
+        row.update(extra)
+        return row
+
+    def _pages(self, rows, complete=True):
+        def pages(*args, **options):
+            self.calls.append(options)
+            yield rows
+            return complete
+
+        return pages
+
+    def _subtotal(self, cache, rows, complete=True, now=None):
+        with mock.patch(
+            "lambda_function.iter_notion_database_pages",
+            side_effect=self._pages(rows, complete),
+        ):
+            return lambda_function.incremental_database_subtotal(
+                "fiat-db",
+                True,
+                {},
+                mock.Mock(),
+                cache,
+                {"query_filter": {"property": "Amount"}},
+                now=now or self.NOW,
+            )
+
+    def setUp(self):
+        self.calls = []
+
+    def test_first_run_reads_everything_then_only_edited_pages(self):
+        cache = {"databases": {}}
+        first = self._subtotal(cache, [self._row("a", 10.0), self._row("b", 5.0)])
+        second = self._subtotal(
+            cache,
+            [self._row("b", 7.0), self._row("a", 10.0, archived=True)],
+            now=self.NOW + datetime.timedelta(hours=1),
+        )
+
+        self.assertEqual(first, 15.0)
+        self.assertEqual(second, 7.0)
+        self.assertEqual(self.calls[0]["query_filter"], {"property": "Amount"})
+        self.assertEqual(
+            self.calls[1]["query_filter"],
+            lambda_function.build_edited_since_filter("2024-05-01T11:58:00.000Z"),
+        )
+        entry = cache["databases"]["fiatdb"]
+        self.assertEqual(list(entry["pages"]), ["b"])
+        self.assertEqual(entry["checkpoint"], "2024-05-01T12:58:00.000Z")
+
+    def test_full_reconcile_after_interval_drops_deleted_pages(self):
+        cache = {"databases": {}}
+        self._subtotal(cache, [self._row("a", 10.0), self._row("b", 5.0)])
+        with mock.patch.dict(os.environ, {"TOTALS_FULL_RECONCILE_SECONDS": "3600"}):
+            total = self._subtotal(
+                cache, [self._row("b", 5.0)], now=self.NOW + datetime.timedelta(hours=2)
+            )
+
+        self.assertEqual(total, 5.0)
+        self.assertEqual(self.calls[1]["query_filter"], {"property": "Amount"})
+
+    def test_failed_read_keeps_previous_checkpoint(self):
+        cache = {"databases": {}}
+        self._subtotal(cache, [self._row("a", 10.0)])
+        checkpoint = cache["databases"]["fiatdb"]["checkpoint"]
+        total = self._subtotal(
+            cache,
+            [self._row("a", 12.0)],
+            complete=False,
+            now=self.NOW + datetime.timedelta(hours=1),
+        )
+
+        self.assertEqual(total, 12.0)
+        self.assertEqual(cache["databases"]["fiatdb"]["checkpoint"], checkpoint)
+        self.assertEqual(cache["databases"]["fiatdb"]["pages"]["a"]["value"], 10.0)
+
+    def test_breakdown_persists_cache_when_path_is_set(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "totals.json")
+            with mock.patch.dict(os.environ, {"TOTALS_CACHE_PATH": path}), mock.patch(
+                "lambda_function.iter_notion_database_pages",
+                side_effect=self._pages([self._row("a", 3.0)]),
+            ):
+                breakdown = lambda_function.calculate_asset_breakdown(
+                    ["fiat-db"], {}, mock.Mock(), fiat_database_id="fiat-db"
+                )
+            with open(path) as cache_file:
+                cache = json.load(cache_file)
+
+        self.assertEqual(breakdown, {"fiat-db": 3.0})
+        self.assertEqual(cache["databases"]["fiatdb"]["pages"]["a"]["value"], 3.0)
+
+    def test_concurrent_portfolios_keep_each_others_cache_entries(self):
+        both_loaded = threading.Barrier(2)
+        load = lambda_function.load_totals_cache
+
+        def load_together(path):
+            cache = load(path)
+            # Both portfolios read the file before either writes it
+            if not lambda_function.TOTALS_CACHE_LOCK.locked():
+                both_loaded.wait(5)
+            return cache
+
+        def breakdown(database_id):
+            lambda_function.calculate_asset_breakdown(
+                [database_id], {}, mock.Mock(), fiat_database_id=database_id
+            )
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "totals.json")
+            with mock.patch.dict(os.environ, {"TOTALS_CACHE_PATH": path}), mock.patch(
+                "lambda_function.iter_notion_database_pages",
+                side_effect=self._pages([self._row("a", 3.0)]),
+            ), mock.patch(
+                "lambda_function.load_totals_cache", side_effect=load_together
+            ), mock.patch("builtins.print"):
+                threads = [
+                    threading.Thread(target=breakdown, args=(database_id,))
+                    for database_id in ("fiat-one", "fiat-two")
+                ]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            with open(path) as cache_file:
+                cache = json.load(cache_file)
+
+        self.assertEqual(sorted(cache["databases"]), ["fiatone", "fiattwo"])
+
 
 class UpdateTotalAssetsCalloutTests(unittest.TestCase):
+    def setUp(self):
+        self.patcher = mock.patch.object(lambda_function, "CALLOUT_CACHE", None)
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def _update(self, total, block=None, patch_response=None):
+        block = block or {
+            "callout": {"rich_text": [{"type": "text", "text": {"content": "Total"}}]}
+        }
+        with mock.patch(
+            "lambda_function.request_json", return_value=block
+        ) as json_mock, mock.patch(
+            "lambda_function.request_status", return_value=True
+        ) as status_mock, mock.patch(
+            "lambda_function.send_request",
+            return_value=patch_response or mock.Mock(status_code=200),
+        ) as send_mock, mock.patch(
+            "builtins.print"
+        ):
+            lambda_function.update_total_assets_callout(
+                "block-id", total, {"h": "v"}, mock.Mock()
+            )
+        return json_mock.call_count, status_mock.call_count, send_mock.call_count
+
+    def test_cached_layout_skips_the_get_and_unchanged_total_skips_the_patch(self):
+        self.assertEqual(self._update(42.5), (1, 1, 0))
+        self.assertEqual(self._update(42.5), (0, 0, 0))
+        self.assertEqual(self._update(43.0), (0, 0, 1))
+        cached = lambda_function.get_callout_cache()["block-id"]["rich_text"]
+        self.assertEqual(cached[0]["text"]["content"], "Total")
+        self.assertEqual(cached[1]["text"]["content"], ": $43.00")
+
+    def test_rejected_layout_falls_back_to_get(self):
+        self._update(42.5)
+        rejected = mock.Mock(status_code=400, text="validation_error")
+        self.assertEqual(self._update(50.0, patch_response=rejected), (1, 1, 1))
+
+    def test_transient_failure_keeps_cached_layout(self):
+        self._update(42.5)
+        self.assertEqual(
+            self._update(50.0, patch_response=mock.Mock(status_code=502)), (0, 0, 1)
+        )
+        self.assertIn("block-id", lambda_function.get_callout_cache())
+
+    def test_cache_is_persisted_when_path_is_set(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "callout.json")
+            with mock.patch.dict(os.environ, {"CALLOUT_CACHE_PATH": path}):
+                self._update(42.5)
+                lambda_function.CALLOUT_CACHE = None
+                self.assertEqual(self._update(42.5), (0, 0, 0))
+
     def test_update_total_assets_callout_sets_text(self):
         block_response = {
             "callout": {"rich_text": [{"type": "text", "text": {"content": "Total"}}]}
@@ -66,6 +582,157 @@ class FetchCryptoPricesTests(unittest.TestCase):
         self.assertEqual(prices, {})
 
 
+class CoinGeckoPriceBatchTests(unittest.TestCase):
+    def test_chunk_coin_ids_respects_batch_size(self):
+        chunks = lambda_function.chunk_coin_ids(
+            ["a", "b", "c", "d", "e"], ["usd"], batch_size=2, max_url_length=2000
+        )
+        self.assertEqual(chunks, [["a", "b"], ["c", "d"], ["e"]])
+
+    def test_chunk_coin_ids_respects_url_length(self):
+        coin_ids = ["coin-%03d" % index for index in range(50)]
+        chunks = lambda_function.chunk_coin_ids(
+            coin_ids, ["usd", "eur"], batch_size=100, max_url_length=256
+        )
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual([coin for chunk in chunks for coin in chunk], coin_ids)
+        for chunk in chunks:
+            url = lambda_function.build_coingecko_price_url(chunk, ["usd", "eur"])
+            self.assertLessEqual(len(url), 256)
+
+    @mock.patch.dict(
+        os.environ, {"COINGECKO_PRICE_BATCH_SIZE": "1", "COINGECKO_RPS_LIMIT": "1000"}
+    )
+    def test_failed_batch_only_loses_its_own_coins(self):
+        def fake_request(session, method, url):
+            if "ids=ethereum" in url:
+                return None
+            return {"bitcoin": {"usd": 100.0, "eur": 90.0}}
+
+        with mock.patch("lambda_function.request_json", side_effect=fake_request):
+            data = lambda_function.fetch_coingecko_price_batches(
+                ["bitcoin", "ethereum"], ["usd", "eur"], mock.Mock()
+            )
+        self.assertEqual(data, {"bitcoin": {"usd": 100.0, "eur": 90.0}})
+
+    def test_fetch_crypto_prices_maps_symbols_to_usd(self):
+        with mock.patch(
+            "lambda_function.get_cached_symbol_index",
+            return_value={"btc": ["bitcoin"], "eth": ["ethereum"]},
+        ), mock.patch(
+            "lambda_function.fetch_coingecko_price_batches",
+            return_value={"bitcoin": {"usd": 100.0}},
+        ):
+            prices = lambda_function.fetch_crypto_prices(["BTC", "ETH"], mock.Mock())
+        self.assertEqual(prices, {"BTC": 100.0})
+
+
+class SymbolIndexCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.cache_path = os.path.join(self.temp_dir.name, "index.json")
+        self.env = mock.patch.dict(
+            os.environ, {"COINGECKO_SYMBOL_CACHE_PATH": self.cache_path}
+        )
+        self.env.start()
+        self.global_cache = mock.patch.object(
+            lambda_function, "COINGECKO_SYMBOL_CACHE", None
+        )
+        self.global_cache.start()
+
+    def tearDown(self):
+        self.global_cache.stop()
+        self.env.stop()
+        self.temp_dir.cleanup()
+
+    def _response(self, status_code, body=None, etag=None):
+        response = mock.Mock(status_code=status_code, text="")
+        response.json.return_value = body
+        response.headers = {"ETag": etag} if etag else {}
+        return response
+
+    def test_build_symbol_index_groups_candidates(self):
+        index = lambda_function.build_symbol_index(
+            [
+                {"id": "bitcoin", "symbol": "btc"},
+                {"id": "batcat", "symbol": "BTC"},
+                {"id": "ethereum", "symbol": "eth"},
+            ]
+        )
+        self.assertEqual(index, {"btc": ["bitcoin", "batcat"], "eth": ["ethereum"]})
+
+    def test_index_is_persisted_and_reused_on_cold_start(self):
+        session = mock.Mock()
+        session.request.return_value = self._response(
+            200, [{"id": "bitcoin", "symbol": "btc"}], etag="v1"
+        )
+        index = lambda_function.get_cached_symbol_index(session, "url")
+        self.assertEqual(index, {"btc": ["bitcoin"]})
+
+        lambda_function.COINGECKO_SYMBOL_CACHE = None
+        cold_session = mock.Mock()
+        index = lambda_function.get_cached_symbol_index(cold_session, "url")
+        self.assertEqual(index, {"btc": ["bitcoin"]})
+        cold_session.request.assert_not_called()
+
+    def test_expired_index_is_revalidated_with_etag(self):
+        lambda_function.write_json_file(
+            self.cache_path,
+            {"index": {"btc": ["bitcoin"]}, "fetched_at": 0, "etag": "v1"},
+        )
+        session = mock.Mock()
+        session.request.return_value = self._response(304)
+        index = lambda_function.get_cached_symbol_index(session, "url")
+
+        self.assertEqual(index, {"btc": ["bitcoin"]})
+        self.assertEqual(
+            session.request.call_args.kwargs["headers"], {"If-None-Match": "v1"}
+        )
+        self.assertGreater(lambda_function.COINGECKO_SYMBOL_CACHE["fetched_at"], 0)
+        self.assertLess(
+            time.time() - lambda_function.COINGECKO_SYMBOL_CACHE["fetched_at"], 60
+        )
+
+
+class SymbolMappingTests(unittest.TestCase):
+    INDEX = {
+        "btc": ["batcat", "bitcoin"],
+        "eth": ["ethereum", "ethereum-wormhole"],
+        "abc": ["abc-two", "abc-one"],
+        "ada": ["cardano"],
+    }
+
+    @mock.patch.dict(os.environ, {}, clear=True)
+    def test_default_overrides_pin_ambiguous_symbols(self):
+        mapping = lambda_function.create_symbol_to_id_mapping(
+            self.INDEX, ["BTC", "ETH", "ADA"]
+        )
+        self.assertEqual(
+            mapping, {"btc": "bitcoin", "eth": "ethereum", "ada": "cardano"}
+        )
+
+    @mock.patch.dict(os.environ, {"COINGECKO_SYMBOL_OVERRIDES": '{"ABC": "abc-one"}'})
+    def test_env_overrides_extend_defaults(self):
+        mapping = lambda_function.create_symbol_to_id_mapping(
+            self.INDEX, ["ABC", "BTC"]
+        )
+        self.assertEqual(mapping, {"abc": "abc-one", "btc": "bitcoin"})
+
+    @mock.patch.dict(os.environ, {}, clear=True)
+    def test_ambiguous_symbol_without_override_is_deterministic(self):
+        with mock.patch("builtins.print") as print_mock:
+            mapping = lambda_function.create_symbol_to_id_mapping(
+                self.INDEX, ["ABC", "XYZ"]
+            )
+        self.assertEqual(mapping, {"abc": "abc-two"})
+        messages = [call.args[0] for call in print_mock.call_args_list]
+        self.assertIn(
+            "Warning: Ambiguous CoinGecko symbol ABC: candidates=abc-one,abc-two, "
+            "using abc-two. Add it to COINGECKO_SYMBOL_OVERRIDES to pin the id.",
+            messages,
+        )
+
+
 class SelectHelpersTests(unittest.TestCase):
     def test_get_select_name_returns_none_for_missing(self):
         result = {"id": "page-1", "properties": {"Coin": {"select": None}}}
@@ -81,7 +748,11 @@ class SelectHelpersTests(unittest.TestCase):
         }
         with mock.patch("lambda_function.request_status") as status_mock:
             lambda_function.update_notion_prices(
-                "crypto", [result], {"BTC": 100.0}, {"h": "v"}, mock.Mock()
+                "crypto",
+                [lambda_function.parse_holding(result)],
+                {"BTC": 100.0},
+                {"h": "v"},
+                mock.Mock(),
             )
 
         status_mock.assert_not_called()
@@ -90,23 +761,27 @@ class SelectHelpersTests(unittest.TestCase):
 class BuildUpdateJobsTests(unittest.TestCase):
     def test_build_update_jobs_skips_missing_coin(self):
         results = [
-            {
-                "id": "page-1",
-                "properties": {"Coin": {"select": None}, "Price": {"number": 1.0}},
-            }
+            lambda_function.parse_holding(
+                {
+                    "id": "page-1",
+                    "properties": {"Coin": {"select": None}, "Price": {"number": 1.0}},
+                }
+            )
         ]
         jobs = lambda_function.build_update_jobs("crypto", results, {"BTC": 2.0})
         self.assertEqual(jobs, [])
 
     def test_build_update_jobs_stock_payload(self):
         results = [
-            {
-                "id": "page-2",
-                "properties": {
-                    "Stock": {"select": {"name": "AAPL"}},
-                    "Price": {"number": 100.0},
-                },
-            }
+            lambda_function.parse_holding(
+                {
+                    "id": "page-2",
+                    "properties": {
+                        "Stock": {"select": {"name": "AAPL"}},
+                        "Price": {"number": 100.0},
+                    },
+                }
+            )
         ]
         jobs = lambda_function.build_update_jobs("stock", results, {"AAPL": 123.45})
         self.assertEqual(len(jobs), 1)
@@ -120,7 +795,16 @@ class BuildUpdateJobsTests(unittest.TestCase):
 class UpdateNotionPricesTests(unittest.TestCase):
     @mock.patch.dict(os.environ, {}, clear=True)
     def test_update_notion_prices_uses_defaults(self):
-        jobs = [{"symbol": "BTC", "page_id": "page-1", "url": "u", "payload": {}}]
+        jobs = [
+            {
+                "symbol": "BTC",
+                "page_id": "page-1",
+                "url": "u",
+                "payload": {},
+                "current_price": 0.5,
+                "new_price": 1.0,
+            }
+        ]
         with mock.patch(
             "lambda_function.build_update_jobs", return_value=jobs
         ), mock.patch("lambda_function.run_notion_updates_concurrently") as run_mock:
@@ -143,6 +827,58 @@ class UpdateNotionPricesTests(unittest.TestCase):
         run_mock.assert_not_called()
 
 
+class ChangeDetectionTests(unittest.TestCase):
+    def _stock_row(self, page_id, symbol, price):
+        return lambda_function.parse_holding(
+            {
+                "id": page_id,
+                "properties": {
+                    "Stock": {"select": {"name": symbol}},
+                    "Price": {"number": price},
+                },
+            }
+        )
+
+    def test_filter_changed_jobs_drops_unchanged_and_missing(self):
+        rows = [
+            self._stock_row("p1", "AAPL", 100.0),
+            self._stock_row("p2", "MSFT", 200.0),
+            self._stock_row("p3", "TSLA", 300.0),
+        ]
+        jobs = lambda_function.build_update_jobs(
+            "stock", rows, {"AAPL": 100.0, "MSFT": 201.0}
+        )
+        changed, skipped = lambda_function.filter_changed_jobs(jobs)
+        self.assertEqual([job["symbol"] for job in changed], ["MSFT"])
+        self.assertEqual(skipped, 2)
+
+    def test_filter_changed_jobs_applies_tolerance(self):
+        rows = [
+            self._stock_row("p1", "AAPL", 100.0),
+            self._stock_row("p2", "MSFT", 200.0),
+        ]
+        jobs = lambda_function.build_update_jobs(
+            "stock", rows, {"AAPL": 100.4, "MSFT": 210.0}
+        )
+        changed, skipped = lambda_function.filter_changed_jobs(
+            jobs, rel_tolerance=0.01
+        )
+        self.assertEqual([job["symbol"] for job in changed], ["MSFT"])
+        self.assertEqual(skipped, 1)
+
+    @mock.patch.dict(os.environ, {"PRICE_CHANGE_ABS_TOLERANCE_STOCK": "5"})
+    def test_update_notion_prices_reports_saved_writes(self):
+        rows = [self._stock_row("p1", "AAPL", 100.0)]
+        with mock.patch(
+            "lambda_function.run_notion_updates_concurrently"
+        ) as run_mock:
+            outcomes = lambda_function.update_notion_prices(
+                "stock", rows, {"AAPL": 103.0}, {"h": "v"}, mock.Mock()
+            )
+        run_mock.assert_not_called()
+        self.assertEqual(outcomes, {"ok": 0, "fail": 0, "deferred": 0, "skipped": 1})
+
+
 class RateLimiterTests(unittest.TestCase):
     def test_rate_limiter_enforces_interval(self):
         limiter = lambda_function.RateLimiter(rps_limit=2.0, burst=1)
@@ -155,6 +891,271 @@ class RateLimiterTests(unittest.TestCase):
         sleep_mock.assert_called_once_with(0.5)
 
 
+class AdaptiveRateLimiterTests(unittest.TestCase):
+    def test_sleep_happens_outside_the_lock(self):
+        limiter = lambda_function.RateLimiter(rps_limit=1.0, burst=1)
+        limiter._next_allowed_at = 0.0
+
+        def fake_sleep(delay):
+            self.assertFalse(limiter._lock.locked())
+
+        with mock.patch(
+            "lambda_function.time.monotonic", return_value=0.0
+        ), mock.patch(
+            "lambda_function.time.sleep", side_effect=fake_sleep
+        ) as sleep_mock:
+            limiter.wait_for_slot()
+            limiter.wait_for_slot()
+        sleep_mock.assert_called_once_with(1.0)
+
+    def test_throttle_halves_rate_and_success_ramps_back(self):
+        limiter = lambda_function.RateLimiter(rps_limit=2.0, burst=1)
+        limiter.record_throttle()
+        self.assertEqual(limiter.rps, 1.0)
+        self.assertAlmostEqual(limiter.interval, 1.0)
+        for _ in range(30):
+            limiter.record_success()
+        self.assertEqual(limiter.rps, 2.0)
+        now = time.monotonic()
+        with mock.patch("lambda_function.time.monotonic") as monotonic_mock:
+            for step in range(1, 11):
+                # Each 429 arrives after the previous backoff window
+                monotonic_mock.return_value = now + step * 10
+                limiter.record_throttle()
+        self.assertAlmostEqual(limiter.rps, 0.2)
+
+    def test_throttles_within_one_backoff_window_cut_once(self):
+        limiter = lambda_function.RateLimiter(rps_limit=4.0, burst=1)
+        with mock.patch("lambda_function.time.monotonic") as monotonic_mock:
+            monotonic_mock.return_value = 100.0
+            limiter.record_throttle(retry_after=2)
+            monotonic_mock.return_value = 101.0
+            limiter.record_throttle(retry_after=2)
+            limiter.record_throttle()
+            self.assertEqual(limiter.rps, 2.0)
+            # Past the Retry-After window the next 429 is a new signal
+            monotonic_mock.return_value = 102.0
+            limiter.record_throttle()
+            self.assertEqual(limiter.rps, 1.0)
+            # Without Retry-After the window is one interval at the new rate
+            monotonic_mock.return_value = 102.5
+            limiter.record_throttle()
+            self.assertEqual(limiter.rps, 1.0)
+
+    def test_retry_after_pushes_next_slot(self):
+        limiter = lambda_function.RateLimiter(rps_limit=2.0, burst=1)
+        limiter._next_allowed_at = 0.0
+        with mock.patch("lambda_function.time.monotonic", return_value=100.0):
+            limiter.record_throttle(retry_after=3)
+            self.assertEqual(limiter.reserve(), 3.0)
+
+    def test_limited_request_retries_after_429(self):
+        limiter = lambda_function.RateLimiter(rps_limit=1000.0, burst=1)
+        throttled = mock.Mock(status_code=429, headers={"Retry-After": "0"})
+        ok = mock.Mock(status_code=200, headers={})
+        session = mock.Mock()
+        session.request.side_effect = [throttled, ok]
+        self.assertTrue(
+            lambda_function.request_status(
+                session, "PATCH", "https://api.notion.com/v1/pages/p", limiter=limiter
+            )
+        )
+        self.assertEqual(session.request.call_count, 2)
+        self.assertLess(limiter.rps, 1000.0)
+
+    def test_notion_adapter_does_not_retry_429(self):
+        session = lambda_function.create_session()
+        notion_adapter = session.get_adapter("https://api.notion.com/v1/pages")
+        other_adapter = session.get_adapter("https://api.coingecko.com/")
+        notion_retry = notion_adapter.max_retries
+        other_retry = other_adapter.max_retries
+        self.assertNotIn(429, notion_retry.status_forcelist)
+        self.assertIn(429, other_retry.status_forcelist)
+
+
+class DeadlineTests(unittest.TestCase):
+    def setUp(self):
+        self.patcher = mock.patch.object(lambda_function, "RUN_DEADLINE", None)
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def _start(self, remaining_ms, reserve="10"):
+        context = mock.Mock()
+        context.get_remaining_time_in_millis.return_value = remaining_ms
+        with mock.patch.dict(os.environ, {"DEADLINE_RESERVE_SECONDS": reserve}):
+            return lambda_function.start_run_deadline(context)
+
+    def test_no_context_means_no_deadline(self):
+        self.assertIsNone(lambda_function.start_run_deadline(None))
+        self.assertTrue(lambda_function.has_time_for_work())
+        self.assertEqual(
+            lambda_function.get_request_timeout(),
+            lambda_function.DEFAULT_TIMEOUT_SECONDS,
+        )
+
+    def test_reserve_is_held_back_until_the_final_phase(self):
+        self._start(14000)
+        self.assertTrue(lambda_function.has_time_for_work())
+        self.assertAlmostEqual(lambda_function.get_request_timeout(), 4.0, places=1)
+
+        self._start(10500)
+        self.assertFalse(lambda_function.has_time_for_work())
+        self.assertEqual(lambda_function.get_request_timeout(), 1.0)
+
+        lambda_function.enter_final_phase()
+        self.assertTrue(lambda_function.has_time_for_work())
+        self.assertEqual(
+            lambda_function.get_request_timeout(),
+            lambda_function.DEFAULT_TIMEOUT_SECONDS,
+        )
+
+    def test_retry_backoff_is_capped_and_exhausted_by_the_deadline(self):
+        retry = lambda_function.create_retry([500])
+        attempt = RequestHistory("GET", "/", None, 500, None)
+        later = retry.new(history=(attempt, attempt))
+        self.assertEqual(later.get_backoff_time(), 1.0)
+
+        self._start(12500)
+        self.assertLessEqual(later.get_backoff_time(), 1.5)
+        self.assertFalse(later.is_exhausted())
+        self._start(10500)
+        self.assertTrue(later.is_exhausted())
+
+    def test_updates_are_deferred_when_out_of_time(self):
+        self._start(5000)
+        jobs = [{"symbol": "BTC", "page_id": "p1", "url": "u", "payload": {}}]
+        with mock.patch("lambda_function.rate_limited_request_status") as send_mock:
+            outcomes = lambda_function.run_notion_updates_concurrently(
+                jobs, {}, mock.Mock(), 2, lambda_function.RateLimiter(0, 1)
+            )
+
+        send_mock.assert_not_called()
+        self.assertEqual(outcomes, {"ok": 0, "fail": 0, "deferred": 1})
+
+    def test_jobs_are_ordered_by_value_at_stake(self):
+        def row(page_id, coin, amount, price):
+            return lambda_function.parse_holding(
+                {
+                    "id": page_id,
+                    "properties": {
+                        "Coin": {"select": {"name": coin}},
+                        "Amount": {"number": amount},
+                        "Price": {"number": price},
+                    },
+                }
+            )
+
+        rows = [
+            row("small", "DOGE", 1000, 0.1),
+            row("large", "BTC", 2, 100.0),
+            row("medium", "ETH", -10, 10.0),
+        ]
+        jobs, _ = lambda_function.plan_notion_updates(
+            "crypto", rows, {"DOGE": 0.11, "BTC": 150.0, "ETH": 12.0}
+        )
+        self.assertEqual([job["page_id"] for job in jobs], ["large", "medium", "small"])
+
+
+class NotionJobQueueTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "jobs.sqlite")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _job(self, page_id, symbol="BTC", price=1.0):
+        return {
+            "page_id": page_id,
+            "symbol": symbol,
+            "url": f"https://api.notion.com/v1/pages/{page_id}",
+            "payload": {"properties": {"Price": {"number": price}}},
+        }
+
+    def _row(self, page_id, price):
+        return lambda_function.parse_holding(
+            {
+                "id": page_id,
+                "properties": {
+                    "Coin": {"select": {"name": "BTC"}},
+                    "Amount": {"number": 1},
+                    "Price": {"number": price},
+                },
+            }
+        )
+
+    def test_claim_follows_queue_order_and_leases_jobs(self):
+        queue = lambda_function.NotionJobQueue(self.path)
+        queue.sync("s", [self._job("a"), self._job("b")], ["a", "b"], 100.0)
+
+        first = queue.claim("s", 1, 100.0, 60)
+        second = queue.claim("s", 10, 100.0, 60)
+        self.assertEqual([job["page_id"] for job in first], ["a"])
+        self.assertEqual([job["page_id"] for job in second], ["b"])
+        self.assertEqual(queue.claim("s", 10, 120.0, 60), [])
+        self.assertEqual(len(queue.claim("s", 10, 200.0, 60)), 2)
+        self.assertEqual(queue.claim("other", 10, 200.0, 60), [])
+        queue.close()
+
+    def test_fresh_plan_replaces_and_drops_queued_jobs(self):
+        queue = lambda_function.NotionJobQueue(self.path)
+        queue.sync("s", [self._job("a", price=1.0), self._job("b")], ["a", "b"], 0.0)
+        queue.retry_later("a", 0.0, "HTTP 503")
+        queue.sync("s", [self._job("a", price=2.0)], ["a", "b"], 100.0)
+
+        jobs = queue.claim("s", 10, 100.0, 60)
+        self.assertEqual(len(jobs), 1)
+        self.assertEqual(jobs[0]["payload"]["properties"]["Price"]["number"], 2.0)
+        self.assertEqual(jobs[0]["attempts"], 1)
+        queue.close()
+
+    def test_failed_writes_are_requeued_and_resumed_by_a_later_run(self):
+        responses = {
+            "p1": [mock.Mock(status_code=503, text="busy"), mock.Mock(status_code=200)],
+            "p2": [mock.Mock(status_code=200)],
+            "p3": [mock.Mock(status_code=400, text="bad")],
+        }
+
+        def send(limiter, session, method, url, headers, payload, retries=None):
+            self.assertEqual(retries, 0)
+            return responses[url.rsplit("/", 1)[1]].pop(0)
+
+        rows = [self._row("p1", 1.0), self._row("p2", 1.0), self._row("p3", 1.0)]
+        limiter = lambda_function.RateLimiter(0, 1)
+        with mock.patch.dict(
+            os.environ, {"NOTION_JOB_QUEUE_PATH": self.path}
+        ), mock.patch(
+            "lambda_function.send_limited_request", side_effect=send
+        ), mock.patch(
+            "builtins.print"
+        ):
+            first = lambda_function.update_notion_prices(
+                "crypto", rows, {"BTC": 2.0}, {}, mock.Mock(), limiter
+            )
+            with mock.patch.object(
+                lambda_function.time, "time", return_value=time.time() + 3600
+            ):
+                second = lambda_function.update_notion_prices(
+                    "crypto", [], {}, {}, mock.Mock(), limiter
+                )
+
+        self.assertEqual(
+            first,
+            {"ok": 1, "fail": 1, "deferred": 1, "retried": 1, "skipped": 0},
+        )
+        self.assertEqual(
+            second,
+            {"ok": 1, "fail": 0, "deferred": 0, "retried": 0, "skipped": 0},
+        )
+
+    def test_session_does_not_retry_patches_with_the_queue(self):
+        session = lambda_function.create_session(retry_notion_writes=False)
+        retry = session.get_adapter("https://api.notion.com/v1/pages/x").max_retries
+        self.assertNotIn("PATCH", retry.allowed_methods)
+
+
 class RunNotionUpdatesConcurrentlyTests(unittest.TestCase):
     def test_runner_calls_rate_limited_request_per_job(self):
         jobs = [
@@ -169,7 +1170,7 @@ class RunNotionUpdatesConcurrentlyTests(unittest.TestCase):
                 jobs, {"h": "v"}, mock.Mock(), max_workers=1, limiter=mock.Mock()
             )
         self.assertEqual(request_mock.call_count, 2)
-        self.assertEqual(outcomes, {"ok": 2, "fail": 0})
+        self.assertEqual(outcomes, {"ok": 2, "fail": 0, "deferred": 0})
 
     def test_runner_failure_does_not_abort_batch(self):
         jobs = [
@@ -184,7 +1185,951 @@ class RunNotionUpdatesConcurrentlyTests(unittest.TestCase):
             outcomes = lambda_function.run_notion_updates_concurrently(
                 jobs, {"h": "v"}, mock.Mock(), max_workers=2, limiter=mock.Mock()
             )
-        self.assertEqual(outcomes, {"ok": 2, "fail": 1})
+        self.assertEqual(outcomes, {"ok": 2, "fail": 1, "deferred": 0})
+
+    def _job(self, page_id, symbol, amount, current_price, new_price):
+        return {
+            "symbol": symbol,
+            "page_id": page_id,
+            "url": page_id,
+            "payload": {},
+            "amount": amount,
+            "current_price": current_price,
+            "new_price": new_price,
+        }
+
+    def test_jobs_are_grouped_by_symbol_and_ordered_by_value(self):
+        jobs = [
+            self._job("eth", "ETH", 1, 10.0, 40.0),
+            self._job("btc-1", "BTC", 1, 10.0, 30.0),
+            self._job("doge", "DOGE", 100, 0.1, 0.1),
+            self._job("btc-2", "BTC", 1, 10.0, 25.0),
+        ]
+        ordered = lambda_function.order_jobs_by_symbol(jobs)
+        self.assertEqual(
+            [job["page_id"] for job in ordered], ["btc-1", "btc-2", "eth", "doge"]
+        )
+
+    def test_scheduler_streams_outcomes_and_tracks_symbol_progress(self):
+        jobs = [
+            self._job("eth", "ETH", 1, 1.0, 2.0),
+            self._job("btc-1", "BTC", 1, 10.0, 20.0),
+            self._job("btc-2", "BTC", 2, 10.0, 20.0),
+        ]
+        results = {"btc-1": (True, 0.1), "btc-2": (True, 0.1), "eth": (False, 0.1)}
+        sent = []
+        seen = []
+
+        def on_outcome(scheduler, job, ok):
+            seen.append((scheduler, job["page_id"], ok))
+
+        def send(limiter, session, method, url, headers=None, payload=None):
+            sent.append(url)
+            return results[url]
+
+        with mock.patch.object(lambda_function, "RUN_METRICS", None), mock.patch(
+            "lambda_function.rate_limited_request_status", side_effect=send
+        ), mock.patch("builtins.print"):
+            outcomes = lambda_function.run_notion_updates_concurrently(
+                jobs, {}, mock.Mock(), 1, mock.Mock(), on_outcome=on_outcome
+            )
+            counters = lambda_function.get_run_metrics().counters
+
+        self.assertEqual(sent, ["btc-2", "btc-1", "eth"])
+        scheduler = seen[0][0]
+        self.assertEqual(
+            seen,
+            [
+                (scheduler, "btc-2", True),
+                (scheduler, "btc-1", True),
+                (scheduler, "eth", False),
+            ],
+        )
+        self.assertEqual(outcomes, {"ok": 2, "fail": 1, "deferred": 0})
+        self.assertEqual(scheduler.progress["BTC"]["ok"], 2)
+        self.assertEqual(scheduler.progress["BTC"]["value"], 60.0)
+        self.assertIsNotNone(scheduler.progress["ETH"]["done_at"])
+        self.assertAlmostEqual(scheduler.written_value(), 60.0 / 62.0)
+        self.assertEqual(counters["notion_symbols_completed"], 1)
+
+
+class PortfolioSnapshotTests(unittest.TestCase):
+    def _crypto_row(self, page_id, coin, amount, price):
+        return lambda_function.parse_holding(
+            {
+                "id": page_id,
+                "parent": {"database_id": "crypto-db"},
+                "properties": {
+                    "Coin": {"select": {"name": coin}},
+                    "Amount": {"number": amount},
+                    "Price": {"number": price},
+                    "Total": {"formula": {"number": amount * price}},
+                },
+            }
+        )
+
+    def test_apply_prices_in_memory_updates_price_and_total(self):
+        rows = [
+            self._crypto_row("p1", "BTC", 2, 10.0),
+            self._crypto_row("p2", "ETH", 1, 5.0),
+        ]
+        applied = lambda_function.apply_prices_in_memory(rows, {"BTC": 20.0})
+        self.assertEqual(applied, 1)
+        self.assertEqual(rows[0].price, 20.0)
+        self.assertEqual(rows[0].total, 40.0)
+        self.assertEqual(rows[1].total, 5.0)
+
+    @mock.patch.dict(os.environ, {"FIAT_DB_ID": "fiat-db"})
+    def test_calculate_total_assets_only_queries_missing_databases(self):
+        snapshot = lambda_function.PortfolioSnapshot()
+        snapshot.store("crypto-db", [self._crypto_row("p1", "BTC", 2, 10.0)])
+        fiat_rows = [
+            {
+                "id": "f1",
+                "parent": {"database_id": "fiat-db"},
+                "properties": {"Total": {"number": 5.5}},
+            }
+        ]
+        with mock.patch(
+            "lambda_function.iter_notion_database_pages", return_value=iter([fiat_rows])
+        ) as query_mock:
+            total = lambda_function.calculate_total_assets(
+                ["crypto-db", "fiat-db"], {"h": "v"}, mock.Mock(), snapshot
+            )
+
+        self.assertEqual(total, 25.5)
+        query_mock.assert_called_once()
+        self.assertEqual(query_mock.call_args.args[0], "fiat-db")
+
+    def test_incomplete_read_is_not_snapshotted(self):
+        def pages(*args, **options):
+            yield [
+                {
+                    "id": "p1",
+                    "parent": {"database_id": "crypto-db"},
+                    "properties": {"Coin": {"select": {"name": "BTC"}}},
+                }
+            ]
+            return False
+
+        snapshot = lambda_function.PortfolioSnapshot()
+        with mock.patch.object(lambda_function, "RUN_METRICS", None), mock.patch(
+            "lambda_function.iter_notion_database_pages", side_effect=pages
+        ), mock.patch("builtins.print"):
+            results = lambda_function.load_database_results(
+                "crypto-db", {}, mock.Mock(), snapshot, kind="crypto"
+            )
+            phases = lambda_function.get_run_metrics().phases
+
+        self.assertEqual([holding.page_id for holding in results], ["p1"])
+        # The total queries the database again instead of summing a partial read
+        self.assertFalse(snapshot.is_loaded("crypto-db"))
+        # Metric names stay fixed however many databases there are
+        self.assertIn("db_query.crypto", phases)
+        self.assertNotIn("db_query.crypto-db", phases)
+
+
+class RuntimeContextTests(unittest.TestCase):
+    CONFIG = {"notion_api_key": "key", "pipeline_mode": "sync"}
+
+    def setUp(self):
+        self.runtime = mock.patch.object(lambda_function, "RUNTIME", None)
+        self.runtime.start()
+
+    def tearDown(self):
+        self.runtime.stop()
+
+    @mock.patch.dict(os.environ, {"NOTION_UPDATE_MAX_WORKERS": "16"})
+    def test_runtime_is_built_once_and_reused_when_warm(self):
+        with mock.patch(
+            "lambda_function.load_config", return_value=dict(self.CONFIG)
+        ) as config_mock:
+            first, first_warm = lambda_function.get_runtime()
+            second, second_warm = lambda_function.get_runtime()
+
+        config_mock.assert_called_once()
+        self.assertFalse(first_warm)
+        self.assertTrue(second_warm)
+        self.assertIs(first["session"], second["session"])
+        self.assertEqual(second["invocations"], 2)
+        self.assertEqual(first["headers"]["Authorization"], "Bearer key")
+        notion_adapter = first["session"].get_adapter("https://api.notion.com/v1/x")
+        self.assertEqual(notion_adapter._pool_maxsize, 19)
+
+    def test_lambda_handler_reuses_session_across_invocations(self):
+        with mock.patch(
+            "lambda_function.load_config", return_value=dict(self.CONFIG)
+        ), mock.patch("lambda_function.run_pipeline") as run_mock:
+            lambda_function.lambda_handler(None, None)
+            lambda_function.lambda_handler(None, None)
+
+        first_session = run_mock.call_args_list[0].args[2]
+        second_session = run_mock.call_args_list[1].args[2]
+        self.assertIs(first_session, second_session)
+
+
+class MultiPortfolioTests(unittest.TestCase):
+    def _portfolio(self, name, key="key"):
+        return {
+            "name": name,
+            "notion_api_key": key,
+            "crypto_database_id": f"{name}-crypto",
+            "stock_database_id": f"{name}-stock",
+            "fiat_database_id": f"{name}-fiat",
+            "total_callout_block_id": f"{name}-block",
+        }
+
+    def test_parse_portfolios_uses_default_key_and_validates(self):
+        entry = self._portfolio("alice")
+        del entry["notion_api_key"]
+        portfolios = lambda_function.parse_portfolios(
+            json.dumps([entry]), "test", "default-key"
+        )
+        self.assertEqual(portfolios[0]["notion_api_key"], "default-key")
+
+        del entry["fiat_database_id"]
+        with self.assertRaises(ValueError) as error:
+            lambda_function.parse_portfolios(json.dumps([entry]), "test")
+        self.assertIn("fiat_database_id", str(error.exception))
+        self.assertIn("notion_api_key", str(error.exception))
+
+    def test_load_config_switches_to_portfolios(self):
+        env = {
+            "ALPHA_VANTAGE_API_KEY": "av",
+            "PORTFOLIOS_CONFIG": json.dumps([self._portfolio("alice")]),
+        }
+        with mock.patch.dict(os.environ, env, clear=True):
+            config = lambda_function.load_config()
+        self.assertEqual([p["name"] for p in config["portfolios"]], ["alice"])
+
+    def test_prices_are_fetched_once_for_all_portfolios(self):
+        config = {
+            "alpha_vantage_api_key": "av",
+            "portfolios": [
+                self._portfolio("alice", "key-a"),
+                self._portfolio("bob", "key-a"),
+                self._portfolio("carol", "key-c"),
+            ],
+        }
+        coins = {"alice": ["BTC", "ETH"], "bob": ["BTC"], "carol": ["DOT"]}
+
+        def load(portfolio, headers, session, limiter):
+            crypto = [
+                lambda_function.Holding(coin, symbol=coin)
+                for coin in coins[portfolio["name"]]
+            ]
+            return {"crypto_results": crypto, "stock_results": [], "name": portfolio}
+
+        with mock.patch(
+            "lambda_function.load_portfolio_rows", side_effect=load
+        ), mock.patch(
+            "lambda_function.fetch_crypto_prices", return_value={"BTC": 1.0}
+        ) as crypto_mock, mock.patch(
+            "lambda_function.fetch_stock_prices", return_value={"USD": 1.0}
+        ) as stock_mock, mock.patch(
+            "lambda_function.write_portfolio_prices"
+        ) as update_mock, mock.patch(
+            "lambda_function.finish_portfolio", return_value=5.0
+        ):
+            totals = lambda_function.run_portfolios_pipeline(config, mock.Mock())
+
+        crypto_mock.assert_called_once()
+        self.assertEqual(crypto_mock.call_args.args[0], ["BTC", "DOT", "ETH"])
+        stock_mock.assert_called_once()
+        self.assertEqual(totals, {"alice": 5.0, "bob": 5.0, "carol": 5.0})
+        limiters = {
+            call.args[0]["name"]: call.args[6] for call in update_mock.call_args_list
+        }
+        self.assertIs(limiters["alice"], limiters["bob"])
+        self.assertIsNot(limiters["alice"], limiters["carol"])
+
+    def test_each_portfolio_values_its_own_fiat_database(self):
+        config = {
+            "alpha_vantage_api_key": "av",
+            "portfolios": [self._portfolio("alice"), self._portfolio("bob")],
+        }
+
+        def load(portfolio, headers, session, limiter):
+            snapshot = lambda_function.PortfolioSnapshot()
+            snapshot.store(portfolio["crypto_database_id"], [])
+            snapshot.store(portfolio["stock_database_id"], [])
+            return {
+                "snapshot": snapshot,
+                "query_options": {},
+                "crypto_results": [],
+                "stock_results": [],
+            }
+
+        fiat_rows = [
+            {
+                "id": "f1",
+                "properties": {
+                    "Currency": {"select": {"name": "EUR"}},
+                    "Total": {"number": 10.0},
+                },
+            }
+        ]
+        env = {"FIAT_FX_RATES": '{"EUR": 2.0}'}
+        with mock.patch.dict(os.environ, env, clear=True), mock.patch(
+            "lambda_function.load_portfolio_rows", side_effect=load
+        ), mock.patch(
+            "lambda_function.fetch_crypto_prices", return_value={}
+        ), mock.patch(
+            "lambda_function.fetch_stock_prices", return_value={"USD": 1.0}
+        ), mock.patch(
+            "lambda_function.iter_notion_database_pages",
+            side_effect=lambda *args, **options: iter([fiat_rows]),
+        ), mock.patch(
+            "lambda_function.update_total_assets_callout"
+        ) as callout_mock, mock.patch(
+            "builtins.print"
+        ):
+            totals = lambda_function.run_portfolios_pipeline(config, mock.Mock())
+
+        self.assertEqual(totals, {"alice": 20.0, "bob": 20.0})
+        self.assertEqual(
+            sorted(call.args[:2] for call in callout_mock.call_args_list),
+            [("alice-block", 20.0), ("bob-block", 20.0)],
+        )
+
+    def test_failed_portfolio_does_not_stop_the_others(self):
+        config = {
+            "alpha_vantage_api_key": "av",
+            "portfolios": [self._portfolio("alice"), self._portfolio("bob")],
+        }
+
+        def update(portfolio, *args):
+            if portfolio["name"] == "bob":
+                raise KeyError("Total")
+            return 1.0
+
+        with mock.patch(
+            "lambda_function.load_portfolio_rows",
+            return_value={"crypto_results": [], "stock_results": []},
+        ), mock.patch("lambda_function.fetch_crypto_prices", return_value={}), mock.patch(
+            "lambda_function.fetch_stock_prices", return_value={}
+        ), mock.patch(
+            "lambda_function.write_portfolio_prices", side_effect=update
+        ) as update_mock, mock.patch(
+            "lambda_function.finish_portfolio", return_value=1.0
+        ) as finish_mock:
+            with self.assertRaises(RuntimeError):
+                lambda_function.run_portfolios_pipeline(config, mock.Mock())
+
+        self.assertEqual(update_mock.call_count, 2)
+        self.assertEqual(finish_mock.call_count, 1)
+        self.assertEqual(finish_mock.call_args.args[0]["name"], "alice")
+
+
+class PriceHistoryStoreTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "history.bin")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_append_query_and_latest(self):
+        store = lambda_function.PriceHistoryStore(self.path)
+        for hour in range(5):
+            store.append(
+                [
+                    (hour * 3600.0, "crypto:BTC", 100.0 + hour, 200.0 + hour),
+                    (hour * 3600.0, "total", 1000.0 + hour, 1000.0 + hour),
+                ]
+            )
+
+        reopened = lambda_function.PriceHistoryStore(self.path)
+        btc = reopened.query("crypto:BTC", start=3600.0, end=3 * 3600.0)
+        self.assertEqual(
+            btc,
+            [
+                (3600.0, "crypto:BTC", 101.0, 201.0),
+                (7200.0, "crypto:BTC", 102.0, 202.0),
+            ],
+        )
+        self.assertEqual(len(reopened.query()), 10)
+        self.assertEqual(
+            reopened.latest(),
+            {
+                "crypto:BTC": (14400.0, 104.0, 204.0),
+                "total": (14400.0, 1004.0, 1004.0),
+            },
+        )
+        expected_size = (
+            lambda_function.PRICE_HISTORY_HEADER.size
+            + 10 * lambda_function.PRICE_HISTORY_RECORD.size
+        )
+        self.assertEqual(os.path.getsize(self.path), expected_size)
+
+    def test_partial_record_is_ignored_and_replaced(self):
+        store = lambda_function.PriceHistoryStore(self.path)
+        store.append([(1.0, "total", 5.0, 5.0)])
+        with open(self.path, "ab") as history_file:
+            history_file.write(b"\x00" * 7)
+
+        self.assertEqual(len(store.query()), 1)
+        store.append([(2.0, "total", 6.0, 6.0)])
+        self.assertEqual(
+            store.query(), [(1.0, "total", 5.0, 5.0), (2.0, "total", 6.0, 6.0)]
+        )
+
+    def test_failed_symbol_write_appends_nothing(self):
+        store = lambda_function.PriceHistoryStore(self.path)
+        with mock.patch("lambda_function.write_json_file", return_value=False):
+            self.assertEqual(store.append([(1.0, "total", 5.0, 5.0)]), 0)
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(store.symbols, [])
+
+    def test_concurrent_portfolios_keep_their_symbols(self):
+        def record(name):
+            for hour in range(20):
+                rows = {"crypto_results": [], "stock_results": []}
+                lambda_function.record_price_history(
+                    {"name": name}, rows, {}, {}, 1.0, timestamp=float(hour)
+                )
+
+        with mock.patch.dict(os.environ, {"PRICE_HISTORY_PATH": self.path}):
+            threads = [
+                threading.Thread(target=record, args=(name,))
+                for name in ("alice", "bob", "carol")
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        store = lambda_function.PriceHistoryStore(self.path)
+        records = store.query()
+        self.assertEqual(len(records), 60)
+        self.assertEqual(
+            {symbol for _, symbol, _, _ in records},
+            {"alice:total", "bob:total", "carol:total"},
+        )
+        # Interleaved appends still leave the file in time order
+        timestamps = [timestamp for timestamp, _, _, _ in records]
+        self.assertEqual(timestamps, sorted(timestamps))
+        self.assertEqual(
+            store.query(start=10.0), [r for r in records if r[0] >= 10.0]
+        )
+        self.assertEqual(store.query(end=10.0), [r for r in records if r[0] < 10.0])
+
+    def test_older_records_are_moved_up_to_the_last_timestamp(self):
+        store = lambda_function.PriceHistoryStore(self.path)
+        store.append([(100.002, "BTC", 1.0, 1.0)])
+        store.append([(100.001, "ETH", 2.0, 2.0)])
+
+        self.assertEqual(
+            store.query(start=100.0015),
+            [(100.002, "BTC", 1.0, 1.0), (100.002, "ETH", 2.0, 2.0)],
+        )
+        self.assertEqual(store.query(end=100.0015), [])
+
+    def test_missing_file_reads_empty(self):
+        store = lambda_function.PriceHistoryStore(self.path)
+        self.assertEqual(store.query(), [])
+        self.assertEqual(store.latest(), {})
+
+    def test_record_price_history_writes_holdings_and_total(self):
+        rows = {
+            "crypto_results": [
+                lambda_function.Holding("p1", symbol="BTC", total=20.0),
+                lambda_function.Holding("p2", symbol="BTC", total=5.0),
+            ],
+            "stock_results": [],
+        }
+        with mock.patch.dict(os.environ, {"PRICE_HISTORY_PATH": self.path}):
+            written = lambda_function.record_price_history(
+                {"name": "alice"}, rows, {"BTC": 10.0}, {}, 125.0, timestamp=60.0
+            )
+
+        self.assertEqual(written, 2)
+        self.assertEqual(
+            lambda_function.PriceHistoryStore(self.path).query(),
+            [
+                (60.0, "alice:crypto:BTC", 10.0, 25.0),
+                (60.0, "alice:total", 125.0, 125.0),
+            ],
+        )
+
+
+class AsyncPipelineTests(unittest.TestCase):
+    CONFIG = {
+        "notion_api_key": "key",
+        "alpha_vantage_api_key": "av-key",
+        "crypto_database_id": "crypto-db",
+        "stock_database_id": "stock-db",
+        "fiat_database_id": "fiat-db",
+        "total_callout_block_id": "block-id",
+        "pipeline_mode": "async",
+    }
+
+    def _rows(self, database_id):
+        if database_id == "crypto-db":
+            return [
+                {
+                    "id": "c1",
+                    "parent": {"database_id": "crypto-db"},
+                    "properties": {
+                        "Coin": {"select": {"name": "BTC"}},
+                        "Amount": {"number": 2},
+                        "Price": {"number": 10.0},
+                        "Total": {"formula": {"number": 20.0}},
+                    },
+                }
+            ]
+        if database_id == "stock-db":
+            return [
+                {
+                    "id": "s1",
+                    "parent": {"database_id": "stock-db"},
+                    "properties": {
+                        "Stock": {"select": {"name": "AAPL"}},
+                        "Amount": {"number": 1},
+                        "Price": {"number": 100.0},
+                        "Total": {"formula": {"number": 100.0}},
+                    },
+                }
+            ]
+        return [
+            {
+                "id": "f1",
+                "parent": {"database_id": "fiat-db"},
+                "properties": {"Total": {"number": 5.0}},
+            }
+        ]
+
+    def test_async_rate_limiter_spaces_slots(self):
+        shared = lambda_function.RateLimiter(rps_limit=2.0, burst=1)
+        shared._next_allowed_at = 0.0
+        limiter = lambda_function.AsyncRateLimiter(shared)
+        sleeps = []
+
+        async def fake_sleep(delay):
+            sleeps.append(delay)
+
+        async def run():
+            await limiter.wait_for_slot()
+            await limiter.wait_for_slot()
+
+        with mock.patch(
+            "lambda_function.time.monotonic", return_value=0.0
+        ), mock.patch("lambda_function.asyncio.sleep", side_effect=fake_sleep):
+            asyncio.run(run())
+        self.assertEqual(sleeps, [0.5])
+
+    @mock.patch.dict(os.environ, {"FIAT_DB_ID": "fiat-db"})
+    def test_async_pipeline_updates_prices_and_total(self):
+        with mock.patch(
+            "lambda_function.iter_notion_database_pages",
+            side_effect=lambda database_id, headers, session, **options: iter(
+                [self._rows(database_id)]
+            ),
+        ) as query_mock, mock.patch(
+            "lambda_function.get_cached_symbol_index", return_value={}
+        ) as index_mock, mock.patch(
+            "lambda_function.fetch_crypto_prices", return_value={"BTC": 15.0}
+        ), mock.patch(
+            "lambda_function.fetch_stock_prices",
+            return_value={"USD": 1.0, "AAPL": 100.0},
+        ), mock.patch(
+            "lambda_function.send_request", return_value=mock.Mock(status_code=200)
+        ) as send_mock, mock.patch(
+            "lambda_function.update_total_assets_callout"
+        ) as callout_mock:
+            total = asyncio.run(
+                lambda_function.run_pipeline_async(self.CONFIG, {}, mock.Mock())
+            )
+
+        self.assertEqual(total, 135.0)
+        self.assertEqual(query_mock.call_count, 3)
+        # The coins list is only fetched by fetch_crypto_prices, when needed
+        index_mock.assert_not_called()
+        send_mock.assert_called_once()
+        method, url, _, payload = send_mock.call_args.args[1:]
+        self.assertEqual((method, url), ("PATCH", "https://api.notion.com/v1/pages/c1"))
+        self.assertEqual(payload["properties"]["Price"]["number"], 15.0)
+        self.assertEqual(callout_mock.call_args.args[:2], ("block-id", 135.0))
+
+    def test_async_pipeline_reads_fiat_through_the_totals_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "totals.json")
+            with mock.patch.dict(
+                os.environ, {"FIAT_DB_ID": "fiat-db", "TOTALS_CACHE_PATH": path}
+            ), mock.patch(
+                "lambda_function.iter_notion_database_pages",
+                side_effect=lambda database_id, headers, session, **options: iter(
+                    [self._rows(database_id)]
+                ),
+            ), mock.patch(
+                "lambda_function.fetch_crypto_prices", return_value={"BTC": 15.0}
+            ), mock.patch(
+                "lambda_function.fetch_stock_prices",
+                return_value={"USD": 1.0, "AAPL": 100.0},
+            ), mock.patch(
+                "lambda_function.send_request", return_value=mock.Mock(status_code=200)
+            ), mock.patch(
+                "lambda_function.update_total_assets_callout"
+            ), mock.patch(
+                "builtins.print"
+            ):
+                total = asyncio.run(
+                    lambda_function.run_pipeline_async(self.CONFIG, {}, mock.Mock())
+                )
+            with open(path) as cache_file:
+                cache = json.load(cache_file)
+
+        self.assertEqual(total, 135.0)
+        self.assertEqual(list(cache["databases"]), ["fiatdb"])
+
+    def test_lambda_handler_dispatches_on_pipeline_mode(self):
+        with mock.patch.object(lambda_function, "RUNTIME", None), mock.patch(
+            "lambda_function.load_config", return_value=dict(self.CONFIG)
+        ), mock.patch("lambda_function.create_session"), mock.patch(
+            "lambda_function.run_pipeline"
+        ) as sync_mock, mock.patch(
+            "lambda_function.run_pipeline_async", new=mock.AsyncMock()
+        ) as async_mock:
+            lambda_function.lambda_handler(None, None)
+        async_mock.assert_awaited_once()
+        sync_mock.assert_not_called()
+
+
+class RunMetricsTests(unittest.TestCase):
+    def setUp(self):
+        self.patcher = mock.patch.object(lambda_function, "RUN_METRICS", None)
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def test_send_request_counts_requests_bytes_and_throttles(self):
+        metrics = lambda_function.start_run_metrics()
+        session = mock.Mock()
+        session.request.side_effect = [
+            mock.Mock(status_code=200, content=b"abcd"),
+            mock.Mock(status_code=429, content=b"{}"),
+        ]
+
+        lambda_function.send_request(session, "GET", "https://example.com/a")
+        lambda_function.send_request(session, "GET", "https://example.com/b")
+
+        self.assertEqual(metrics.counters["requests"], 2)
+        self.assertEqual(metrics.counters["response_bytes"], 6)
+        self.assertEqual(metrics.counters["throttled_429"], 1)
+        self.assertNotIn("retries", metrics.counters)
+
+    def test_to_emf_reports_phases_counters_and_write_latency(self):
+        metrics = lambda_function.RunMetrics()
+        with metrics.span("callout"):
+            pass
+        metrics.increment("notion_writes_ok", 3)
+        for seconds in (0.04, 0.2, 0.3, 6.0):
+            metrics.observe_write_latency(seconds)
+
+        record = metrics.to_emf("Test", {"PipelineMode": "sync"})
+
+        definition = record["_aws"]["CloudWatchMetrics"][0]
+        names = [metric["Name"] for metric in definition["Metrics"]]
+        self.assertEqual(definition["Namespace"], "Test")
+        self.assertEqual(definition["Dimensions"], [["PipelineMode"]])
+        self.assertIn("phase.callout", names)
+        self.assertIn("phase.total", names)
+        self.assertEqual(record["notion_writes_ok"], 3)
+        self.assertEqual(record["notion_write_latency_p50"], 200.0)
+        self.assertEqual(record["notion_write_latency_p99"], 6000.0)
+        histogram = record["notion_write_latency_histogram"]
+        self.assertEqual(histogram["le_50ms"], 1)
+        self.assertEqual(histogram["le_250ms"], 1)
+        self.assertEqual(histogram["le_500ms"], 1)
+        self.assertEqual(histogram["gt_5000ms"], 1)
+
+    def test_row_log_modes(self):
+        with mock.patch.dict(os.environ, {"ROW_LOG_MODE": "summary"}):
+            lambda_function.start_run_metrics()
+        with mock.patch("builtins.print") as print_mock:
+            lambda_function.log_row("row", "page-1")
+        print_mock.assert_not_called()
+
+        with mock.patch.dict(
+            os.environ, {"ROW_LOG_MODE": "sample", "ROW_LOG_SAMPLE_RATE": "0.5"}
+        ):
+            metrics = lambda_function.start_run_metrics()
+        sampled = [metrics.should_log_row(f"page-{i}") for i in range(1000)]
+        self.assertEqual(
+            sampled, [metrics.should_log_row(f"page-{i}") for i in range(1000)]
+        )
+        self.assertTrue(400 < sum(sampled) < 600)
+
+    def test_lambda_handler_emits_one_metrics_line(self):
+        config = {"notion_api_key": "key", "pipeline_mode": "sync"}
+        with mock.patch.object(lambda_function, "RUNTIME", None), mock.patch(
+            "lambda_function.load_config", return_value=config
+        ), mock.patch("lambda_function.run_pipeline"), mock.patch(
+            "builtins.print"
+        ) as print_mock:
+            lambda_function.lambda_handler(None, None)
+
+        lines = [
+            call.args[0]
+            for call in print_mock.call_args_list
+            if call.args and str(call.args[0]).startswith("{")
+        ]
+        self.assertEqual(len(lines), 1)
+        record = json.loads(lines[0])
+        self.assertEqual(record["PipelineMode"], "sync")
+        self.assertEqual(record["Start"], "cold")
+        self.assertIn("phase.total", record)
+
+
+class StartupTests(unittest.TestCase):
+    ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+    def test_import_stays_within_cold_start_budget(self):
+        # A fresh interpreter, as in a new Lambda container
+        script = (
+            "import json, sys, lambda_function; print(json.dumps({"
+            "'import': lambda_function.STARTUP_TIMINGS['import'], "
+            "'loaded': [name for name in ('asyncio.base_events', 'sqlite3') "
+            "if name in sys.modules]}))"
+        )
+        env = dict(os.environ, ENVIRONMENT="production")
+        output = subprocess.run(
+            [sys.executable, "-c", script],
+            cwd=self.ROOT,
+            env=env,
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout
+        report = json.loads(output.splitlines()[-1])
+
+        budget_ms = float(
+            os.environ.get(
+                "COLD_START_BUDGET_MS", lambda_function.DEFAULT_COLD_START_BUDGET_MS
+            )
+        )
+        self.assertLess(report["import"] * 1000, budget_ms)
+        self.assertEqual(report["loaded"], [])
+
+    def test_cold_start_report_records_phases_and_flags_overrun(self):
+        metrics = lambda_function.RunMetrics()
+        metrics.first_request_at = metrics.started_at + 0.2
+        with mock.patch.dict(
+            lambda_function.STARTUP_TIMINGS, {"import": 0.1, "init": 0.05}
+        ), mock.patch.dict(os.environ, {"COLD_START_BUDGET_MS": "300"}), mock.patch(
+            "builtins.print"
+        ) as print_mock:
+            total_ms = lambda_function.report_startup(metrics)
+
+        self.assertAlmostEqual(total_ms, 350.0)
+        self.assertAlmostEqual(metrics.phases["startup.first_request"], 0.2)
+        self.assertEqual(metrics.counters["cold_start_over_budget"], 1)
+        self.assertIn(
+            "Warning: Cold start exceeded COLD_START_BUDGET_MS",
+            [call.args[0] for call in print_mock.call_args_list],
+        )
+
+    def test_pinned_coins_do_not_need_the_coins_list(self):
+        with mock.patch(
+            "lambda_function.get_cached_symbol_index"
+        ) as index_mock, mock.patch(
+            "lambda_function.fetch_coingecko_price_batches",
+            return_value={"bitcoin": {"usd": 10.0}},
+        ), mock.patch(
+            "builtins.print"
+        ):
+            prices = lambda_function.fetch_crypto_prices(["BTC"], mock.Mock())
+
+        index_mock.assert_not_called()
+        self.assertEqual(prices, {"BTC": 10.0})
+
+
+class PriceProviderTests(unittest.TestCase):
+    def setUp(self):
+        patchers = [
+            mock.patch.object(lambda_function, "PROVIDER_STATS", None),
+            mock.patch.object(lambda_function, "RUN_METRICS", None),
+            mock.patch.dict(os.environ, {"PRICE_HEDGE_DELAY_SECONDS": "0.01"}),
+            mock.patch("builtins.print"),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _provider(self, name, prices, release=None):
+        calls = []
+
+        class FakeProvider(lambda_function.PriceProvider):
+            def fetch(self, symbols, session):
+                calls.append(list(symbols))
+                if release is not None:
+                    while not self.cancelled and not release.wait(0.01):
+                        pass
+                    if self.cancelled:
+                        return {}
+                return {
+                    symbol: prices[symbol] for symbol in symbols if symbol in prices
+                }
+
+        provider = FakeProvider()
+        provider.name = name
+        provider.calls = calls
+        return provider
+
+    def test_slow_primary_is_hedged_and_first_answer_wins(self):
+        release = threading.Event()
+        slow = self._provider("slow", {"BTC": 1.0}, release)
+        fast = self._provider("fast", {"BTC": 2.0})
+        try:
+            prices = lambda_function.resolve_prices(
+                "crypto", [slow, fast], ["BTC"], mock.Mock()
+            )
+        finally:
+            release.set()
+
+        self.assertEqual(prices, {"BTC": 2.0})
+        self.assertEqual(fast.calls, [["BTC"]])
+        counters = lambda_function.get_run_metrics().counters
+        self.assertEqual(counters["price_hedges"], 1)
+        self.assertEqual(counters["prices_from.fast"], 1)
+        # The losing request was cancelled and finished before we returned
+        self.assertTrue(slow.cancelled)
+        stats = lambda_function.get_provider_stats()
+        self.assertEqual(stats["slow"]["ok"], 1)
+
+    def test_missing_symbols_fall_through_to_the_next_provider(self):
+        primary = self._provider("primary", {"BTC": 1.0})
+        secondary = self._provider("secondary", {"BTC": 9.0, "ETH": 2.0})
+
+        prices = lambda_function.resolve_prices(
+            "crypto", [primary, secondary], ["BTC", "ETH"], mock.Mock()
+        )
+
+        self.assertEqual(prices, {"BTC": 1.0, "ETH": 2.0})
+        self.assertEqual(secondary.calls, [["ETH"]])
+
+    def test_provider_errors_count_as_failures_and_fall_through(self):
+        broken = self._provider("broken", {})
+        broken.fetch = mock.Mock(side_effect=ValueError("bad body"))
+        backup = self._provider("backup", {"BTC": 3.0})
+
+        prices = lambda_function.resolve_prices(
+            "crypto", [broken, backup], ["BTC"], mock.Mock()
+        )
+
+        self.assertEqual(prices, {"BTC": 3.0})
+        stats = lambda_function.get_provider_stats()
+        self.assertEqual(stats["broken"]["consecutive_failures"], 1)
+
+    def test_unknown_tickers_do_not_count_as_failures(self):
+        provider = lambda_function.FinnhubProvider("key")
+        with mock.patch.object(
+            lambda_function, "request_json", return_value={"c": 0}
+        ):
+            prices = lambda_function.run_price_provider(
+                provider, ["NOPE"], mock.Mock()
+            )
+        self.assertEqual(prices, {})
+        with mock.patch.object(lambda_function, "request_json", return_value=None):
+            prices = lambda_function.run_price_provider(
+                provider, ["AAPL"], mock.Mock()
+            )
+        self.assertIsNone(prices)
+
+        stats = lambda_function.get_provider_stats()["finnhub"]
+        self.assertEqual((stats["ok"], stats["fail"]), (1, 1))
+        self.assertEqual(stats["consecutive_failures"], 1)
+
+    def test_providers_are_ranked_by_health_then_latency(self):
+        first = self._provider("first", {})
+        second = self._provider("second", {})
+        third = self._provider("third", {})
+        lambda_function.record_provider_result("first", 1.5, True)
+        lambda_function.record_provider_result("second", 0.5, True)
+        for _ in range(lambda_function.PROVIDER_MAX_CONSECUTIVE_FAILURES):
+            lambda_function.record_provider_result("third", 0.1, False, now=100.0)
+
+        ranked = lambda_function.rank_providers([first, second, third], now=200.0)
+        self.assertEqual([p.name for p in ranked], ["second", "first", "third"])
+        later = 200.0 + lambda_function.PROVIDER_COOLDOWN_SECONDS
+        ranked = lambda_function.rank_providers([first, second, third], now=later)
+        self.assertEqual([p.name for p in ranked], ["third", "second", "first"])
+
+    def test_configured_providers_skip_missing_keys(self):
+        env = {"PRICE_PROVIDERS_STOCK": "finnhub, alphavantage"}
+        with mock.patch.dict(os.environ, env):
+            providers = lambda_function.build_price_providers("stock", "av")
+        self.assertEqual([p.name for p in providers], ["alphavantage"])
+
+    def test_coinbase_prices_are_inverted_usd_rates(self):
+        data = {"data": {"rates": {"BTC": "0.5", "ETH": "bad"}}}
+        with mock.patch("lambda_function.request_json", return_value=data):
+            prices = lambda_function.CoinbaseProvider().fetch(
+                ["btc", "ETH"], mock.Mock()
+            )
+        self.assertEqual(prices, {"btc": 2.0})
+
+
+class SingleFlightTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, "run.lease")
+        patchers = [
+            mock.patch.object(lambda_function, "RUN_METRICS", None),
+            mock.patch.object(lambda_function, "RUN_DEADLINE", None),
+            mock.patch("builtins.print"),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_trigger_after_a_fresh_run_gets_its_result(self):
+        run = mock.Mock(return_value=42.0)
+        first = lambda_function.run_single_flight(self.path, "a", run)
+        second = lambda_function.run_single_flight(self.path, "b", run)
+
+        self.assertEqual((first, second), (42.0, 42.0))
+        run.assert_called_once()
+        counters = lambda_function.get_run_metrics().counters
+        self.assertEqual(counters["runs_coalesced"], 1)
+
+    def test_trigger_during_a_run_attaches_to_it(self):
+        self.assertEqual(lambda_function.claim_run(self.path, "a"), ("run", None))
+
+        def finish(seconds):
+            lambda_function.finish_run(self.path, "a", "done", 7.0)
+
+        run = mock.Mock()
+        with mock.patch("lambda_function.time.sleep", side_effect=finish) as sleep:
+            result = lambda_function.run_single_flight(self.path, "b", run)
+
+        self.assertEqual(result, 7.0)
+        sleep.assert_called_once()
+        run.assert_not_called()
+        counters = lambda_function.get_run_metrics().counters
+        self.assertEqual(counters["runs_attached"], 1)
+
+    def test_failed_or_expired_runs_do_not_block_the_next_trigger(self):
+        with self.assertRaises(RuntimeError):
+            lambda_function.run_single_flight(
+                self.path, "a", mock.Mock(side_effect=RuntimeError("boom"))
+            )
+        self.assertEqual(lambda_function.claim_run(self.path, "b"), ("run", None))
+
+        later = time.time() + lambda_function.DEFAULT_RUN_LEASE_TTL_SECONDS + 1
+        self.assertEqual(
+            lambda_function.claim_run(self.path, "c", now=later), ("run", None)
+        )
+        self.assertFalse(lambda_function.finish_run(self.path, "b", "done", 1.0))
+
+    @mock.patch.dict(os.environ, {"RUN_LEASE_WAIT_SECONDS": "0"})
+    def test_trigger_gives_up_when_the_run_outlasts_the_wait(self):
+        lambda_function.claim_run(self.path, "a")
+        run = mock.Mock()
+        self.assertIsNone(lambda_function.run_single_flight(self.path, "b", run))
+        run.assert_not_called()
 
 
 if __name__ == "__main__":